@@ -15,6 +15,8 @@ export interface IncomingMessage {
 	is_user: boolean;
 	init: boolean;
 	model_name: string | null;
+	queue_position?: number | null;
+	estimated_wait?: number | null;
 }
 
 export interface OutgoingMessage {
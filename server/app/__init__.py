@@ -1,15 +1,19 @@
+import asyncio
 import os
 
 from fastapi import FastAPI
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.middleware.cors import CORSMiddleware
 
-from app import chatroom, websockets
+from app import chatroom, stats, websockets
 from app.dependencies import process_pool_executor
-from app.globals import ALLOWED, LOG_DIR
+from app.globals import ALLOWED, LOG_DIR, STATS_ADMIN_USER_IDS
 from app.logger import api_logger
 from app.middlewares import auth
 from database import cache, db
+from gpt.context_cache import context_cache
+from gpt.http_client import http_client_pool
+from gpt.llama_worker import llama_worker_pool
 
 
 def create_app() -> FastAPI:
@@ -46,6 +50,9 @@ def create_app() -> FastAPI:
         chatroom.router,
         tags=["chatroom"],
     )
+    if STATS_ADMIN_USER_IDS:
+        # internals of server, such as worker pids and cache sizes, for admins only
+        app.include_router(stats.router, tags=["admin"])
 
     @app.on_event("startup")
     async def startup():
@@ -59,10 +66,16 @@ def create_app() -> FastAPI:
             api_logger.critical("Redis CACHE connected!")
         else:
             api_logger.critical("Redis CACHE connection failed!")
+        app.state.context_cache_listener = asyncio.create_task(context_cache.listen())
+        http_client_pool.start()
+        llama_worker_pool.start()
 
     @app.on_event("shutdown")
     async def shutdown():
+        app.state.context_cache_listener.cancel()
         process_pool_executor.shutdown()
+        await http_client_pool.close()
+        await llama_worker_pool.close()
         await db.close()
         await cache.close()
         api_logger.critical("DB & CACHE connection closed!")
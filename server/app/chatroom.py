@@ -1,6 +1,8 @@
 from fastapi import APIRouter, Depends, Request, Response
 
+from app.exceptions import ChatroomNotFound
 from database import repository, schemas
+from gpt.cache_manager import ChatGptCacheManager
 
 router = APIRouter()
 
@@ -40,3 +42,15 @@ async def delete_chatroom(chatroom_id: int, user_id=Depends(get_user_id)):
 @router.get("/chatroom", response_model=list[schemas.Chatroom])
 async def get_chatrooms(user_id=Depends(get_user_id)):
     return await repository.get_all_chatrooms(user_id=int(user_id))
+
+
+@router.get("/chatroom/{chatroom_id}/usage")
+async def get_chatroom_usage(chatroom_id: int, user_id=Depends(get_user_id)):
+    chatroom = await repository.get_chatroom(chatroom_id=chatroom_id)
+    if chatroom.user_id != int(user_id):
+        raise ChatroomNotFound()
+    return {
+        "usage": await ChatGptCacheManager.read_usage(
+            user_id=int(user_id), chatroom_id=chatroom_id
+        )
+    }
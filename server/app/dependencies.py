@@ -1,5 +1,3 @@
 from concurrent.futures import ProcessPoolExecutor
-from multiprocessing import Manager
 
 process_pool_executor = ProcessPoolExecutor()
-process_manager = Manager()
@@ -1,4 +1,4 @@
-from os import environ
+from os import cpu_count, environ
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -17,12 +17,57 @@ Main Secret Key
 HOST_MAIN: str = environ.get("HOST_MAIN")
 DEBUG_MODE: str = environ.get("DEBUG_MODE")
 JWT_SECRET = environ.get("JWT_SECRET")
+# comma separated ids of users who can read /stats, which is disabled if empty
+STATS_ADMIN_USER_IDS: list[int] = [
+    int(user_id)
+    for user_id in environ.get("STATS_ADMIN_USER_IDS", "").split(",")
+    if user_id.strip()
+]
 
 """
 OpenAI API SECRETS
 """
 OPENAI_API_KEY: str = environ.get("OPENAI_API_KEY")
 DEFAULT_LLM_MODEL: str = environ.get("DEFAULT_LLM_MODEL")
+# chatrooms of a user generating at once, each handling its messages in its own lane
+MAX_CONCURRENT_CHATROOMS_PER_USER: int = int(
+    environ.get("MAX_CONCURRENT_CHATROOMS_PER_USER", 2)
+)
+# connections to openai api are pooled and kept alive, HTTP/2 requires `pip install httpx[http2]`
+HTTP_CLIENT_HTTP2: bool = environ.get("HTTP_CLIENT_HTTP2", "false").lower() in [
+    "1",
+    "true",
+]
+HTTP_CLIENT_MAX_CONNECTIONS: int = int(environ.get("HTTP_CLIENT_MAX_CONNECTIONS", 100))
+HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS: int = int(
+    environ.get("HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS", 20)
+)
+# documents are embedded by "openai", or by "local" deterministic embeddings without network
+EMBEDDING_BACKEND: str = environ.get("EMBEDDING_BACKEND", "openai")
+EMBEDDING_BATCH_SIZE: int = int(environ.get("EMBEDDING_BATCH_SIZE", 32))
+EMBEDDING_MAX_CONCURRENT_BATCHES: int = int(
+    environ.get("EMBEDDING_MAX_CONCURRENT_BATCHES", 4)
+)
+# embeddings of chunks are cached by content, about 6 KB each for 1536 dimensions
+EMBEDDING_CACHE_MAX_ENTRIES: int = int(
+    environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 50000)
+)
+# llama.cpp models are kept loaded by long-lived worker processes
+# comma separated names of LLMModels to load at startup, others are loaded on first use
+LLAMA_WORKER_MODELS: list[str] = [
+    model for model in environ.get("LLAMA_WORKER_MODELS", "").split(",") if model
+]
+LLAMA_PROCESSES_PER_MODEL: int = int(environ.get("LLAMA_PROCESSES_PER_MODEL", 1))
+LLAMA_CORE_BUDGET: int = int(environ.get("LLAMA_CORE_BUDGET") or cpu_count() or 1)
+LLAMA_WORKER_WARMUP: bool = environ.get("LLAMA_WORKER_WARMUP", "true").lower() in [
+    "1",
+    "true",
+]
+# states of chatrooms are cached per worker, so follow-up turns only evaluate new tokens
+# opt-in, since every worker process keeps its own budget in RAM
+LLAMA_STATE_CACHE_BYTES: int = int(environ.get("LLAMA_STATE_CACHE_BYTES", 0))
+LLAMA_STATE_SPILL_DIR: str | None = environ.get("LLAMA_STATE_SPILL_DIR") or None
+LLAMA_STATE_SPILL_BYTES: int = int(environ.get("LLAMA_STATE_SPILL_BYTES", 16 << 30))
 
 """
 MySQL DB SECRETS
@@ -48,6 +93,20 @@ REDIS_PORT: str = environ.get("REDIS_PORT")
 REDIS_DB: str = environ.get("REDIS_DB")
 REDIS_USER: str = environ.get("REDIS_USER")
 REDIS_PASSWORD: str = environ.get("REDIS_PASSWORD")
+# "list": one key per context field, "compact": one hash per chatroom
+CONTEXT_STORAGE_FORMAT: str = environ.get("CONTEXT_STORAGE_FORMAT", "list")
+# vectors are searched by brute force with "FLAT", or by approximate graph search with "HNSW"
+VECTOR_INDEX_ALGORITHM: str = environ.get("VECTOR_INDEX_ALGORITHM", "FLAT").upper()
+VECTOR_INDEX_M: int = int(environ.get("VECTOR_INDEX_M", 16))
+VECTOR_INDEX_EF_CONSTRUCTION: int = int(
+    environ.get("VECTOR_INDEX_EF_CONSTRUCTION", 200)
+)
+VECTOR_INDEX_EF_RUNTIME: int = int(environ.get("VECTOR_INDEX_EF_RUNTIME", 10))
+VECTOR_INDEX_INITIAL_CAP: int | None = (
+    int(environ["VECTOR_INDEX_INITIAL_CAP"])
+    if environ.get("VECTOR_INDEX_INITIAL_CAP")
+    else None
+)
 
 
 """
@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Depends, HTTPException, Request
+
+from app.globals import STATS_ADMIN_USER_IDS
+from database import cache
+from gpt.common import LLMModels
+from gpt.context_cache import context_cache
+from gpt.http_client import http_client_pool
+from gpt.llama_worker import llama_worker_pool
+
+router = APIRouter()
+
+
+def get_admin_user_id(request: Request) -> int:
+    """Only users of STATS_ADMIN_USER_IDS can read internals of server"""
+    user_id = int(request.state.user_id)
+    if user_id not in STATS_ADMIN_USER_IDS:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return user_id
+
+
+@router.get("/stats", dependencies=[Depends(get_admin_user_id)])
+async def stats():
+    return {
+        "context_cache": context_cache.stats,
+        "http_client": http_client_pool.stats,
+        "llama_workers": llama_worker_pool.stats,
+        "tokenizers": {
+            model.value.tokenizer.name: model.value.tokenizer.stats
+            for model in LLMModels
+        },
+        "vectorstore": cache.vectorstore.search_stats if cache.is_initiated else {},
+    }
@@ -0,0 +1,95 @@
+"""
+Benchmark comparing the two context storage formats of `ChatGptCacheManager`:
+"list" (one key per field, one orjson blob per message) and "compact" (one hash per chatroom).
+Reports redis memory per conversation (MEMORY USAGE) and read latency.
+Requires the redis configured in `config/.env`.
+
+    python -m benchmarks.context_format --messages 10 100 500
+"""
+import argparse
+import asyncio
+from statistics import median
+from time import perf_counter
+
+from tabulate import tabulate
+
+from database import cache
+from gpt.cache_manager import ChatGptCacheManager
+from gpt.common import MessageHistory, UserGptContext
+
+
+def build_context(user_id: int, chatroom_id: int, n_messages: int) -> UserGptContext:
+    context = UserGptContext.construct_default(user_id=user_id, chatroom_id=chatroom_id)
+    for idx in range(n_messages):
+        context.user_message_histories.append(
+            MessageHistory(
+                role="user", content=f"question {idx} " * 20, tokens=60, is_user=True
+            )
+        )
+        context.gpt_message_histories.append(
+            MessageHistory(
+                role="assistant",
+                content=f"answer {idx} " * 60,
+                tokens=180,
+                is_user=False,
+                model_name="chatgpt",
+            )
+        )
+    return context
+
+
+async def memory_usage(user_id: int, chatroom_id: int) -> int:
+    keys: list[bytes] = [
+        key
+        async for key in cache.redis.scan_iter(
+            ChatGptCacheManager._generate_key(user_id, chatroom_id, "*")
+        )
+    ]
+    return sum([await cache.redis.memory_usage(key) or 0 for key in keys])
+
+
+async def main(args: argparse.Namespace) -> None:
+    cache.start()
+    rows: list[list] = []
+    for n_messages in args.messages:
+        row: list = [n_messages]
+        for storage_format in ("list", "compact"):
+            ChatGptCacheManager.storage_format = storage_format
+            await ChatGptCacheManager.create_context(
+                build_context(args.user_id, args.chatroom_id, n_messages),
+                only_if_not_exists=False,
+            )
+            latencies: list[float] = []
+            for _ in range(args.repeat):
+                start = perf_counter()
+                await ChatGptCacheManager.read_context(args.user_id, args.chatroom_id)
+                latencies.append(perf_counter() - start)
+            row += [
+                await memory_usage(args.user_id, args.chatroom_id) / 1024,
+                median(latencies) * 1000,
+            ]
+            await ChatGptCacheManager.delete_chatroom(args.user_id, args.chatroom_id)
+        rows.append(row)
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "messages per role",
+                "list (KiB)",
+                "list read (ms)",
+                "compact (KiB)",
+                "compact read (ms)",
+            ],
+            floatfmt=".2f",
+        )
+    )
+    await cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--user-id", type=int, default=999_999_999)
+    parser.add_argument("--chatroom-id", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,106 @@
+"""
+Benchmark for loading chatroom contexts on websocket connect.
+Compares the per-key access pattern (one awaited GET/LRANGE per field, for every chatroom)
+with the pipelined `ChatGptCacheManager.read_contexts`, for a growing number of chatrooms.
+Requires the redis configured in `config/.env`.
+
+    python -m benchmarks.context_load --chatrooms 1 10 50 200 --messages 20
+"""
+import argparse
+import asyncio
+from statistics import median
+from time import perf_counter
+
+from orjson import loads as orjson_loads
+from tabulate import tabulate
+
+from database import cache
+from gpt.cache_manager import ChatGptCacheManager
+from gpt.common import MessageHistory, UserGptContext
+
+
+async def read_per_key(user_id: int, chatroom_id: int) -> dict:
+    """Access pattern of reading each field with its own round trip"""
+    stored: dict = {
+        field: await cache.redis.get(key)
+        for field, key in ChatGptCacheManager._get_string_fields(
+            user_id, chatroom_id
+        ).items()
+    }
+    for field, key in ChatGptCacheManager._get_list_fields(
+        user_id, chatroom_id
+    ).items():
+        stored[field] = [orjson_loads(v) for v in await cache.redis.lrange(key, 0, -1)]
+    return stored
+
+
+async def populate(user_id: int, n_chatrooms: int, n_messages: int) -> list[int]:
+    contexts: list[UserGptContext] = []
+    for chatroom_id in range(n_chatrooms):
+        context = UserGptContext.construct_default(
+            user_id=user_id, chatroom_id=chatroom_id
+        )
+        for idx in range(n_messages):
+            context.user_message_histories.append(
+                MessageHistory(
+                    role="user",
+                    content=f"question {idx} " * 20,
+                    tokens=60,
+                    is_user=True,
+                )
+            )
+            context.gpt_message_histories.append(
+                MessageHistory(
+                    role="assistant",
+                    content=f"answer {idx} " * 60,
+                    tokens=180,
+                    is_user=False,
+                )
+            )
+        contexts.append(context)
+    await ChatGptCacheManager.create_contexts(contexts, only_if_not_exists=False)
+    return list(range(n_chatrooms))
+
+
+async def main(args: argparse.Namespace) -> None:
+    cache.start()
+    rows: list[list] = []
+    for n_chatrooms in args.chatrooms:
+        chatroom_ids = await populate(args.user_id, n_chatrooms, args.messages)
+        per_key, pipelined = [], []
+        for _ in range(args.repeat):
+            start = perf_counter()
+            await asyncio.gather(
+                *[read_per_key(args.user_id, id) for id in chatroom_ids]
+            )
+            per_key.append(perf_counter() - start)
+            start = perf_counter()
+            await ChatGptCacheManager.read_contexts(args.user_id, chatroom_ids)
+            pipelined.append(perf_counter() - start)
+        for chatroom_id in chatroom_ids:
+            await ChatGptCacheManager.delete_chatroom(args.user_id, chatroom_id)
+        rows.append(
+            [
+                n_chatrooms,
+                median(per_key) * 1000,
+                median(pipelined) * 1000,
+                median(per_key) / median(pipelined),
+            ]
+        )
+    print(
+        tabulate(
+            rows,
+            headers=["chatrooms", "per-key (ms)", "pipelined (ms)", "speedup"],
+            floatfmt=".2f",
+        )
+    )
+    await cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chatrooms", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--user-id", type=int, default=999_999_999)
+    asyncio.run(main(parser.parse_args()))
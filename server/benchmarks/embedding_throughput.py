@@ -0,0 +1,109 @@
+"""
+Benchmark of throughput of adding documents to the Redis vectorstore with `aadd_texts`,
+for `--configs` of documents per embedding request and requests at once, given as BATCHxCONCURRENCY.
+1x1 is the previous path, embedding documents one by one.
+Runs offline: documents are embedded by `LocalEmbeddings`, delayed by `--latency` seconds
+per request and `--latency-per-document` seconds per document, to model round trips to OpenAI.
+Requires Redis Stack at `--redis-url`; written documents are deleted afterwards.
+
+    python -m benchmarks.embedding_throughput --documents 300 --configs 1x1 32x1 32x4
+"""
+import argparse
+import asyncio
+import random
+from time import perf_counter, sleep
+from typing import List
+from uuid import uuid4
+
+from tabulate import tabulate
+
+from database.dataclasses import EmbeddingConfig
+from database.embeddings import LocalEmbeddings
+from database.redis import Redis
+
+_WORDS: list[str] = (
+    "model token vector chatroom server memory stream document page embedding "
+    "search latency context answer question research paper result method data"
+).split()
+
+
+class LatencyEmbeddings(LocalEmbeddings):
+    """Local embeddings, delayed like requests to a remote embedding API"""
+
+    def __init__(self, dim: int, latency: float, latency_per_document: float):
+        super().__init__(dim=dim)
+        self.latency = latency
+        self.latency_per_document = latency_per_document
+        self.requests: int = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.requests += 1
+        sleep(self.latency + self.latency_per_document * len(texts))
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+async def measure(args: argparse.Namespace, texts: list[str], config: str) -> list:
+    batch_size, max_concurrent_batches = map(int, config.split("x"))
+    embeddings = LatencyEmbeddings(
+        dim=args.dim,
+        latency=args.latency,
+        latency_per_document=args.latency_per_document,
+    )
+    vectorstore = Redis(
+        redis_url=args.redis_url,
+        index_name=f"benchmark_{uuid4().hex}",
+        embedding_function=embeddings.embed_query,
+        is_async=True,
+        embedding=embeddings,
+        embedding_config=EmbeddingConfig(
+            batch_size=batch_size, max_concurrent_batches=max_concurrent_batches
+        ),
+    )
+    try:
+        start: float = perf_counter()
+        ids: list[str] = await vectorstore.aadd_texts(texts)
+        seconds: float = perf_counter() - start
+        await vectorstore.client.delete(*ids)  # type: ignore
+    finally:
+        await vectorstore.client.close()  # type: ignore
+    return [batch_size, max_concurrent_batches, embeddings.requests, seconds]
+
+
+async def main(args: argparse.Namespace) -> None:
+    rng = random.Random(0)
+    texts: list[str] = [
+        " ".join(rng.choices(_WORDS, k=args.words)) for _ in range(args.documents)
+    ]
+    rows: list[list] = []
+    for config in args.configs:
+        rows.append(await measure(args, texts, config))
+    baseline: float = rows[0][-1]
+    print(
+        tabulate(
+            [row + [args.documents / row[-1], baseline / row[-1]] for row in rows],
+            headers=[
+                "batch size",
+                "concurrency",
+                "requests",
+                "seconds",
+                "documents/s",
+                "speedup",
+            ],
+            floatfmt=",.2f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--redis-url", default="redis://localhost:6379/0")
+    parser.add_argument("--documents", type=int, default=300)
+    parser.add_argument("--words", type=int, default=350)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--latency-per-document", type=float, default=0.002)
+    parser.add_argument("--configs", nargs="+", default=["1x1", "32x1", "32x4"])
+    asyncio.run(main(parser.parse_args()))
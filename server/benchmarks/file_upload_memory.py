@@ -0,0 +1,186 @@
+"""
+Benchmark of peak memory of ingesting an uploaded file into documents, before embedding:
+    - whole bytes: previous path, the file as one websocket frame, parsed by unstructured
+        into one text, which is split into documents at once
+    - chunked upload: the file written in chunks to `SpooledUpload`, then parsed from disk
+        a part at a time by `iter_document_batches`
+Each path runs in its own process, reporting growth of its peak RSS over RSS after imports.
+Unless `--file` is given, a PDF of `--size-mb` megabytes is generated, a page of text per 4 KB.
+
+    python -m benchmarks.file_upload_memory --size-mb 100
+    python -m benchmarks.file_upload_memory --file ./some.pdf --paths chunked
+"""
+import argparse
+import hashlib
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import orjson
+from tabulate import tabulate
+
+_PATHS: tuple[str, ...] = ("whole", "chunked")
+_WORDS: list[str] = (
+    "model token vector chatroom server memory stream document page embedding "
+    "search latency context answer question research paper result method data"
+).split()
+
+
+def write_pdf(path: str, size: int, seed: int = 0) -> None:
+    """Write a PDF of about size bytes, with uncompressed pages of text"""
+    rng = random.Random(seed)
+    offsets: list[int] = []
+
+    with open(path, "wb") as f:
+
+        def add_object(body: bytes) -> None:
+            offsets.append(f.tell())
+            f.write(f"{len(offsets)} 0 obj\n".encode() + body + b"\nendobj\n")
+
+        n_pages: int = max(size // 4096, 1)
+        f.write(b"%PDF-1.4\n")
+        add_object(b"<< /Type /Catalog /Pages 2 0 R >>")
+        # each page is an object of page and one of its content, following the font
+        kids: bytes = b" ".join(
+            [f"{4 + 2 * idx} 0 R".encode() for idx in range(n_pages)]
+        )
+        add_object(
+            b"<< /Type /Pages /Kids [" + kids + f"] /Count {n_pages} >>".encode()
+        )
+        add_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        for idx in range(n_pages):
+            add_object(
+                b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                b"/Resources << /Font << /F1 3 0 R >> >> "
+                + f"/Contents {5 + 2 * idx} 0 R >>".encode()
+            )
+            lines: list[bytes] = [
+                f"({' '.join(rng.choices(_WORDS, k=10))}) '".encode() for _ in range(60)
+            ]
+            content: bytes = (
+                b"BT /F1 9 Tf 12 TL 40 760 Td\n" + b"\n".join(lines) + b"\nET"
+            )
+            add_object(
+                f"<< /Length {len(content)} >>\nstream\n".encode()
+                + content
+                + b"\nendstream"
+            )
+        xref_offset: int = f.tell()
+        f.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            f.write(f"{offset:010d} 00000 n \n".encode())
+        f.write(
+            f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\n"
+            f"startxref\n{xref_offset}\n%%EOF\n".encode()
+        )
+
+
+def _rss_kib() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def run_whole(path: str) -> int:
+    from langchain.text_splitter import TokenTextSplitter
+
+    from gpt.fileloader import read_bytes_to_text
+
+    with open(path, "rb") as f:
+        file: bytes = f.read()  # one websocket frame
+    text: str = read_bytes_to_text(file, os.path.basename(path))
+    return len(
+        TokenTextSplitter(
+            chunk_size=500, chunk_overlap=0, encoding_name="cl100k_base"
+        ).split_text(text)
+    )
+
+
+def run_chunked(path: str, chunk_size: int = 1 << 16) -> int:
+    from gpt.fileloader import SpooledUpload, iter_document_batches
+
+    upload = SpooledUpload(filename=os.path.basename(path), size=os.path.getsize(path))
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):  # websocket frames
+            checksum.update(chunk)
+            upload.write(chunk)
+    upload.finish(sha256_hex=checksum.hexdigest())
+    n_documents: int = 0
+    for batch in iter_document_batches(file=upload.file, filename=upload.filename):
+        n_documents += len(batch)  # embedded here, a batch at a time
+    upload.close()
+    return n_documents
+
+
+def child(path: str, ingest_path: str) -> None:
+    # imported before measuring, so only memory of ingesting is measured
+    import gpt.fileloader  # noqa: F401
+
+    baseline: int = _rss_kib()
+    start: float = perf_counter()
+    n_documents: int = (run_whole if ingest_path == "whole" else run_chunked)(path)
+    peak: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sys.stdout.buffer.write(
+        orjson.dumps(
+            {
+                "documents": n_documents,
+                "seconds": perf_counter() - start,
+                "peak_growth_kib": max(peak - baseline, 0),
+            }
+        )
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path: str = args.file or os.path.join(directory, "upload.pdf")
+        if args.file is None:
+            write_pdf(path, args.size_mb << 20)
+        rows: list[list] = []
+        for ingest_path in args.paths:
+            completed = subprocess.run(
+                [sys.executable, "-m", "benchmarks.file_upload_memory"]
+                + ["--child", ingest_path, "--file", path],
+                capture_output=True,
+                check=True,
+            )
+            result: dict = orjson.loads(completed.stdout)
+            rows.append(
+                [
+                    ingest_path,
+                    os.path.getsize(path) / (1 << 20),
+                    result["documents"],
+                    result["seconds"],
+                    result["peak_growth_kib"] / 1024,
+                ]
+            )
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "path",
+                "file (MB)",
+                "documents",
+                "seconds",
+                "peak RSS growth (MB)",
+            ],
+            floatfmt=",.1f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=int, default=100)
+    parser.add_argument("--file", help="file to ingest instead of a generated PDF")
+    parser.add_argument("--paths", nargs="+", choices=_PATHS, default=list(_PATHS))
+    parser.add_argument("--child", choices=_PATHS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.file, args.child)
+    else:
+        main(args)
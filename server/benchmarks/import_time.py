@@ -0,0 +1,108 @@
+"""
+Benchmark of import time of the server entry point `main:app`, measured by `python -X importtime`.
+Each run imports `main` in a fresh interpreter, so nothing is cached in `sys.modules`.
+Reports the median total, without interpreter startup, and the modules taking longest
+to import, including their own imports.
+With `--save`, the result is written to a json file; with `--baseline`, it is compared with
+a saved result, exiting with 1 if the total grew by more than `--tolerance`.
+
+    python -m benchmarks.import_time --runs 5 --top 15 --save import_time.json
+    python -m benchmarks.import_time --baseline import_time.json --tolerance 0.2
+"""
+import argparse
+import subprocess
+import sys
+from statistics import median
+
+import orjson
+from tabulate import tabulate
+
+
+def measure(statement: str) -> list[tuple[str, int, int]]:
+    """Name, nesting depth and cumulative import time in microseconds of modules imported by statement"""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"running {statement} failed:\n{completed.stderr}")
+    modules: list[tuple[str, int, int]] = []
+    for line in completed.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative_us, name = line.removeprefix("import time:").split("|")
+        modules.append(
+            (name.strip(), len(name) - len(name.lstrip()), int(cumulative_us))
+        )
+    return modules
+
+
+def measure_entry_point(entry_point: str) -> tuple[int, dict[str, int]]:
+    """
+    Total import time of entry point, leaving out modules imported by the interpreter at startup,
+    and cumulative import time of each module
+    """
+    module, _, attribute = entry_point.partition(":")
+    startup: set[str] = {name for name, _, _ in measure("pass")}
+    modules: list[tuple[str, int, int]] = measure(
+        f"import {module}" + (f"; {module}.{attribute}" if attribute else "")
+    )
+    return (
+        sum([us for name, depth, us in modules if depth == 1 and name not in startup]),
+        {name: us for name, _, us in modules if name not in startup},
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    runs: list[tuple[int, dict[str, int]]] = [
+        measure_entry_point(args.entry_point) for _ in range(args.runs)
+    ]
+    total: float = median([run_total for run_total, _ in runs])
+    modules: dict[str, float] = {
+        name: median([run_modules.get(name, 0) for _, run_modules in runs])
+        for name in runs[0][1]
+    }
+    top: list[tuple[str, float]] = sorted(
+        modules.items(), key=lambda item: item[1], reverse=True
+    )[: args.top]
+    print(
+        tabulate(
+            [["<total>", total / 1000]] + [[name, us / 1000] for name, us in top],
+            headers=["module", "cumulative (ms)"],
+            floatfmt=",.1f",
+        )
+    )
+    if args.save:
+        with open(args.save, "wb") as f:
+            f.write(
+                orjson.dumps(
+                    {
+                        "entry_point": args.entry_point,
+                        "total_us": total,
+                        "modules_us": dict(top),
+                    },
+                    option=orjson.OPT_INDENT_2,
+                )
+            )
+    if args.baseline:
+        with open(args.baseline, "rb") as f:
+            baseline: dict = orjson.loads(f.read())
+        ratio: float = total / baseline["total_us"]
+        print(
+            f"\n{baseline['total_us'] / 1000:,.1f} ms -> {total / 1000:,.1f} ms ({ratio - 1:+.1%})"
+        )
+        if ratio > 1 + args.tolerance:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entry-point", default="main:app")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--save", help="json file to write the result to")
+    parser.add_argument("--baseline", help="json file of a saved result to compare")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    main(parser.parse_args())
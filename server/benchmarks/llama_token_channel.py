@@ -0,0 +1,130 @@
+"""
+Benchmark of channels carrying generated tokens from a llama worker process to the event loop:
+    - manager queue: previous `Manager().Queue()`, read with a blocking get in a thread per token
+    - shared memory ring: `gpt/token_ring.py`, read by the event loop when the pipe wakes it up
+A producer process sends tokens as fast as it can, to measure tokens per second,
+then paced by `--interval`, to measure per-token latency like a model generating tokens.
+Timestamps use the monotonic clock, which is shared by processes on linux.
+
+    python -m benchmarks.llama_token_channel --tokens 20000 --paced-tokens 500 --interval 1
+"""
+import argparse
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median, quantiles
+from time import perf_counter_ns, sleep
+
+from tabulate import tabulate
+
+from gpt.token_ring import TokenRingReader, TokenRingWriter
+
+
+def produce(send, n_tokens: int, interval: float) -> None:
+    for idx in range(n_tokens):
+        if interval:
+            sleep(interval)
+        send((perf_counter_ns(), f" token{idx}"))
+    send(None)
+
+
+def produce_to_queue(m_queue, n_tokens: int, interval: float) -> None:
+    produce(m_queue.put, n_tokens, interval)
+
+
+def produce_to_ring(writer_args: tuple, n_tokens: int, interval: float) -> None:
+    writer = TokenRingWriter(*writer_args)
+    produce(writer.send, n_tokens, interval)
+    writer.close()
+
+
+async def consume_queue(
+    context: multiprocessing.context.BaseContext, n_tokens: int, interval: float
+) -> list[tuple[int, int]]:
+    """Previous behaviour of generate_from_llama_cpp"""
+    manager = context.Manager()
+    m_queue = manager.Queue()
+    process = context.Process(
+        target=produce_to_queue, args=(m_queue, n_tokens, interval)
+    )
+    process.start()
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+    received: list[tuple[int, int]] = []
+    while True:
+        token = await loop.run_in_executor(executor, m_queue.get)
+        if token is None:
+            break
+        received.append((token[0], perf_counter_ns()))
+    process.join()
+    executor.shutdown()
+    manager.shutdown()
+    return received
+
+
+async def consume_ring(
+    context: multiprocessing.context.BaseContext, n_tokens: int, interval: float
+) -> list[tuple[int, int]]:
+    reader = TokenRingReader(capacity=1 << 20, context=context, send_timeout=30.0)
+    process = context.Process(
+        target=produce_to_ring, args=(reader.writer_args, n_tokens, interval)
+    )
+    process.start()
+    reader.close_writer()
+    loop = asyncio.get_running_loop()
+    done: asyncio.Future = loop.create_future()
+    received: list[tuple[int, int]] = []
+
+    def on_messages(tokens: list) -> None:
+        now: int = perf_counter_ns()
+        for token in tokens:
+            if token is None:
+                done.set_result(None)
+            else:
+                received.append((token[0], now))
+
+    reader.attach(loop=loop, on_messages=on_messages, on_closed=lambda: None)
+    await done
+    process.join()
+    reader.close()
+    return received
+
+
+async def main(args: argparse.Namespace) -> None:
+    context = multiprocessing.get_context("spawn")
+    rows: list[list] = []
+    for name, consume in (
+        ("manager queue", consume_queue),
+        ("shared memory ring", consume_ring),
+    ):
+        burst = await consume(context, args.tokens, 0.0)
+        paced = await consume(context, args.paced_tokens, args.interval / 1000)
+        latencies: list[float] = [(end - start) / 1000 for start, end in paced]
+        rows.append(
+            [
+                name,
+                len(burst) / ((burst[-1][1] - burst[0][0]) / 1e9),
+                median(latencies),
+                quantiles(latencies, n=100)[98],
+            ]
+        )
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "channel",
+                "tokens/s",
+                "latency p50 (us)",
+                "latency p99 (us)",
+            ],
+            floatfmt=",.1f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--paced-tokens", type=int, default=500)
+    parser.add_argument("--interval", type=float, default=1.0, help="milliseconds")
+    asyncio.run(main(parser.parse_args()))
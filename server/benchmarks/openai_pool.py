@@ -0,0 +1,138 @@
+"""
+Benchmark for time to first token of streamed completions, with and without a pooled http client.
+A local fake SSE server streams chat completion chunks like the OpenAI api does.
+Opening a connection is slowed down by `--connect-delay`, to stand in for TCP and TLS handshakes
+to a remote host, which localhost doesn't have.
+
+    python -m benchmarks.openai_pool --requests 50 --concurrency 1 8 --connect-delay 50
+"""
+import argparse
+import asyncio
+from statistics import median, quantiles
+from time import perf_counter
+
+import httpx
+import orjson
+from tabulate import tabulate
+
+from database.dataclasses import HttpClientConfig
+from gpt.http_client import HttpClientPool
+
+
+async def serve_sse(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    connect_delay: float,
+    n_chunks: int,
+) -> None:
+    """Serve keep-alive requests of a single connection, each with a chunked SSE response"""
+    await asyncio.sleep(connect_delay)
+    try:
+        while True:
+            head: bytes = await reader.readuntil(b"\r\n\r\n")
+            content_length: int = 0
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    content_length = int(line.split(b":")[1])
+            await reader.readexactly(content_length)
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream\r\n"
+                b"Transfer-Encoding: chunked\r\n\r\n"
+            )
+            for idx in range(n_chunks):
+                event: bytes = (
+                    b"data: "
+                    + orjson.dumps(
+                        {"choices": [{"delta": {"content": f"token{idx} "}}]}
+                    )
+                    + b"\n\n"
+                )
+                writer.write(b"%x\r\n%s\r\n" % (len(event), event))
+                await writer.drain()
+            writer.write(b"e\r\ndata: [DONE]\n\n\r\n0\r\n\r\n")
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def time_to_first_token(client: httpx.AsyncClient, url: str) -> float:
+    start = perf_counter()
+    ttft: float = 0.0
+    async with client.stream("POST", url, json={"stream": True}) as response:
+        async for chunk in response.aiter_text():
+            if not ttft and "content" in chunk:
+                ttft = perf_counter() - start
+    return ttft
+
+
+async def run(
+    url: str, n_requests: int, concurrency: int, pool: HttpClientPool | None
+) -> list[float]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one() -> float:
+        async with semaphore:
+            if pool is not None:
+                return await time_to_first_token(pool.client, url)
+            # previous behaviour: a new client, and so a new connection, per generation
+            async with httpx.AsyncClient() as client:
+                return await time_to_first_token(client, url)
+
+    return await asyncio.gather(*[one() for _ in range(n_requests)])
+
+
+async def main(args: argparse.Namespace) -> None:
+    server = await asyncio.start_server(
+        lambda r, w: serve_sse(r, w, args.connect_delay / 1000, args.chunks),
+        host="127.0.0.1",
+        port=args.port,
+    )
+    url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/v1/chat/completions"
+    rows: list[list] = []
+    for concurrency in args.concurrency:
+        for pooled in (False, True):
+            pool = HttpClientPool(HttpClientConfig(http2=False)) if pooled else None
+            ttfts = await run(url, args.requests, concurrency, pool)
+            connections: int | str = "-"
+            if pool is not None:
+                connections = sum(
+                    [stats["connections"] for stats in pool.stats.values()]
+                )
+                await pool.close()
+            rows.append(
+                [
+                    concurrency,
+                    "pooled" if pooled else "per request",
+                    median(ttfts) * 1000,
+                    quantiles(ttfts, n=20)[-1] * 1000,
+                    connections if pooled else args.requests,
+                ]
+            )
+    server.close()
+    await server.wait_closed()
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "concurrency",
+                "client",
+                "TTFT p50 (ms)",
+                "TTFT p95 (ms)",
+                "connections",
+            ],
+            floatfmt=".2f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--connect-delay", type=float, default=50.0)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--port", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
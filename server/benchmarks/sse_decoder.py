@@ -0,0 +1,161 @@
+"""
+Fuzz check and micro-benchmark of the incremental SSE decoder in `gpt/sse.py`.
+The fuzz check splits streams at random positions, including inside multi-byte characters
+and between "\\r" and "\\n", and asserts the decoded events never change.
+The benchmark compares it with the previous regex over a growing text buffer,
+on a 4k-token completion stream delivered in chunks of different sizes.
+
+    python -m benchmarks.sse_decoder --fuzz 2000 --tokens 4096 --chunk-sizes 16 256 4096
+"""
+import argparse
+import random
+import re
+from statistics import median
+from time import perf_counter
+
+import orjson
+from tabulate import tabulate
+
+from gpt.sse import SSEDecoder
+
+# previous pattern of ChatGPTConfig, applied to text decoded from the stream
+REGEX_PATTERN: re.Pattern = re.compile(r"data:\s*({.+?})\n\n")
+
+
+def completion_stream(n_tokens: int) -> bytes:
+    """Stream of a chat completion, as the OpenAI api sends it"""
+    events: list[bytes] = [
+        b"data: "
+        + orjson.dumps(
+            {
+                "id": "chatcmpl-0",
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"content": f" token{idx}"}}],
+            }
+        )
+        + b"\n\n"
+        for idx in range(n_tokens)
+    ]
+    return b"".join(events) + b"data: [DONE]\n\n"
+
+
+def tricky_stream(rng: random.Random) -> bytes:
+    """Stream mixing line endings, comments, multi-line data and multi-byte characters"""
+    parts: list[bytes] = []
+    for idx in range(rng.randint(1, 30)):
+        line_end: bytes = rng.choice([b"\n", b"\r\n", b"\r"])
+        if rng.random() < 0.2:
+            parts.append(b": keep-alive" + line_end)
+        for line in range(rng.randint(1, 3)):
+            content: str = rng.choice(["ascii", "한국어", "émoji 🚀", ""]) + str(idx)
+            parts.append(
+                b"data:" + rng.choice([b" ", b""]) + content.encode() + line_end
+            )
+        parts.append(line_end)
+    return b"".join(parts)
+
+
+def split_randomly(stream: bytes, rng: random.Random) -> list[bytes]:
+    cuts: list[int] = sorted(
+        rng.sample(range(1, len(stream)), k=min(len(stream) - 1, rng.randint(0, 40)))
+    )
+    return [stream[start:end] for start, end in zip([0, *cuts], [*cuts, len(stream)])]
+
+
+def decode(chunks: list[bytes]) -> list[str]:
+    decoder = SSEDecoder()
+    events: list[str] = []
+    for chunk in chunks:
+        events += decoder.feed(chunk)
+    return events + decoder.flush()
+
+
+def fuzz(iterations: int, seed: int) -> None:
+    rng = random.Random(seed)
+    for _ in range(iterations):
+        stream: bytes = rng.choice([tricky_stream(rng), completion_stream(5)])
+        expected: list[str] = decode([stream])
+        assert decode(split_randomly(stream, rng)) == expected
+        assert decode([bytes([byte]) for byte in stream]) == expected
+    print(f"fuzz: {iterations} streams decoded identically at random chunk boundaries")
+
+
+def regex_over_buffer(chunks: list[bytes]) -> int:
+    """
+    Previous behaviour of generate_from_openai.
+    The buffer is sliced with offsets of matches found in the buffer before slicing,
+    so it may drop events when a chunk completes more than one of them.
+    """
+    n_events: int = 0
+    stream_buffer: str = ""
+    for chunk in chunks:
+        stream_buffer += chunk.decode("utf-8")
+        for match in REGEX_PATTERN.finditer(stream_buffer):
+            orjson.loads(match.group(1))
+            n_events += 1
+            stream_buffer = stream_buffer[match.end() :]
+    return n_events
+
+
+def incremental(chunks: list[bytes]) -> int:
+    decoder = SSEDecoder()
+    n_events: int = 0
+    for chunk in chunks:
+        for data in decoder.feed(chunk):
+            if data != decoder.done_data:
+                orjson.loads(data)
+                n_events += 1
+    return n_events
+
+
+def main(args: argparse.Namespace) -> None:
+    fuzz(args.fuzz, args.seed)
+    stream: bytes = completion_stream(args.tokens)
+    rows: list[list] = []
+    for chunk_size in args.chunk_sizes:
+        chunks: list[bytes] = [
+            stream[idx : idx + chunk_size] for idx in range(0, len(stream), chunk_size)
+        ]
+        timings: dict[str, list[float]] = {"regex": [], "incremental": []}
+        regex_events: int = 0
+        for _ in range(args.repeat):
+            start = perf_counter()
+            regex_events = regex_over_buffer(chunks)
+            timings["regex"].append(perf_counter() - start)
+            start = perf_counter()
+            assert incremental(chunks) == args.tokens
+            timings["incremental"].append(perf_counter() - start)
+        rows.append(
+            [
+                chunk_size,
+                len(chunks),
+                f"{regex_events}/{args.tokens}",
+                median(timings["regex"]) * 1000,
+                median(timings["incremental"]) * 1000,
+                median(timings["regex"]) / median(timings["incremental"]),
+            ]
+        )
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "chunk size",
+                "chunks",
+                "regex events",
+                "regex (ms)",
+                "incremental (ms)",
+                "speedup",
+            ],
+            floatfmt=".2f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--fuzz", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tokens", type=int, default=4096)
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[16, 256, 4096])
+    parser.add_argument("--repeat", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,121 @@
+"""
+Benchmark for time to first frame on websocket connect.
+Compares eagerly loading every chatroom and sending the whole current history,
+with loading context stubs, the selected chatroom only, and a window of its history.
+The context cache is cleared before every connect, as on a cold worker.
+Requires the redis configured in `config/.env`.
+
+    python -m benchmarks.time_to_first_frame --chatrooms 1 10 50 200 --messages 100
+"""
+import argparse
+import asyncio
+from statistics import median
+from time import perf_counter
+
+from tabulate import tabulate
+
+from benchmarks.context_load import populate
+from database import cache
+from database.schemas import InitMessage
+from gpt.buffer import BufferedUserContext
+from gpt.cache_manager import ChatGptCacheManager
+from gpt.commands import get_context_stubs_sorted_from_recent_to_past
+from gpt.context_cache import context_cache
+from gpt.generation import message_history_organizer
+from gpt.websocket_manager import SendToWebsocket
+
+
+async def eager_first_frame(user_id: int, chatroom_ids: list[int]) -> str:
+    """Previous behaviour: every history is decoded, and the whole current one is sent"""
+    contexts = await ChatGptCacheManager.read_contexts(user_id, chatroom_ids)
+    contexts.sort(key=lambda x: x.user_gpt_profile.created_at, reverse=True)
+    buffer = BufferedUserContext(
+        user_id=user_id,
+        initial_chatroom_id=contexts[0].chatroom_id,
+        websocket=None,
+        sorted_contexts=contexts,  # type: ignore
+    )
+    return InitMessage(
+        chatroom_ids=buffer.sorted_chatroom_ids,
+        previous_chats=message_history_organizer(  # type: ignore
+            user_gpt_context=buffer.current_user_gpt_context, send_to_stream=False
+        ),
+    ).json()
+
+
+async def lazy_first_frame(user_id: int, chatroom_ids: list[int]) -> str:
+    stubs = await get_context_stubs_sorted_from_recent_to_past(user_id, chatroom_ids)
+    stubs[0] = await ChatGptCacheManager.read_context(  # type: ignore
+        user_id, stubs[0].chatroom_id
+    )
+    buffer = BufferedUserContext(
+        user_id=user_id,
+        initial_chatroom_id=stubs[0].chatroom_id,
+        websocket=None,
+        sorted_contexts=stubs,
+    )
+    n_turns: int = len(buffer.current_user_gpt_context.user_message_histories)
+    offset: int = max(n_turns - SendToWebsocket.previous_chats_window, 0)
+    return InitMessage(
+        chatroom_ids=buffer.sorted_chatroom_ids,
+        previous_chats=message_history_organizer(  # type: ignore
+            user_gpt_context=buffer.current_user_gpt_context,
+            send_to_stream=False,
+            turns=slice(offset, None),
+        ),
+        previous_chats_offset=offset,
+    ).json()
+
+
+async def main(args: argparse.Namespace) -> None:
+    cache.start()
+    rows: list[list] = []
+    for n_chatrooms in args.chatrooms:
+        chatroom_ids = await populate(args.user_id, n_chatrooms, args.messages)
+        eager, lazy = [], []
+        eager_size = lazy_size = 0
+        for _ in range(args.repeat):
+            context_cache.clear()
+            start = perf_counter()
+            eager_size = len(await eager_first_frame(args.user_id, chatroom_ids))
+            eager.append(perf_counter() - start)
+            context_cache.clear()
+            start = perf_counter()
+            lazy_size = len(await lazy_first_frame(args.user_id, chatroom_ids))
+            lazy.append(perf_counter() - start)
+        for chatroom_id in chatroom_ids:
+            await ChatGptCacheManager.delete_chatroom(args.user_id, chatroom_id)
+        rows.append(
+            [
+                n_chatrooms,
+                median(eager) * 1000,
+                median(lazy) * 1000,
+                median(eager) / median(lazy),
+                eager_size / 1024,
+                lazy_size / 1024,
+            ]
+        )
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "chatrooms",
+                "eager (ms)",
+                "lazy (ms)",
+                "speedup",
+                "eager frame (KiB)",
+                "lazy frame (KiB)",
+            ],
+            floatfmt=".2f",
+        )
+    )
+    await cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chatrooms", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--user-id", type=int, default=999_999_999)
+    asyncio.run(main(parser.parse_args()))
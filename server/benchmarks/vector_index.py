@@ -0,0 +1,200 @@
+"""
+Benchmark of recall and latency of KNN search by a FLAT index and by HNSW indexes,
+over synthetic clustered vectors, searched one query at a time.
+Recall@k is measured against exact nearest neighbors computed with numpy.
+HNSW is searched with each of `--ef-runtimes`, given to queries as EF_RUNTIME.
+Vectors are tagged by one of `--users` users, and searches are repeated pre-filtered
+to the vectors of one user, as /query does, against exact neighbors among them.
+Requires Redis Stack at `--redis-url`; written vectors and indexes are deleted afterwards.
+
+    python -m benchmarks.vector_index --vectors 100000 --dim 256 --ef-runtimes 10 50 200 --users 10
+"""
+import argparse
+from time import perf_counter, sleep
+from uuid import uuid4
+
+import numpy as np
+import redis
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+from tabulate import tabulate
+
+from database.dataclasses import VectorIndexConfig
+from database.redis import _redis_vectorstore_schema
+
+
+def synthetic_vectors(
+    rng: np.random.Generator, n: int, dim: int, centers: np.ndarray
+) -> np.ndarray:
+    """Unit vectors scattered around random centers, like embeddings of topics"""
+    vectors = centers[rng.integers(len(centers), size=n)] + 0.5 * rng.normal(
+        size=(n, dim)
+    )
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def build_index(
+    client: redis.Redis, name: str, prefix: str, dim: int, config: VectorIndexConfig
+) -> float:
+    start: float = perf_counter()
+    client.ft(name).create_index(
+        fields=_redis_vectorstore_schema(
+            content_key="content",
+            metadata_key="metadata",
+            vector_key="content_vector",
+            dim=dim,
+            index_config=config,
+        ),
+        definition=IndexDefinition(prefix=[prefix], index_type=IndexType.HASH),
+    )
+    while int(client.ft(name).info()["indexing"]):
+        sleep(0.05)
+    return perf_counter() - start
+
+
+def search(
+    client: redis.Redis,
+    name: str,
+    queries: np.ndarray,
+    k: int,
+    ef_runtime: int | None,
+    filter_query: str = "*",
+) -> tuple[list[list[int]], list[float]]:
+    ef: str = " EF_RUNTIME $ef" if ef_runtime is not None else ""
+    query = (
+        Query(f"{filter_query}=>[KNN {k} @content_vector $vector{ef} AS vector_score]")
+        .return_fields("vector_score")
+        .sort_by("vector_score")
+        .paging(0, k)
+        .dialect(2)
+    )
+    found: list[list[int]] = []
+    latencies: list[float] = []
+    for vector in queries:
+        params: dict = {"vector": vector.tobytes()}
+        if ef_runtime is not None:
+            params["ef"] = ef_runtime
+        start: float = perf_counter()
+        results = client.ft(name).search(query, params)  # type: ignore
+        latencies.append(perf_counter() - start)
+        found.append([int(doc.id.rsplit(":", 1)[1]) for doc in results.docs])
+    return found, latencies
+
+
+def main(args: argparse.Namespace) -> None:
+    rng = np.random.default_rng(0)
+    centers: np.ndarray = rng.normal(size=(args.clusters, args.dim))
+    vectors: np.ndarray = synthetic_vectors(rng, args.vectors, args.dim, centers)
+    queries: np.ndarray = synthetic_vectors(rng, args.queries, args.dim, centers)
+    # exact nearest neighbors by cosine similarity of unit vectors
+    similarities: np.ndarray = queries @ vectors.T
+    truth: list[set[int]] = [
+        set(neighbors) for neighbors in np.argsort(-similarities, axis=1)[:, : args.k]
+    ]
+    # exact nearest neighbors among vectors of user 0
+    user_ids: np.ndarray = np.flatnonzero(np.arange(args.vectors) % args.users == 0)
+    user_truth: list[set[int]] = [
+        set(user_ids[neighbors])
+        for neighbors in np.argsort(-similarities[:, user_ids], axis=1)[:, : args.k]
+    ]
+    filters: list[tuple[str, list[set[int]]]] = [("*", truth)]
+    if args.users > 1:
+        filters.append(("@user_id:{0}", user_truth))
+
+    client = redis.Redis.from_url(args.redis_url)
+    run_id: str = uuid4().hex[:8]
+    prefix: str = f"doc:benchmark_{run_id}"
+    keys: list[str] = [f"{prefix}:{idx}" for idx in range(args.vectors)]
+    pipeline = client.pipeline(transaction=False)
+    for idx, (key, vector) in enumerate(zip(keys, vectors)):
+        pipeline.hset(
+            key,
+            mapping={
+                "content_vector": vector.tobytes(),
+                "user_id": str(idx % args.users),
+            },
+        )
+        if len(pipeline) >= 1000:
+            pipeline.execute()
+    pipeline.execute()
+
+    configs: list[tuple[VectorIndexConfig, list[int | None]]] = [
+        (VectorIndexConfig(algorithm="FLAT", initial_cap=args.vectors), [None]),
+        (
+            VectorIndexConfig(
+                algorithm="HNSW",
+                m=args.m,
+                ef_construction=args.ef_construction,
+                initial_cap=args.vectors,
+            ),
+            args.ef_runtimes,
+        ),
+    ]
+    rows: list[list] = []
+    try:
+        for config, ef_runtimes in configs:
+            name: str = f"benchmark_{run_id}_{config.algorithm.lower()}"
+            build_seconds: float = build_index(client, name, prefix, args.dim, config)
+            try:
+                for ef_runtime in ef_runtimes:
+                    for filter_query, expected in filters:
+                        found, latencies = search(
+                            client, name, queries, args.k, ef_runtime, filter_query
+                        )
+                        recall: float = float(
+                            np.mean(
+                                [
+                                    len(expected[idx] & set(ids)) / args.k
+                                    for idx, ids in enumerate(found)
+                                ]
+                            )
+                        )
+                        rows.append(
+                            [
+                                config.algorithm,
+                                ef_runtime or "-",
+                                filter_query,
+                                build_seconds,
+                                recall,
+                                np.percentile(latencies, 50) * 1000,
+                                np.percentile(latencies, 99) * 1000,
+                                len(latencies) / sum(latencies),
+                            ]
+                        )
+            finally:
+                client.ft(name).dropindex(delete_documents=False)
+    finally:
+        for start in range(0, len(keys), 1000):
+            client.delete(*keys[start : start + 1000])
+        client.close()
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "algorithm",
+                "ef_runtime",
+                "filter",
+                "build (s)",
+                f"recall@{args.k}",
+                "p50 (ms)",
+                "p99 (ms)",
+                "queries/s",
+            ],
+            floatfmt=",.3f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--redis-url", default="redis://localhost:6379/0")
+    parser.add_argument("--vectors", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--m", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef-runtimes", type=int, nargs="+", default=[10, 50, 200])
+    main(parser.parse_args())
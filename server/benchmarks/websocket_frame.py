@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of encoding a streamed frame, in frames per second of CPU time of one core:
+    - pydantic + json: previous path, `MessageToWebsocket(...).dict()` then `send_json`'s `json.dumps`
+    - pydantic + orjson: the same model, encoded with orjson
+    - template: `MessageToWebsocketFrame`, encoding only msg between pre-encoded fields
+Each is run for deltas of `--sizes` characters, the same delta for every frame.
+
+    python -m benchmarks.websocket_frame --frames 100000 --sizes 4 64 512
+"""
+import argparse
+import json
+from time import process_time
+from typing import Callable
+
+import orjson
+from tabulate import tabulate
+
+from database.schemas import MessageToWebsocket, MessageToWebsocketFrame
+
+
+def pydantic_json(msg: str) -> str:
+    return json.dumps(
+        MessageToWebsocket(
+            msg=msg, finish=False, chatroom_id=1, is_user=False, model_name="gpt-4"
+        ).dict(),
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+
+
+def pydantic_orjson(msg: str) -> str:
+    return orjson.dumps(
+        MessageToWebsocket(
+            msg=msg, finish=False, chatroom_id=1, is_user=False, model_name="gpt-4"
+        ).dict()
+    ).decode("utf-8")
+
+
+def measure(encode: Callable[[str], str], msg: str, n_frames: int) -> float:
+    start: float = process_time()
+    for _ in range(n_frames):
+        encode(msg)
+    return n_frames / (process_time() - start)
+
+
+def main(args: argparse.Namespace) -> None:
+    frame = MessageToWebsocketFrame(chatroom_id=1, is_user=False, model_name="gpt-4")
+    encoders: dict[str, Callable[[str], str]] = {
+        "pydantic + json": pydantic_json,
+        "pydantic + orjson": pydantic_orjson,
+        "template": frame.text,
+    }
+    rows: list[list] = []
+    for size in args.sizes:
+        msg: str = ("tok " * size)[:size]
+        assert (
+            len({orjson.loads(encode(msg))["msg"] for encode in encoders.values()}) == 1
+        )
+        baseline: float | None = None
+        for name, encode in encoders.items():
+            frames_per_second: float = measure(encode, msg, args.frames)
+            baseline = baseline or frames_per_second
+            rows.append([size, name, frames_per_second, frames_per_second / baseline])
+    print(
+        tabulate(
+            rows,
+            headers=["delta chars", "encoder", "frames/s per core", "speedup"],
+            floatfmt=",.1f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=100000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[4, 64, 512])
+    main(parser.parse_args())
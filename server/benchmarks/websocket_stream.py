@@ -0,0 +1,180 @@
+"""
+Benchmark of sending a stream of deltas to a websocket:
+    - per chunk: previous `SendToWebsocket.stream`, a pydantic frame every `--chunk-size` deltas
+    - coalesced: `SendToWebsocket.stream` with `CoalescingSender`, frames by time window and bytes
+The websocket is a fake one, buffering sent bytes up to a high-water mark like a transport,
+drained at `--client-rates` bytes per second, to compare a fast client with slow ones.
+Deltas arrive as fast as possible, then paced by `--interval` like a model generating tokens.
+
+    python -m benchmarks.websocket_stream --tokens 5000 --client-rates 0 20000 --interval 1
+"""
+import argparse
+import asyncio
+import json
+from time import perf_counter, process_time
+from types import SimpleNamespace
+from typing import AsyncIterator
+
+from tabulate import tabulate
+
+from database.dataclasses import WebsocketStreamConfig
+from database.schemas import MessageToWebsocket
+from gpt.websocket_manager import SendToWebsocket
+
+
+class FakeWebSocket:
+    """Buffers sent bytes, waiting while they are above `high_water` until drained to `low_water`"""
+
+    client_state = SimpleNamespace(value=1)
+
+    def __init__(self, bytes_per_second: float, high_water: int = 1 << 16):
+        self.bytes_per_second = bytes_per_second
+        self.high_water = high_water
+        self.low_water = high_water // 4
+        self.frames: int = 0
+        self.buffered: float = 0
+        self.peak_buffered: float = 0
+        self._drained_at: float = perf_counter()
+
+    async def send_text(self, data: str) -> None:
+        self._drain()
+        self.buffered += len(data.encode("utf-8"))
+        self.peak_buffered = max(self.peak_buffered, self.buffered)
+        self.frames += 1
+        if self.bytes_per_second and self.buffered > self.high_water:
+            await asyncio.sleep(
+                (self.buffered - self.low_water) / self.bytes_per_second
+            )
+            self._drain()
+
+    async def send_json(self, data: dict) -> None:
+        await self.send_text(json.dumps(data, separators=(",", ":")))
+
+    def _drain(self) -> None:
+        now: float = perf_counter()
+        if not self.bytes_per_second:
+            self.buffered = 0
+        else:
+            self.buffered = max(
+                self.buffered - (now - self._drained_at) * self.bytes_per_second, 0
+            )
+        self._drained_at = now
+
+
+async def deltas(n_tokens: int, interval: float) -> AsyncIterator[str]:
+    for idx in range(n_tokens):
+        if interval:
+            await asyncio.sleep(interval)
+        yield f" token{idx}"
+
+
+async def stream_per_chunk(buffer, stream: AsyncIterator[str], chunk_size: int) -> str:
+    """Previous behaviour of `SendToWebsocket.stream`"""
+    final_response, stream_buffer = "", ""
+    iteration: int = 0
+    await buffer.websocket.send_json(
+        MessageToWebsocket(
+            msg=None,
+            finish=False,
+            chatroom_id=buffer.current_chatroom_id,
+            is_user=False,
+        ).dict()
+    )
+    async for delta in stream:
+        stream_buffer += delta
+        iteration += 1
+        if iteration % chunk_size == 0:
+            final_response += stream_buffer
+            await buffer.websocket.send_json(
+                MessageToWebsocket(
+                    msg=stream_buffer,
+                    finish=False,
+                    chatroom_id=buffer.current_chatroom_id,
+                    is_user=False,
+                ).dict()
+            )
+            stream_buffer = ""
+    await buffer.websocket.send_json(
+        MessageToWebsocket(
+            msg=stream_buffer,
+            finish=True,
+            chatroom_id=buffer.current_chatroom_id,
+            is_user=False,
+        ).dict()
+    )
+    return final_response
+
+
+async def measure(
+    name: str, args: argparse.Namespace, bytes_per_second: float, interval: float
+) -> list:
+    websocket = FakeWebSocket(bytes_per_second)
+    buffer = SimpleNamespace(
+        websocket=websocket, done=asyncio.Event(), current_chatroom_id=0
+    )
+    n_tokens: int = args.paced_tokens if interval else args.tokens
+    start, cpu_start = perf_counter(), process_time()
+    if name == "per chunk":
+        await stream_per_chunk(buffer, deltas(n_tokens, interval), args.chunk_size)
+    else:
+        await SendToWebsocket.stream(
+            buffer=buffer,  # type: ignore
+            stream=deltas(n_tokens, interval),
+            config=WebsocketStreamConfig(
+                flush_interval=args.flush_interval / 1000,
+                flush_bytes=args.flush_bytes,
+            ),
+        )
+    elapsed, cpu = perf_counter() - start, process_time() - cpu_start
+    return [
+        name,
+        bytes_per_second or "unlimited",
+        f"{interval * 1000:g} ms" if interval else "burst",
+        websocket.frames,
+        websocket.frames / elapsed,
+        cpu / n_tokens * 1e6,
+        websocket.peak_buffered / 1024,
+    ]
+
+
+async def main(args: argparse.Namespace) -> None:
+    rows: list[list] = []
+    for bytes_per_second in args.client_rates:
+        for interval in (0.0, args.interval / 1000):
+            for name in ("per chunk", "coalesced"):
+                rows.append(await measure(name, args, bytes_per_second, interval))
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "send path",
+                "client bytes/s",
+                "deltas",
+                "frames",
+                "frames/s",
+                "cpu per token (us)",
+                "peak buffered (KiB)",
+            ],
+            floatfmt=",.1f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=5000)
+    parser.add_argument("--paced-tokens", type=int, default=300)
+    parser.add_argument("--interval", type=float, default=1.0, help="milliseconds")
+    parser.add_argument(
+        "--client-rates",
+        type=float,
+        nargs="+",
+        default=[0, 20000],
+        help="0 for unlimited",
+    )
+    parser.add_argument("--chunk-size", type=int, default=2)
+    parser.add_argument(
+        "--flush-interval", type=float, default=30.0, help="milliseconds"
+    )
+    parser.add_argument("--flush-bytes", type=int, default=512)
+    asyncio.run(main(parser.parse_args()))
@@ -1,8 +1,27 @@
 import logging
-import re
 from dataclasses import dataclass
 
 from app.exceptions import APIException
+from app.globals import (
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_CACHE_MAX_ENTRIES,
+    EMBEDDING_MAX_CONCURRENT_BATCHES,
+    HTTP_CLIENT_HTTP2,
+    HTTP_CLIENT_MAX_CONNECTIONS,
+    HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+    LLAMA_CORE_BUDGET,
+    LLAMA_PROCESSES_PER_MODEL,
+    LLAMA_STATE_CACHE_BYTES,
+    LLAMA_STATE_SPILL_BYTES,
+    LLAMA_STATE_SPILL_DIR,
+    LLAMA_WORKER_MODELS,
+    LLAMA_WORKER_WARMUP,
+    VECTOR_INDEX_ALGORITHM,
+    VECTOR_INDEX_EF_CONSTRUCTION,
+    VECTOR_INDEX_EF_RUNTIME,
+    VECTOR_INDEX_INITIAL_CAP,
+    VECTOR_INDEX_M,
+)
 
 
 @dataclass(frozen=True)
@@ -13,7 +32,6 @@ class ChatGPTConfig:
     wait_for_timeout: float = 30.0
     # wait for this time before reconnecting
     wait_for_reconnect: float = 3.0
-    api_regex_pattern: re.Pattern = re.compile(r"data:\s*({.+?})\n\n")
     # number of tokens to remove when tokens exceed token limit
     extra_token_margin: int = 100
 
@@ -77,3 +95,154 @@ class LoggingConfig:
     file_log_level: int | None = logging.DEBUG
     file_log_name: str | None = "./log/app.log"
     logging_format: str = "[%(asctime)s] %(name)s:%(levelname)s - %(message)s"
+
+
+@dataclass(frozen=True)
+class ContextCacheConfig:
+    """
+    Context Cache Config
+        - max_entries: maximum number of contexts kept in memory per worker
+        - max_bytes: approximate memory budget of contexts kept in memory per worker
+        - ttl: seconds before a context kept in memory must be read from redis again
+        - invalidation_channel: redis pub/sub channel telling other workers to drop a context
+    """
+
+    max_entries: int = 1024
+    max_bytes: int = 64 * 1024 * 1024
+    ttl: float = 300.0
+    invalidation_channel: str = "chatgpt:invalidate"
+
+
+@dataclass(frozen=True)
+class HttpClientConfig:
+    """
+    Http Client Config
+        - http2: whether to multiplex requests to a host over a single HTTP/2 connection
+        - max_connections: maximum number of connections open at once
+        - max_keepalive_connections: maximum number of idle connections kept alive
+        - keepalive_expiry: seconds before an idle connection is closed
+        - timeout: seconds before connecting, reading or writing times out
+    """
+
+    http2: bool = HTTP_CLIENT_HTTP2
+    max_connections: int = HTTP_CLIENT_MAX_CONNECTIONS
+    max_keepalive_connections: int = HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS
+    keepalive_expiry: float = 30.0
+    timeout: float = ChatGPTConfig.wait_for_timeout
+
+
+@dataclass(frozen=True)
+class TokenizerConfig:
+    """
+    Tokenizer Config
+        - count_cache_size: number of token counts of messages kept per tokenizer
+    """
+
+    count_cache_size: int = 4096
+
+
+@dataclass(frozen=True)
+class WebsocketStreamConfig:
+    """
+    Websocket Stream Config
+        - flush_interval: minimum seconds between frames of a stream, deltas in between are coalesced
+        - flush_bytes: bytes of coalesced deltas that are sent without waiting for the interval
+        - max_pending_bytes: bytes of deltas waiting for a slow client,
+            above which the stream is not read until a frame is sent
+    """
+
+    flush_interval: float = 0.03
+    flush_bytes: int = 512
+    max_pending_bytes: int = 1 << 16
+
+
+@dataclass(frozen=True)
+class EmbeddingConfig:
+    """
+    Embedding Config
+        - batch_size: documents embedded by one request
+        - max_concurrent_batches: requests of a vectorstore embedding documents at once
+        - cache_max_entries: embeddings of a model cached in redis, 0 to disable the cache
+        - query_cache_max_entries: embeddings of queries cached in memory, 0 to disable the cache
+        - query_cache_ttl: seconds before an embedding of query cached in memory expires
+        - latency_samples: latest latencies of each search stage kept for percentiles
+    """
+
+    batch_size: int = EMBEDDING_BATCH_SIZE
+    max_concurrent_batches: int = EMBEDDING_MAX_CONCURRENT_BATCHES
+    cache_max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES
+    query_cache_max_entries: int = 1024
+    query_cache_ttl: float = 3600.0
+    latency_samples: int = 1024
+
+
+@dataclass(frozen=True)
+class VectorIndexConfig:
+    """
+    Vector Index Config
+        - algorithm: "FLAT" to compare a query with every vector,
+            or "HNSW" to search a graph of vectors approximately, in time growing with log of vectors
+        - distance_metric: distance between vectors, "COSINE", "IP" or "L2"
+        - m: edges of a vector in each layer of HNSW graph, more for better recall and more memory
+        - ef_construction: candidates considered while adding a vector to HNSW graph
+        - ef_runtime: candidates considered while searching HNSW graph, more for better recall
+        - initial_cap: vectors the index is allocated for at creation, None for default
+    """
+
+    algorithm: str = VECTOR_INDEX_ALGORITHM
+    distance_metric: str = "COSINE"
+    m: int = VECTOR_INDEX_M
+    ef_construction: int = VECTOR_INDEX_EF_CONSTRUCTION
+    ef_runtime: int = VECTOR_INDEX_EF_RUNTIME
+    initial_cap: int | None = VECTOR_INDEX_INITIAL_CAP
+
+
+@dataclass(frozen=True)
+class FileUploadConfig:
+    """
+    File Upload Config
+        - max_size: bytes of a file that can be uploaded
+        - spool_size: bytes of an upload kept in memory, before it is written to a temporary file
+        - chunk_size: tokens of a document embedded to vectorstore
+        - chunk_overlap: tokens shared by consecutive documents
+        - text_buffer_size: characters of parsed text buffered before splitting it into documents
+        - embed_batch_size: documents added to vectorstore at once, while the rest of file is parsed
+    """
+
+    max_size: int = 256 << 20
+    spool_size: int = 1 << 20
+    chunk_size: int = 500
+    chunk_overlap: int = 0
+    text_buffer_size: int = 1 << 16
+    embed_batch_size: int = 128
+
+
+@dataclass(frozen=True)
+class LlamaWorkerConfig:
+    """
+    Llama Worker Config
+        - models: names of llama.cpp models loaded by worker processes at startup
+        - processes_per_model: number of worker processes a model is pinned to,
+            which is also the number of sequences it decodes at once
+        - core_budget: CPU cores shared by workers of a model, unless the model sets n_threads
+        - warmup: whether to generate a token after loading, before accepting jobs
+        - shutdown_timeout: seconds to wait for a worker to exit before terminating it
+        - token_buffer_size: bytes of shared memory ring buffer carrying tokens from a worker
+        - token_buffer_timeout: seconds a worker waits for space of a full ring buffer, then exits
+        - state_cache_bytes: RAM budget of a worker for states of chatrooms, 0 to disable
+        - state_spill_dir: directory where states evicted from RAM are spilled, None to drop them
+        - state_spill_bytes: disk budget of a worker for spilled states
+        - recent_chatrooms_per_worker: chatrooms remembered to send them to the same worker
+    """
+
+    models: tuple[str, ...] = tuple(LLAMA_WORKER_MODELS)
+    processes_per_model: int = LLAMA_PROCESSES_PER_MODEL
+    core_budget: int = LLAMA_CORE_BUDGET
+    warmup: bool = LLAMA_WORKER_WARMUP
+    shutdown_timeout: float = 5.0
+    token_buffer_size: int = 1 << 20
+    token_buffer_timeout: float = 30.0
+    state_cache_bytes: int = LLAMA_STATE_CACHE_BYTES
+    state_spill_dir: str | None = LLAMA_STATE_SPILL_DIR
+    state_spill_bytes: int = LLAMA_STATE_SPILL_BYTES
+    recent_chatrooms_per_worker: int = 1024
@@ -0,0 +1,193 @@
+import re
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from hashlib import blake2b, sha256
+from threading import Lock
+from time import monotonic, time
+from typing import TYPE_CHECKING, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+if TYPE_CHECKING:
+    from redis.asyncio.client import Redis as AsyncRedisType
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def digest_of(text: str) -> str:
+    """Hash of text, ignoring differences of unicode normalization and whitespaces"""
+    normalized: str = " ".join(unicodedata.normalize("NFC", text).split())
+    return sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def model_of(embedding: Embeddings) -> str:
+    """Name of model embedding documents, telling apart vectors of different spaces"""
+    return (
+        getattr(embedding, "document_model_name", None)
+        or getattr(embedding, "model", None)
+        or type(embedding).__name__
+    )
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    Deterministic embeddings computed locally, without network or model.
+    Words are hashed into `dim` signed buckets and the counts normalized,
+    so texts sharing words are similar, and the same text is always embedded alike.
+    Meant for development and benchmarks, where OpenAI is not available.
+    """
+
+    def __init__(self, dim: int = 1536):
+        self.dim = dim
+        self.model = f"local-{dim}"
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in _WORD_PATTERN.findall(text.lower()):
+            digest: int = int.from_bytes(
+                blake2b(word.encode("utf-8"), digest_size=8).digest(), "little"
+            )
+            vector[(digest >> 1) % self.dim] += 1.0 if digest & 1 else -1.0
+        norm: float = float(np.linalg.norm(vector))
+        if not norm:
+            # cosine distance of a zero vector is undefined
+            vector[0], norm = 1.0, 1.0
+        return (vector / norm).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+@dataclass
+class EmbeddingStats:
+    """
+    Documents of an ingestion, by how their vectors were obtained
+        - documents: documents given to be added
+        - duplicates: documents identical to another one of the same ingestion
+        - reused: documents already in the index, which are not written again
+        - cached: documents whose embeddings were found in the embedding cache
+        - embedded: documents embedded by the embedding API
+    """
+
+    documents: int = 0
+    duplicates: int = 0
+    reused: int = 0
+    cached: int = 0
+    embedded: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Ratio of documents not embedded by the embedding API"""
+        return 1 - self.embedded / self.documents if self.documents else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.documents} documents, {self.hit_rate:.0%} hit rate "
+            f"({self.duplicates} duplicates, {self.reused} reused, "
+            f"{self.cached} cached, {self.embedded} embedded)"
+        )
+
+
+class EmbeddingCache:
+    """
+    Embeddings kept in redis as raw float32 bytes, keyed by model and digest of text,
+    so a chunk is embedded once however many times it's uploaded.
+    Bounded to `max_entries` embeddings of a model, evicting the least recently used ones,
+    whose last uses are scored in a sorted set.
+    """
+
+    def __init__(self, client: "AsyncRedisType", model: str, max_entries: int):
+        self.client = client
+        self.model = model
+        self.max_entries = max_entries
+        self.lru_key: str = f"embedding:{model}:lru"
+
+    def key_of(self, digest: str) -> str:
+        return f"embedding:{self.model}:{digest}"
+
+    async def aget_many(self, digests: List[str]) -> List[Optional[bytes]]:
+        if not digests:
+            return []
+        vectors: List[Optional[bytes]] = await self.client.mget(
+            [self.key_of(digest) for digest in digests]
+        )
+        now: float = time()
+        hits: dict[str, float] = {
+            digest: now for digest, vector in zip(digests, vectors) if vector
+        }
+        if hits:
+            await self.client.zadd(self.lru_key, hits)  # type: ignore
+        return vectors
+
+    async def aset_many(self, vectors: dict[str, bytes]) -> None:
+        if not vectors:
+            return
+        now: float = time()
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.mset(
+                {self.key_of(digest): vector for digest, vector in vectors.items()}
+            )
+            pipe.zadd(self.lru_key, {digest: now for digest in vectors})
+            pipe.zcard(self.lru_key)
+            n_entries: int = (await pipe.execute())[-1]
+        if n_entries <= self.max_entries:
+            return
+        evicted: list[tuple[bytes, float]] = await self.client.zpopmin(
+            self.lru_key, n_entries - self.max_entries
+        )  # type: ignore
+        if evicted:
+            await self.client.delete(
+                *[self.key_of(digest.decode("utf-8")) for digest, _ in evicted]
+            )
+
+
+class QueryEmbeddingCache:
+    """
+    In-process cache of embeddings of queries as float32 bytes, keyed by digest of query,
+    so a repeated question isn't embedded again.
+    Entries are evicted in LRU order beyond `max_entries`, and expire after `ttl` seconds.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: OrderedDict[str, tuple[bytes, float]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, query: str) -> Optional[bytes]:
+        key: str = digest_of(query)
+        with self._lock:
+            entry: Optional[tuple[bytes, float]] = self._entries.get(key)
+            if entry is None or entry[1] < monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, query: str, vector: bytes) -> None:
+        if self.max_entries <= 0:
+            return
+        key: str = digest_of(query)
+        with self._lock:
+            self._entries[key] = (vector, monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @property
+    def stats(self) -> dict[str, int | float]:
+        requests: int = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
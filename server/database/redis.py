@@ -1,7 +1,11 @@
 """Wrapper around Redis vector database."""
 from __future__ import annotations
 
+import re
+from asyncio import Semaphore, gather, sleep
+from collections import defaultdict, deque
 from enum import Enum
+from time import perf_counter
 from typing import (
     TYPE_CHECKING,
     Any,
@@ -32,6 +36,7 @@ from pydantic import BaseModel, root_validator
 from redis.asyncio import Redis as AsyncRedisType
 
 from app.globals import (
+    EMBEDDING_BACKEND,
     OPENAI_API_KEY,
     REDIS_DB,
     REDIS_HOST,
@@ -40,7 +45,15 @@ from app.globals import (
     REDIS_USER,
 )
 from app.logger import api_logger
-from database.dataclasses import Responses_500
+from database.dataclasses import EmbeddingConfig, Responses_500, VectorIndexConfig
+from database.embeddings import (
+    EmbeddingCache,
+    EmbeddingStats,
+    LocalEmbeddings,
+    QueryEmbeddingCache,
+    digest_of,
+    model_of,
+)
 from database.singleton import SingletonMetaClass
 
 try:
@@ -56,9 +69,10 @@ try:
     if TYPE_CHECKING:
         from redis.client import Pipeline as PipelineType
         from redis.client import Redis as RedisType
-    from redis.commands.search.field import TextField, VectorField
+    from redis.commands.search.field import TagField, TextField, VectorField
     from redis.commands.search.indexDefinition import IndexDefinition, IndexType
     from redis.commands.search.query import Query
+    from redis.commands.search.result import Result
 
     pkg_resources.require("redis>=4.2.0rc1")
     import redis.asyncio as aioredis
@@ -82,6 +96,33 @@ except pkg_resources.ResolutionError:
 REDIS_REQUIRED_MODULES = [
     {"name": "search", "ver": 20400},
 ]
+# fields of documents indexed as tags, which searches can be filtered by before KNN
+REDIS_TAG_FIELDS = ("user_id", "chatroom_id", "source")
+# separator of multiple values of a tag, which can't occur in ids or filenames
+REDIS_TAG_SEPARATOR = "\x1f"
+# punctuation and spaces in values of tags are escaped in queries
+_TAG_ESCAPE_PATTERN = re.compile(r"(\W)")
+# adds ARGV[2k+1] to tag field ARGV[2k] of existing documents of KEYS,
+# unless it's already one of values separated by ARGV[1], within one atomic step
+_MERGE_TAGS_SCRIPT = """
+local separator = ARGV[1]
+for _, key in ipairs(KEYS) do
+    if redis.call("EXISTS", key) == 1 then
+        for i = 2, #ARGV, 2 do
+            local field, value = ARGV[i], ARGV[i + 1]
+            local current = redis.call("HGET", key, field)
+            if not current or current == "" then
+                redis.call("HSET", key, field, value)
+            elseif not string.find(
+                separator .. current .. separator, separator .. value .. separator, 1, true
+            ) then
+                redis.call("HSET", key, field, current .. separator .. value)
+            end
+        end
+    end
+end
+return 0
+"""
 
 
 class DistanceMetric(str, Enum):
@@ -181,29 +222,76 @@ def _redis_key(prefix: str) -> str:
     return f"{prefix}:{uuid4().hex}"
 
 
+def _redis_content_key(prefix: str, text: str, scope: Optional[str] = None) -> str:
+    """Redis key of a document addressed by its content, so identical documents of scope share it."""
+    if scope is None:
+        return f"{prefix}:{digest_of(text)}"
+    return f"{prefix}:{scope}:{digest_of(text)}"
+
+
+def _redis_tag_value(value: Any) -> str:
+    """Value of a tag field, which can't contain the separator of multiple values"""
+    return str(value).replace(REDIS_TAG_SEPARATOR, "")
+
+
+def _redis_tag_filter(filters: Optional[Dict[str, Any]]) -> str:
+    """Query of documents having every tag of filters, or all documents without filters"""
+    if not filters:
+        return "*"
+    return (
+        "("
+        + " ".join(
+            "@%s:{%s}"
+            % (field, _TAG_ESCAPE_PATTERN.sub(r"\\\1", _redis_tag_value(value)))
+            for field, value in filters.items()
+        )
+        + ")"
+    )
+
+
 def _redis_prefix(index_name: str) -> str:
     """Redis key prefix for a given index."""
     return f"doc:{index_name}"
 
 
+def _redis_vector_attributes(
+    dim: int, index_config: VectorIndexConfig
+) -> Dict[str, Union[str, int]]:
+    """Attributes of vector field, for the algorithm of index_config"""
+    attributes: Dict[str, Union[str, int]] = {
+        "TYPE": "FLOAT32",
+        "DIM": dim,
+        "DISTANCE_METRIC": index_config.distance_metric,
+    }
+    if index_config.initial_cap is not None:
+        attributes["INITIAL_CAP"] = index_config.initial_cap
+    if index_config.algorithm == "HNSW":
+        attributes["M"] = index_config.m
+        attributes["EF_CONSTRUCTION"] = index_config.ef_construction
+        attributes["EF_RUNTIME"] = index_config.ef_runtime
+    elif index_config.algorithm != "FLAT":
+        raise ValueError(f"Unknown vector index algorithm: {index_config.algorithm}")
+    return attributes
+
+
 def _redis_vectorstore_schema(
     content_key: str,
     metadata_key: str,
     vector_key: str,
     dim: int,
-    distance_metric: str,
-) -> Tuple[TextField, TextField, VectorField]:
+    index_config: VectorIndexConfig = VectorIndexConfig(),
+) -> Tuple[Union[TextField, TagField, VectorField], ...]:
     return (
         TextField(name=content_key),
         TextField(name=metadata_key),
+        *[
+            TagField(name=field, separator=REDIS_TAG_SEPARATOR, case_sensitive=True)
+            for field in REDIS_TAG_FIELDS
+        ],
         VectorField(
             vector_key,
-            "FLAT",
-            {
-                "TYPE": "FLOAT32",
-                "DIM": dim,
-                "DISTANCE_METRIC": distance_metric,
-            },
+            index_config.algorithm,
+            _redis_vector_attributes(dim=dim, index_config=index_config),
         ),
     )
 
@@ -217,17 +305,21 @@ def _redis_embed_texts_to_pipeline(
     embeddings: List[List[float]],
     pipeline: Union[PipelineType, AsyncPipelineType],
     metadatas: Optional[List[dict]] = None,
+    keys: Optional[List[str]] = None,
+    tags: Optional[Dict[str, Any]] = None,
 ) -> None:
+    tags = {field: _redis_tag_value(value) for field, value in (tags or {}).items()}
     for i, text in enumerate(texts):
-        key = _redis_key(prefix)
-        metadata = metadatas[i] if metadatas else {}
+        key = keys[i] if keys else _redis_key(prefix)
+        metadata = (metadatas[i] if metadatas else {}) | tags
         pipeline.hset(
             key,
             mapping={
                 content_key: text,
                 vector_key: np.array(embeddings[i], dtype=np.float32).tobytes(),
                 metadata_key: orjson_dumps(metadata),
-            },
+            }
+            | tags,
         )
 
 
@@ -239,6 +331,7 @@ def _ensure_index_exist(
     metadata_key: str,
     vector_key: str,
     dim: int,
+    index_config: VectorIndexConfig = VectorIndexConfig(),
 ) -> None:
     if not _check_index_exists(client, index_name):
         # Constants
@@ -247,13 +340,33 @@ def _ensure_index_exist(
             metadata_key=metadata_key,
             vector_key=vector_key,
             dim=dim,
-            distance_metric=DistanceMetric.COSINE.value,
+            index_config=index_config,
         )
         # Create Redis Index
         client.ft(index_name).create_index(
             fields=schema,
             definition=IndexDefinition(prefix=[prefix], index_type=IndexType.HASH),
         )
+    else:
+        missing_tags: List[str] = _missing_tag_fields(client, index_name)
+        if missing_tags:
+            api_logger.warning(
+                f"Index {index_name} has no tag fields {missing_tags}, "
+                "so filtered searches find nothing until it's rebuilt "
+                "by `python -m gpt.vectorstore_migration`"
+            )
+
+
+def _missing_tag_fields(client: RedisType, index_name: str) -> List[str]:
+    """Tag fields of REDIS_TAG_FIELDS which are not in the index yet"""
+    attributes = client.ft(index_name).info().get("attributes", [])
+    names: set[str] = {
+        (name.decode() if isinstance(name, bytes) else str(name))
+        for attribute in attributes
+        for key, name in zip(attribute[::2], attribute[1::2])
+        if key in (b"attribute", "attribute")
+    }
+    return [field for field in REDIS_TAG_FIELDS if field not in names]
 
 
 async def _aensure_index_exist(
@@ -264,6 +377,7 @@ async def _aensure_index_exist(
     content_key: str = "content",
     metadata_key: str = "metadata",
     vector_key: str = "content_vector",
+    index_config: VectorIndexConfig = VectorIndexConfig(),
 ) -> None:
     if not await _acheck_index_exists(client, index_name):
         # Constants
@@ -272,7 +386,7 @@ async def _aensure_index_exist(
             metadata_key=metadata_key,
             vector_key=vector_key,
             dim=dim,
-            distance_metric=DistanceMetric.COSINE.value,
+            index_config=index_config,
         )
         # Create Redis Index
         await client.ft(index_name).create_index(
@@ -281,6 +395,84 @@ async def _aensure_index_exist(
         )
 
 
+async def amigrate_index(
+    client: AsyncRedisType,
+    index_name: str,
+    dim: int,
+    index_config: VectorIndexConfig,
+    content_key: str = "content",
+    metadata_key: str = "metadata",
+    vector_key: str = "content_vector",
+    poll_interval: float = 1.0,
+    drop_old_index: bool = True,
+) -> str:
+    """
+    Rebuild the index of index_name with index_config, online.
+    The new index is built under a new name over the same documents,
+    while searches keep using the old one, then index_name is switched to it by an alias.
+    If index_name is still an index rather than an alias, it's dropped and aliased
+    in one transaction, so searches never find index_name missing.
+    Documents are never deleted. Returns the name of the new index.
+    """
+    try:
+        old_index_name: str = (await client.ft(index_name).info())["index_name"]
+    except Exception as e:
+        raise ValueError(f"Index {index_name} does not exist: {e}")
+    new_index_name: str = f"{index_name}_{uuid4().hex[:8]}"
+    await client.ft(new_index_name).create_index(
+        fields=_redis_vectorstore_schema(
+            content_key=content_key,
+            metadata_key=metadata_key,
+            vector_key=vector_key,
+            dim=dim,
+            index_config=index_config,
+        ),
+        definition=IndexDefinition(
+            prefix=[_redis_prefix(index_name)], index_type=IndexType.HASH
+        ),
+    )
+    # documents already written are indexed in background
+    while int((await client.ft(new_index_name).info())["indexing"]):
+        await sleep(poll_interval)
+    async with client.pipeline(transaction=True) as pipe:
+        if old_index_name == index_name:
+            pipe.execute_command("FT.DROPINDEX", old_index_name)
+            pipe.execute_command("FT.ALIASADD", index_name, new_index_name)
+        else:
+            pipe.execute_command("FT.ALIASUPDATE", index_name, new_index_name)
+        await pipe.execute()
+    api_logger.info(f"Index {index_name} switched to {new_index_name}")
+    if drop_old_index and old_index_name != index_name:
+        await client.ft(old_index_name).dropindex(delete_documents=False)
+    return new_index_name
+
+
+class _StageLatencies:
+    """Latest latencies of stages of search in seconds, summarized as percentiles"""
+
+    def __init__(self, samples: int):
+        self._latencies: defaultdict[str, deque[float]] = defaultdict(
+            lambda: deque(maxlen=samples)
+        )
+
+    def record(self, **seconds_of_stages: float) -> None:
+        for stage, seconds in seconds_of_stages.items():
+            self._latencies[stage].append(seconds)
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        stats: Dict[str, Dict[str, float]] = {}
+        for stage, latencies in self._latencies.items():
+            ordered: List[float] = sorted(latencies)
+            stats[stage] = {"samples": len(ordered)} | {
+                f"p{percentile}": ordered[
+                    min(len(ordered) - 1, len(ordered) * percentile // 100)
+                ]
+                for percentile in (50, 90, 99)
+            }
+        return stats
+
+
 class Redis(VectorStore):
     def __init__(
         self,
@@ -291,10 +483,19 @@ class Redis(VectorStore):
         metadata_key: str = "metadata",
         vector_key: str = "content_vector",
         is_async: bool = False,
+        embedding: Optional[Embeddings] = None,
+        embedding_config: EmbeddingConfig = EmbeddingConfig(),
         **kwargs: Any,
     ):
-        """Initialize with necessary components."""
+        """
+        Initialize with necessary components.
+        If embedding is given, documents are embedded in batches by its `embed_documents`,
+        and their embeddings cached, otherwise one by one by embedding_function.
+        """
         self.embedding_function = embedding_function
+        self.embedding = embedding
+        self.embedding_config = embedding_config
+        self._embedding_semaphore = Semaphore(embedding_config.max_concurrent_batches)
         self.index_name = index_name
         # We need to first remove redis_url from kwargs,
         # otherwise passing it to Redis will result in an error.
@@ -309,6 +510,79 @@ class Redis(VectorStore):
         self.content_key = content_key
         self.metadata_key = metadata_key
         self.vector_key = vector_key
+        self._merge_tags_script = self.client.register_script(_MERGE_TAGS_SCRIPT)
+        self.embedding_cache: Optional[EmbeddingCache] = (
+            EmbeddingCache(
+                client=self.client,  # type: ignore
+                model=model_of(embedding),
+                max_entries=embedding_config.cache_max_entries,
+            )
+            if is_async
+            and embedding is not None
+            and embedding_config.cache_max_entries > 0
+            else None
+        )
+        self.query_cache = QueryEmbeddingCache(
+            max_entries=embedding_config.query_cache_max_entries,
+            ttl=embedding_config.query_cache_ttl,
+        )
+        self.latencies = _StageLatencies(samples=embedding_config.latency_samples)
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.embedding is not None:
+            return self.embedding.embed_documents(texts)
+        return [self.embedding_function(text) for text in texts]
+
+    def _keys_of(self, texts: List[str], **kwargs: Any) -> List[str]:
+        # Use provided keys otherwise use keys addressed by content, within documents of user
+        prefix = _redis_prefix(self.index_name)
+        user_id: Optional[Any] = (kwargs.get("tags") or {}).get("user_id")
+        return kwargs.get("keys") or [
+            _redis_content_key(
+                prefix, text, scope=None if user_id is None else str(user_id)
+            )
+            for text in texts
+        ]
+
+    def _add_batch_to_pipeline(
+        self,
+        pipeline: Union[PipelineType, AsyncPipelineType],
+        texts: List[str],
+        embeddings: List[List[float]],
+        keys: List[str],
+        metadatas: Optional[List[dict]] = None,
+        tags: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        _redis_embed_texts_to_pipeline(
+            texts=texts,
+            prefix=_redis_prefix(self.index_name),
+            content_key=self.content_key,
+            metadata_key=self.metadata_key,
+            vector_key=self.vector_key,
+            embeddings=embeddings,
+            pipeline=pipeline,
+            metadatas=metadatas,
+            keys=keys,
+            tags=tags,
+        )
+
+    async def _amerge_tags(self, keys: List[str], tags: Dict[str, Any]) -> None:
+        """
+        Add tags to documents already in the index, keeping tags they have.
+        Merged by a script in redis, so concurrent merges of one document don't overwrite each other.
+        """
+        fields: List[str] = [field for field in tags if field in REDIS_TAG_FIELDS]
+        if not keys or not fields:
+            return
+        await self._merge_tags_script(  # type: ignore
+            keys=keys,
+            args=[REDIS_TAG_SEPARATOR]
+            + [
+                arg
+                for field in fields
+                for arg in (field, _redis_tag_value(tags[field]))
+            ],
+        )
 
     def _add_texts(
         self,
@@ -316,26 +590,21 @@ class Redis(VectorStore):
         metadatas: Optional[List[dict]] = None,
         **kwargs: Any,
     ) -> Tuple[List[str], Union[PipelineType, AsyncPipelineType]]:
-        prefix = _redis_prefix(self.index_name)
-        keys = kwargs.get("keys")
-        ids = []
+        texts = list(texts)
+        ids = self._keys_of(texts, **kwargs)
+        batch_size = self.embedding_config.batch_size
         # Write data to redis
         pipeline = self.client.pipeline(transaction=False)
-        for i, text in enumerate(texts):
-            # Use provided key otherwise use default key
-            key = keys[i] if keys else _redis_key(prefix)
-            metadata = metadatas[i] if metadatas else {}
-            pipeline.hset(
-                key,
-                mapping={
-                    self.content_key: text,
-                    self.vector_key: np.array(
-                        self.embedding_function(text), dtype=np.float32
-                    ).tobytes(),
-                    self.metadata_key: orjson_dumps(metadata),
-                },
+        for start in range(0, len(texts), batch_size):
+            end = start + batch_size
+            self._add_batch_to_pipeline(
+                pipeline,
+                texts=texts[start:end],
+                embeddings=self._embed_documents(texts[start:end]),
+                keys=ids[start:end],
+                metadatas=metadatas[start:end] if metadatas else None,
+                tags=kwargs.get("tags"),
             )
-            ids.append(key)
         return ids, pipeline
 
     def add_texts(
@@ -355,11 +624,91 @@ class Redis(VectorStore):
         metadatas: Optional[List[dict]] = None,
         **kwargs: Any,
     ) -> List[str]:
-        """Add texts data to an existing index."""
-        ids, pipeline = await run_in_threadpool(
-            self._add_texts, texts, metadatas, **kwargs
+        """
+        Add texts data to an existing index, asynchronously.
+        Documents are keyed by their content, so a document already in the index is reused,
+        and only written once if repeated. Others get their embeddings from the embedding cache,
+        or are embedded in batches, up to `max_concurrent_batches` requests at once
+        across the vectorstore, each batch written by a pipeline as soon as it's embedded.
+        Documents are tagged with `tags`, if given, such as user_id, chatroom_id and source.
+        Documents are shared within a user, so reused ones get the tags added to theirs.
+        How documents were obtained is counted into `stats`, if given.
+        """
+        texts = list(texts)
+        ids = self._keys_of(texts, **kwargs)
+        tags: Dict[str, Any] = kwargs.get("tags") or {}
+        stats: EmbeddingStats = kwargs.get("stats") or EmbeddingStats()
+        stats.documents += len(texts)
+        # identical documents are written once, by their first occurrence
+        first_of: Dict[str, int] = {}
+        for i, key in enumerate(ids):
+            first_of.setdefault(key, i)
+        indices: List[int] = list(first_of.values())
+        stats.duplicates += len(texts) - len(indices)
+        async with self.client.pipeline(transaction=False) as pipe:  # type: ignore
+            for i in indices:
+                pipe.exists(ids[i])
+            exists: List[int] = await pipe.execute()
+        await self._amerge_tags(
+            [ids[i] for i, is_existing in zip(indices, exists) if is_existing], tags
         )
-        await pipeline.execute()  # type: ignore
+        indices = [i for i, is_existing in zip(indices, exists) if not is_existing]
+        stats.reused += len(exists) - len(indices)
+
+        cached: List[Optional[bytes]] = (
+            await self.embedding_cache.aget_many([digest_of(texts[i]) for i in indices])
+            if self.embedding_cache is not None
+            else [None] * len(indices)
+        )
+        hits: List[int] = [i for i, vector in zip(indices, cached) if vector]
+        misses: List[int] = [i for i, vector in zip(indices, cached) if not vector]
+        stats.cached += len(hits)
+        stats.embedded += len(misses)
+
+        def write(batch: List[int], embeddings: List[Any]) -> Any:
+            pipeline = self.client.pipeline(transaction=False)
+            self._add_batch_to_pipeline(
+                pipeline,
+                texts=[texts[i] for i in batch],
+                embeddings=embeddings,
+                keys=[ids[i] for i in batch],
+                metadatas=[metadatas[i] for i in batch] if metadatas else None,
+                tags=tags,
+            )
+            return pipeline.execute()
+
+        async def add_batch(batch: List[int]) -> None:
+            async with self._embedding_semaphore:
+                embeddings = await run_in_threadpool(
+                    self._embed_documents, [texts[i] for i in batch]
+                )
+            await write(batch, embeddings)
+            if self.embedding_cache is not None:
+                await self.embedding_cache.aset_many(
+                    {
+                        digest_of(texts[i]): np.array(
+                            embedding, dtype=np.float32
+                        ).tobytes()
+                        for i, embedding in zip(batch, embeddings)
+                    }
+                )
+
+        batch_size = self.embedding_config.batch_size
+        await gather(
+            *[
+                add_batch(misses[start : start + batch_size])
+                for start in range(0, len(misses), batch_size)
+            ]
+        )
+        if hits:
+            await write(
+                hits,
+                [
+                    np.frombuffer(vector, dtype=np.float32)
+                    for vector in cached
+                    if vector
+                ],
+            )
         return ids
 
     def similarity_search(
@@ -375,7 +724,9 @@ class Redis(VectorStore):
         Returns:
             List[Document]: A list of documents that are most similar to the query text.
         """
-        docs_and_scores = self.similarity_search_with_score(query, k=k)
+        docs_and_scores = self.similarity_search_with_score(
+            query, k=k, filters=kwargs.get("filters")
+        )
         return [doc for doc, _ in docs_and_scores]
 
     async def asimilarity_search(
@@ -391,7 +742,9 @@ class Redis(VectorStore):
         Returns:
             List[Document]: A list of documents that are most similar to the query text.
         """
-        docs_and_scores = await self.asimilarity_search_with_score(query, k=k)
+        docs_and_scores = await self.asimilarity_search_with_score(
+            query, k=k, filters=kwargs.get("filters")
+        )
         return [doc for doc, _ in docs_and_scores]
 
     def similarity_search_limit_score(
@@ -418,7 +771,9 @@ class Redis(VectorStore):
             an empty list is returned.
 
         """
-        docs_and_scores = self.similarity_search_with_score(query, k=k)
+        docs_and_scores = self.similarity_search_with_score(
+            query, k=k, filters=kwargs.get("filters")
+        )
         return [doc for doc, score in docs_and_scores if score < score_threshold]
 
     async def asimilarity_search_limit_score(
@@ -445,19 +800,60 @@ class Redis(VectorStore):
             an empty list is returned.
 
         """
-        docs_and_scores = await self.asimilarity_search_with_score(query, k=k)
+        docs_and_scores = await self.asimilarity_search_with_score(
+            query, k=k, filters=kwargs.get("filters")
+        )
         return [doc for doc, score in docs_and_scores if score < score_threshold]
 
+    def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        # embeddings of documents and queries are alike for OpenAI models
+        if self.embedding is not None and len(queries) > 1:
+            return self.embedding.embed_documents(queries)
+        return [self.embedding_function(query) for query in queries]
+
+    def _cache_query_vectors(
+        self, queries: List[str], embeddings: List[List[float]]
+    ) -> Dict[str, bytes]:
+        vectors: Dict[str, bytes] = {}
+        for query, embedding in zip(queries, embeddings):
+            vectors[query] = np.array(embedding, dtype=np.float32).tobytes()
+            self.query_cache.put(query, vectors[query])
+        return vectors
+
+    def _query_vectors(self, queries: List[str]) -> List[bytes]:
+        """Vectors of queries as float32 bytes, embedding the ones not cached at once"""
+        vectors: List[Optional[bytes]] = [
+            self.query_cache.get(query) for query in queries
+        ]
+        misses: List[str] = list(
+            dict.fromkeys([q for q, vector in zip(queries, vectors) if vector is None])
+        )
+        embedded: Dict[str, bytes] = self._cache_query_vectors(
+            misses, self._embed_queries(misses) if misses else []
+        )
+        return [vector or embedded[q] for q, vector in zip(queries, vectors)]
+
+    async def _aquery_vectors(self, queries: List[str]) -> List[bytes]:
+        """Vectors of queries as float32 bytes, embedding the ones not cached at once in a thread"""
+        vectors: List[Optional[bytes]] = [
+            self.query_cache.get(query) for query in queries
+        ]
+        misses: List[str] = list(
+            dict.fromkeys([q for q, vector in zip(queries, vectors) if vector is None])
+        )
+        embedded: Dict[str, bytes] = self._cache_query_vectors(
+            misses,
+            await run_in_threadpool(self._embed_queries, misses) if misses else [],
+        )
+        return [vector or embedded[q] for q, vector in zip(queries, vectors)]
+
     def _similarity_search_with_score(
-        self, query: str, k: int = 4
+        self, vector: bytes, k: int = 4, filters: Optional[Dict[str, Any]] = None
     ) -> Tuple[Query, Mapping[str, str]]:
-        # Creates embedding vector from user query
-        embedding = self.embedding_function(query)
-
-        # Prepare the Query
+        # Prepare the Query, searching only documents with tags of filters
         return_fields = [self.metadata_key, self.content_key, "vector_score"]
         vector_field = self.vector_key
-        hybrid_fields = "*"
+        hybrid_fields = _redis_tag_filter(filters)
         base_query = (
             f"{hybrid_fields}=>[KNN {k} @{vector_field} $vector AS vector_score]"
         )
@@ -468,70 +864,144 @@ class Redis(VectorStore):
             .paging(0, k)
             .dialect(2)
         )
-        params_dict: Mapping[str, str] = {
-            "vector": np.array(embedding).astype(dtype=np.float32).tobytes()  # type: ignore
-        }
+        params_dict: Mapping[str, str] = {"vector": vector}  # type: ignore
         return redis_query, params_dict
 
+    def _documents_of(self, results: Result) -> List[Tuple[Document, float]]:
+        return [
+            (
+                Document(
+                    page_content=getattr(result, self.content_key),
+                    metadata=orjson_loads(getattr(result, self.metadata_key)),
+                ),
+                float(result.vector_score),
+            )
+            for result in results.docs
+        ]
+
     def similarity_search_with_score(
-        self, query: str, k: int = 4
+        self, query: str, k: int = 4, filters: Optional[Dict[str, Any]] = None
     ) -> List[Tuple[Document, float]]:
         """Return docs most similar to query.
 
         Args:
             query: Text to look up documents similar to.
             k: Number of Documents to return. Defaults to 4.
+            filters: Tags documents must have, such as user_id. Defaults to None.
 
         Returns:
             List of Documents most similar to the query and score for each
         """
-        redis_query, params_dict = self._similarity_search_with_score(query, k=k)
+        started_at = perf_counter()
+        redis_query, params_dict = self._similarity_search_with_score(
+            self._query_vectors([query])[0], k=k, filters=filters
+        )
+        embedded_at = perf_counter()
 
         # perform vector search
         results = self.client.ft(self.index_name).search(redis_query, params_dict)
+        searched_at = perf_counter()
 
-        docs = [
-            (
-                Document(
-                    page_content=result.content, metadata=orjson_loads(result.metadata)
-                ),
-                float(result.vector_score),
-            )
-            for result in results.docs
-        ]
-
+        docs = self._documents_of(results)
+        self.latencies.record(
+            embed=embedded_at - started_at,
+            search=searched_at - embedded_at,
+            decode=perf_counter() - searched_at,
+        )
         return docs
 
     async def asimilarity_search_with_score(
-        self, query: str, k: int = 4
+        self, query: str, k: int = 4, filters: Optional[Dict[str, Any]] = None
     ) -> List[Tuple[Document, float]]:
         """Return docs most similar to query, asynchronously.
 
         Args:
             query: Text to look up documents similar to.
             k: Number of Documents to return. Defaults to 4.
+            filters: Tags documents must have, such as user_id. Defaults to None.
 
         Returns:
             List of Documents most similar to the query and score for each
         """
-        redis_query, params_dict = await run_in_threadpool(
-            self._similarity_search_with_score, query, k
-        )
+        return (
+            await self.abatch_similarity_search_with_score(
+                [query], k=k, filters=filters
+            )
+        )[0]
 
-        # perform vector search
-        results = await self.client.ft(self.index_name).search(redis_query, params_dict)  # type: ignore
+    async def abatch_similarity_search_with_score(
+        self,
+        queries: List[str],
+        k: int = 4,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Return docs most similar to each of queries, asynchronously.
+        Queries not cached are embedded by one request,
+        and their searches are sent by one pipeline.
+        With filters, only documents having their tags are searched, before KNN.
+
+        Args:
+            queries: Texts to look up documents similar to.
+            k: Number of Documents to return for each query. Defaults to 4.
+            filters: Tags documents must have, such as user_id. Defaults to None.
+
+        Returns:
+            List of Documents most similar to each query and score for each
+        """
+        if not queries:
+            return []
+        started_at = perf_counter()
+        vectors: List[bytes] = await self._aquery_vectors(queries)
+        embedded_at = perf_counter()
+
+        # perform vector searches
+        search = self.client.ft(self.index_name)
+        async with self.client.pipeline(transaction=False) as pipe:  # type: ignore
+            for vector in vectors:
+                redis_query, params_dict = self._similarity_search_with_score(
+                    vector, k=k, filters=filters
+                )
+                pipe.execute_command(
+                    "FT.SEARCH",
+                    self.index_name,
+                    *redis_query.get_args(),
+                    *search.get_params_args(params_dict),  # type: ignore
+                )
+            responses: List[Any] = await pipe.execute()
+        searched_at = perf_counter()
 
         docs = [
-            (
-                Document(
-                    page_content=result.content, metadata=orjson_loads(result.metadata)
-                ),
-                float(result.vector_score),
-            )
-            for result in results.docs
+            self._documents_of(Result(response, hascontent=True))
+            for response in responses
         ]
+        self.latencies.record(
+            embed=embedded_at - started_at,
+            search=searched_at - embedded_at,
+            decode=perf_counter() - searched_at,
+        )
         return docs
 
+    async def abatch_similarity_search(
+        self,
+        queries: List[str],
+        k: int = 4,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> List[List[Document]]:
+        """Return docs most similar to each of queries, asynchronously."""
+        return [
+            [doc for doc, _ in docs_and_scores]
+            for docs_and_scores in await self.abatch_similarity_search_with_score(
+                queries, k=k, filters=filters
+            )
+        ]
+
+    @property
+    def search_stats(self) -> Dict[str, Any]:
+        return {
+            "query_cache": self.query_cache.stats,
+            "latencies": self.latencies.stats,
+        }
+
     @classmethod
     def from_texts(
         cls: Type[Redis],
@@ -607,6 +1077,7 @@ class Redis(VectorStore):
             content_key=content_key,
             metadata_key=metadata_key,
             vector_key=vector_key,
+            embedding=embedding,
             is_async=False,
             **kwargs,
         )
@@ -686,6 +1157,7 @@ class Redis(VectorStore):
             content_key=content_key,
             metadata_key=metadata_key,
             vector_key=vector_key,
+            embedding=embedding,
             is_async=True,
             **kwargs,
         )
@@ -785,6 +1257,7 @@ class Redis(VectorStore):
             content_key=content_key,
             metadata_key=metadata_key,
             vector_key=vector_key,
+            embedding=embedding,
             is_async=False,
             **kwargs,
         )
@@ -819,6 +1292,7 @@ class Redis(VectorStore):
             content_key=content_key,
             metadata_key=metadata_key,
             vector_key=vector_key,
+            embedding=embedding,
             is_async=True,
             **kwargs,
         )
@@ -883,7 +1357,13 @@ class RedisFactory(metaclass=SingletonMetaClass):
         vector_key: str = "content_vector",
         vector_dimension: int = 1536,
         openai_api_key: str | None = OPENAI_API_KEY,
+        embeddings: Embeddings | None = None,
+        index_config: VectorIndexConfig = VectorIndexConfig(),
     ) -> None:
+        """
+        Connect to the vectorstore, creating its index with index_config if it doesn't exist.
+        An existing index is kept as it is, until it's rebuilt by `python -m gpt.vectorstore_migration`.
+        """
         if self.is_initiated:
             return
         redis_url = "redis://{username}:{password}@{host}:{port}/{db}".format(
@@ -893,10 +1373,13 @@ class RedisFactory(metaclass=SingletonMetaClass):
             port=REDIS_PORT,
             db=REDIS_DB,
         )
-        embeddings: Embeddings = OpenAIEmbeddings(
-            client=openai.Embedding,
-            openai_api_key=openai_api_key,
-        )
+        if embeddings is None and EMBEDDING_BACKEND == "local":
+            embeddings = LocalEmbeddings(dim=vector_dimension)
+        elif embeddings is None:
+            embeddings = OpenAIEmbeddings(
+                client=openai.Embedding,
+                openai_api_key=openai_api_key,
+            )
         _tmp_ = Redis(
             redis_url=redis_url,
             index_name=index_name,
@@ -914,6 +1397,7 @@ class RedisFactory(metaclass=SingletonMetaClass):
             metadata_key=metadata_key,
             vector_key=vector_key,
             dim=vector_dimension,
+            index_config=index_config,
         )
         _tmp_.client.close()
         self._vectorstore = Redis(
@@ -924,6 +1408,7 @@ class RedisFactory(metaclass=SingletonMetaClass):
             metadata_key=metadata_key,
             vector_key=vector_key,
             is_async=True,
+            embedding=embeddings,
         )
         self.is_initiated = True
 
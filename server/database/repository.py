@@ -3,7 +3,7 @@ from sqlalchemy.future import select
 from app.exceptions import ChatroomNotFound
 from database import db, models, schemas
 from database.models import Base
-from gpt.commands import create_new_chatroom, delete_old_chatroom
+from gpt.commands import create_new_chatroom, delete_old_chatroom, delete_old_chatrooms
 
 
 async def create_chatroom(chatroom: schemas.ChatRoomCreate, user_id: int):
@@ -83,6 +83,19 @@ async def delete_chatroom(chatroom_id: int, user_id: int) -> None:
     return
 
 
+async def delete_all_chatrooms(user_id: int) -> None:
+    """Delete every chatroom of a user from the database, e.g. when the account is deleted"""
+    async with db.session() as transaction:
+        q = select(models.Chatroom).where(models.Chatroom.user_id == user_id)
+        result = await transaction.execute(q)
+        chatrooms = result.scalars().all()
+        for chatroom in chatrooms:
+            await transaction.delete(chatroom)
+        await transaction.commit()
+        await delete_old_chatrooms([chatroom.id for chatroom in chatrooms], user_id)
+    return
+
+
 async def get_all_chatrooms(user_id: int) -> list:
     """Get all chatrooms from the database"""
     async with db.session() as transaction:
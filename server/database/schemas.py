@@ -1,3 +1,6 @@
+from typing import Literal
+
+from orjson import dumps as orjson_dumps
 from pydantic import BaseModel
 
 
@@ -35,12 +38,42 @@ class MessageFromWebsocket(BaseModel):
     chatroom_id: int
 
 
+class FileUploadStart(BaseModel):
+    """
+    start of a chunked file upload, followed by bytes frames of the file and `FileUploadEnd`
+        - filename: name of file, whose extension tells how it is parsed
+        - size: bytes of file
+    """
+
+    upload: Literal["start"]
+    filename: str
+    size: int
+
+
+class FileUploadEnd(BaseModel):
+    """
+    end of a chunked file upload
+        - sha256: hex digest of file, checked against the received bytes
+    """
+
+    upload: Literal["end"]
+    sha256: str
+
+
 class InitMessage(BaseModel):
     """
     message to send to websocket on init
+        - previous_chats: window of previous chats of current chatroom
+        - previous_chats_offset: number of message pairs older than the window,
+            which can be requested with `/history <previous_chats_offset>`
+        - older_chats: whether previous_chats are older than the ones already sent
+        - chatroom_ids: chatroom ids sorted from recent to past
+        - init_callback: whether client should run its init callback
     """
 
     previous_chats: list[dict] | None = None
+    previous_chats_offset: int | None = None
+    older_chats: bool = False
     chatroom_ids: list[int] | None = None
     init_callback: bool = True
 
@@ -54,6 +87,8 @@ class MessageToWebsocket(BaseModel):
         - is_user: whether the message is from user
         - init: whether the message is init message
         - model_name: model name
+        - queue_position: position of generation in queue of a local model, 0 if next
+        - estimated_wait: estimated seconds until the queued generation starts
     """
 
     msg: str | None
@@ -62,6 +97,8 @@ class MessageToWebsocket(BaseModel):
     is_user: bool
     init: bool = False
     model_name: str | None = None
+    queue_position: int | None = None
+    estimated_wait: float | None = None
 
     class Config:
         """
@@ -71,6 +108,48 @@ class MessageToWebsocket(BaseModel):
         orm_mode = True
 
 
+class MessageToWebsocketFrame:
+    """
+    encoder of `MessageToWebsocket` frames differing only in msg and finish, like a stream's.
+    Other fields are validated and encoded once, so a frame is the encoded msg between
+    pre-encoded bytes, without building a model.
+    """
+
+    def __init__(
+        self,
+        chatroom_id: int,
+        is_user: bool,
+        init: bool = False,
+        model_name: str | None = None,
+        queue_position: int | None = None,
+        estimated_wait: float | None = None,
+    ):
+        static_fields: dict = MessageToWebsocket(
+            msg=None,
+            finish=False,
+            chatroom_id=chatroom_id,
+            is_user=is_user,
+            init=init,
+            model_name=model_name,
+            queue_position=queue_position,
+            estimated_wait=estimated_wait,
+        ).dict(exclude={"msg", "finish"})
+        # fields are encoded in order of the model, so frames look the same as before
+        tail: bytes = orjson_dumps(static_fields)[1:]
+        self._head: bytes = b'{"msg":'
+        self._tails: tuple[bytes, bytes] = (
+            b',"finish":false,' + tail,
+            b',"finish":true,' + tail,
+        )
+
+    def encode(self, msg: str | None, finish: bool = False) -> bytes:
+        return self._head + orjson_dumps(msg) + self._tails[finish]
+
+    def text(self, msg: str | None, finish: bool = False) -> str:
+        """Frame as text, since clients parse text frames as json"""
+        return self.encode(msg, finish).decode("utf-8")
+
+
 class SendToStream(BaseModel):
     """
     message to send to stream
@@ -1,26 +1,87 @@
 import asyncio
+from copy import copy
 from dataclasses import dataclass, field
+from typing import Any, Coroutine
 
 from fastapi import WebSocket
 
-from gpt.common import UserGptContext
+from app.globals import MAX_CONCURRENT_CHATROOMS_PER_USER
+from gpt.common import UserGptContext, UserGptContextStub
+
+
+class _LaneWebSocket:
+    """
+    Websocket of a lane, sending only while its chatroom is the current one,
+    since client ignores messages of other chatrooms
+    """
+
+    def __init__(self, buffer: "BufferedUserContext", chatroom_id: int):
+        self._buffer = buffer
+        self._chatroom_id = chatroom_id
+
+    @property
+    def client_state(self) -> Any:
+        return self._buffer.websocket.client_state  # type: ignore
+
+    @property
+    def is_current(self) -> bool:
+        return self._buffer.current_chatroom_id == self._chatroom_id
+
+    async def send_text(self, data: str) -> None:
+        if self.is_current:
+            await self._buffer.websocket.send_text(data)  # type: ignore
+
+    async def send_json(self, data: Any) -> None:
+        if self.is_current:
+            await self._buffer.websocket.send_json(data)  # type: ignore
+
+
+@dataclass
+class ChatroomLane:
+    """
+    Messages of a chatroom, handled in order by a task of their own,
+    so a long generation doesn't hold up other chatrooms of the user.
+    Its buffer is pinned to the chatroom, so handlers keep using it after user changes chatroom.
+    """
+
+    chatroom_id: int
+    buffer: "BufferedUserContext"
+    queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+    task: asyncio.Task | None = None
+    is_handling: bool = False
+
+    @property
+    def done(self) -> asyncio.Event:
+        return self.buffer.done
+
+    @property
+    def is_idle(self) -> bool:
+        return not self.is_handling and self.queue.empty()
 
 
 @dataclass
 class BufferedUserContext:
-    """A buffered user context is a user context that is stored in memory"""
+    """
+    A buffered user context is a user context that is stored in memory.
+    Chatrooms other than the current one may be stubs, whose histories are loaded when selected.
+    Messages of chatrooms are handled in lanes, up to `max_concurrent_lanes` at once.
+    """
 
     user_id: int
     initial_chatroom_id: int
     websocket: WebSocket | None
-    sorted_contexts: list[UserGptContext]
+    sorted_contexts: list[UserGptContext | UserGptContextStub]
     queue: asyncio.Queue = field(default_factory=asyncio.Queue)
     done: asyncio.Event = field(default_factory=asyncio.Event)
+    max_concurrent_lanes: int = MAX_CONCURRENT_CHATROOMS_PER_USER
+    lanes: dict[int, ChatroomLane] = field(default_factory=dict)
+    background_tasks: set[asyncio.Task] = field(default_factory=set)
+    lane_semaphore: asyncio.Semaphore = field(init=False)
     _current_context: UserGptContext = field(init=False)
 
     def __post_init__(self) -> None:
-        index: int | None = self.find_index_of_chatroom(self.initial_chatroom_id)
-        self._current_context = self.sorted_contexts[index if index is not None else 0]
+        self.lane_semaphore = asyncio.Semaphore(self.max_concurrent_lanes)
+        self.change_context_to(index=self.initial_index)
 
     def insert_context(self, user_gpt_context: UserGptContext, index: int = 0) -> None:
         self.sorted_contexts.insert(index, user_gpt_context)
@@ -36,7 +97,58 @@ class BufferedUserContext:
             return None
 
     def change_context_to(self, index: int) -> None:
-        self._current_context = self.sorted_contexts[index]
+        context: UserGptContext | UserGptContextStub = self.sorted_contexts[index]
+        if isinstance(context, UserGptContextStub):
+            raise ValueError(f"Context of chatroom {context.chatroom_id} is not loaded")
+        self._current_context = context
+
+    def replace_context(
+        self, index: int, user_gpt_context: UserGptContext | UserGptContextStub
+    ) -> None:
+        """replace context at index, keeping current context if it was replaced"""
+        if self.sorted_contexts[index] is self._current_context:
+            self._current_context = user_gpt_context
+        self.sorted_contexts[index] = user_gpt_context
+
+    def lane_of(self, chatroom_id: int) -> ChatroomLane:
+        """Lane of chatroom, whose buffer is pinned to the loaded context of chatroom"""
+        if chatroom_id not in self.lanes:
+            # shares contexts, lanes and semaphore, but not the current context and done event
+            pinned: BufferedUserContext = copy(self)
+            pinned.websocket = _LaneWebSocket(self, chatroom_id)  # type: ignore
+            pinned.done = asyncio.Event()
+            self.lanes[chatroom_id] = ChatroomLane(
+                chatroom_id=chatroom_id, buffer=pinned
+            )
+        if self.lanes[chatroom_id].is_idle:
+            self.pin_lane(self.lanes[chatroom_id])
+        return self.lanes[chatroom_id]
+
+    def pin_lane(self, lane: ChatroomLane) -> None:
+        """Pin lane to the loaded context of its chatroom, which may have been replaced"""
+        index: int | None = self.find_index_of_chatroom(lane.chatroom_id)
+        if index is not None and isinstance(
+            self.sorted_contexts[index], UserGptContext
+        ):
+            lane.buffer._current_context = self.sorted_contexts[index]  # type: ignore
+
+    def stop(self, chatroom_id: int) -> None:
+        """Interrupt generation of chatroom, leaving other lanes running"""
+        if chatroom_id in self.lanes:
+            self.lanes[chatroom_id].done.set()
+
+    def run_in_background(self, coroutine: Coroutine) -> asyncio.Task:
+        task: asyncio.Task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    def cancel_tasks(self) -> None:
+        for lane in self.lanes.values():
+            if lane.task is not None:
+                lane.task.cancel()
+        for task in self.background_tasks:
+            task.cancel()
 
     @property
     def buffer_size(self) -> int:
@@ -48,7 +160,13 @@ class BufferedUserContext:
         return self.current_user_gpt_context.chatroom_id
 
     @property
-    def sorted_user_gpt_contexts(self) -> list[UserGptContext]:
+    def initial_index(self) -> int:
+        """Return index of initial chatroom, or the most recent one if it doesn't exist"""
+        index: int | None = self.find_index_of_chatroom(self.initial_chatroom_id)
+        return index if index is not None else 0
+
+    @property
+    def sorted_user_gpt_contexts(self) -> list[UserGptContext | UserGptContextStub]:
         return self.sorted_contexts
 
     @property
@@ -1,17 +1,46 @@
+from dataclasses import dataclass
+from typing import Any, Callable
+
 from orjson import dumps as orjson_dumps
 from orjson import loads as orjson_loads
+from redis.exceptions import WatchError
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.future import select
 
 from app.exceptions import ChatroomNotFound, MySQLConnectionError
+from app.globals import CONTEXT_STORAGE_FORMAT
+from app.logger import api_logger
 from database import cache, db, models
+from gpt.cache_scripts import APPEND_AND_TRIM, HSET_IF_EXISTS
 from gpt.common import (
     GptRoles,
     LLMModels,
     MessageHistory,
     UserGptContext,
+    UserGptContextStub,
     UserGptProfile,
+    describe_usage,
 )
+from gpt.context_cache import context_cache
+from gpt.context_codec import CompactContextCodec
+
+
+@dataclass
+class ContextSyncResult:
+    """
+    Result of syncing a context to cache
+        - success: whether every write succeeded
+        - commands: number of commands sent
+        - bytes: number of payload bytes sent
+        - commands_saved: commands saved compared to rewriting the whole context
+        - bytes_saved: payload bytes saved compared to rewriting the whole context
+    """
+
+    success: bool = True
+    commands: int = 0
+    bytes: int = 0
+    commands_saved: int = 0
+    bytes_saved: int = 0
 
 
 class ChatGptCacheManager:
@@ -22,11 +51,27 @@ class ChatGptCacheManager:
     _list_fields: tuple[str] = tuple(
         f"{role.name.lower()}_message_histories" for role in GptRoles
     )
+    # "list": one key per field, "compact": one hash per chatroom (see gpt/context_codec.py)
+    storage_format: str = CONTEXT_STORAGE_FORMAT
+    # registered on first use, since redis client is created on startup
+    _append_and_trim_script = None
 
     @staticmethod
     def _generate_key(user_id: int, chatroom_id: int, field: str) -> str:
         return f"chatgpt:{user_id}:{chatroom_id}:{field}"
 
+    @classmethod
+    def _get_compact_key(cls, user_id: int, chatroom_id: int) -> str:
+        return cls._generate_key(user_id, chatroom_id, "context")
+
+    @classmethod
+    def _get_token_sums_key(cls, user_id: int, chatroom_id: int) -> str:
+        return cls._generate_key(user_id, chatroom_id, "message_tokens")
+
+    @classmethod
+    def _is_compact(cls) -> bool:
+        return cls.storage_format == "compact"
+
     @classmethod
     def _get_string_fields(cls, user_id: int, chatroom_id: int) -> dict[str, str]:
         return {
@@ -41,6 +86,73 @@ class ChatGptCacheManager:
             for field in cls._list_fields
         }
 
+    @staticmethod
+    def _remember(
+        user_gpt_context: UserGptContext, field: str, value: bytes | list
+    ) -> None:
+        """
+        Remember digests of what is persisted for the field of context.
+        value is encoded bytes for string fields, and a list of (uuid, encoded bytes) for list fields.
+        """
+        user_gpt_context._persisted[field] = (
+            hash(value)
+            if isinstance(value, bytes)
+            else [(uuid, hash(encoded)) for uuid, encoded in value]
+        )
+
+    @staticmethod
+    def _queue_hset_if_exists(pipe, key: str, mapping: dict) -> int:
+        """
+        Queue writing fields of hash, only if the hash exists when it's run
+        :return: index of the command, whose result is 1 if fields are written
+        """
+        pipe.eval(
+            HSET_IF_EXISTS,
+            1,
+            key,
+            *[item for field_and_value in mapping.items() for item in field_and_value],
+        )
+        return len(pipe) - 1
+
+    @staticmethod
+    def _queue_invalidation(pipe, user_id: int | str, chatroom_id: int | str) -> None:
+        """Queue telling other workers to drop chatroom from their context cache"""
+        pipe.publish(
+            context_cache.config.invalidation_channel,
+            context_cache.invalidation_message(user_id, chatroom_id),
+        )
+
+    @classmethod
+    def _queue_token_sums(cls, pipe, user_gpt_context: UserGptContext) -> None:
+        """Queue writing running token sums of every role, kept alongside the lists"""
+        pipe.hset(
+            cls._get_token_sums_key(
+                user_gpt_context.user_id, user_gpt_context.chatroom_id
+            ),
+            mapping={
+                role.name.lower(): getattr(
+                    user_gpt_context, f"{role.name.lower()}_message_tokens"
+                )
+                for role in GptRoles
+            },
+        )
+
+    @classmethod
+    async def _invalidate(cls, user_id: int | str, chatroom_id: int | str) -> None:
+        """
+        Drop chatroom from context cache of every worker.
+        Token sums are dropped too, since lists were written without updating them.
+        """
+        context_cache.invalidate(user_id, chatroom_id)
+        async with cache.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(cls._get_token_sums_key(user_id, chatroom_id))  # type: ignore
+            pipe.hdel(
+                cls._get_compact_key(user_id, chatroom_id),  # type: ignore
+                CompactContextCodec.token_sums_field,
+            )
+            cls._queue_invalidation(pipe, user_id, chatroom_id)
+            await pipe.execute()
+
     @classmethod
     async def get_all_chatrooms(cls, user_id: int) -> list[int]:
         """
@@ -62,82 +174,418 @@ class ChatGptCacheManager:
                 "MySQL connection error. Please try again later."
             )
 
+    @staticmethod
+    def _parse_token_sums(stored_tokens: dict[bytes, bytes]) -> dict[str, int] | None:
+        """Token totals of roles read from token sums hash, or None if they are not all known"""
+        message_tokens: dict[str, int] = {
+            role.decode(): int(tokens) for role, tokens in stored_tokens.items()
+        }
+        if any([role.name.lower() not in message_tokens for role in GptRoles]):
+            return None
+        return message_tokens
+
     @classmethod
-    async def read_context(cls, user_id: int, chatroom_id: int) -> UserGptContext:
-        stored_string: dict[str, str | None] = {
-            field: await cache.redis.get(key)
-            for field, key in cls._get_string_fields(user_id, chatroom_id).items()
+    def _parse_context(
+        cls,
+        stored_string: dict[str, bytes | None],
+        stored_list: dict[str, list | None],
+        stored_tokens: dict[bytes, bytes] | None = None,
+    ) -> UserGptContext | None:
+        """
+        Build context from raw values read from redis
+        :return: None if any of stored strings are None, which means context does not exist
+        """
+        if any([value is None for value in stored_string.values()]):
+            return None
+        parsed_string: dict = {
+            field: orjson_loads(value) for field, value in stored_string.items()
         }
-        stored_list: dict[str, list | None] = {
-            field: await cache.redis.lrange(key, 0, -1)
-            for field, key in cls._get_list_fields(user_id, chatroom_id).items()
+        parsed_list: dict[str, list[MessageHistory]] = {
+            field: [MessageHistory(**orjson_loads(v)) for v in value]
+            if value is not None
+            else []
+            for field, value in stored_list.items()
         }
+        context = UserGptContext(
+            user_gpt_profile=UserGptProfile(**parsed_string["user_gpt_profile"]),
+            gpt_model=LLMModels._member_map_[parsed_string["gpt_model"]],  # type: ignore
+            user_message_histories=parsed_list["user_message_histories"],
+            gpt_message_histories=parsed_list["gpt_message_histories"],
+            system_message_histories=parsed_list["system_message_histories"],
+            message_tokens=cls._parse_token_sums(stored_tokens)
+            if stored_tokens
+            else None,
+        )
+        for field, value in stored_string.items():
+            cls._remember(context, field, value)  # type: ignore
+        for field, value in stored_list.items():
+            cls._remember(
+                context,
+                field,
+                [(m.uuid, v) for m, v in zip(parsed_list[field], value or [])],
+            )
+        return context
 
-        # if any of stored strings are None, create new context
-        if any([value is None for value in stored_string.values()]):
-            default: UserGptContext = UserGptContext.construct_default(
-                user_id=user_id,
-                chatroom_id=chatroom_id,
+    @classmethod
+    def _parse_compact_context(
+        cls, stored: dict[bytes, bytes]
+    ) -> UserGptContext | None:
+        """
+        Build context from hash stored in compact format
+        :return: None if hash doesn't hold a whole context
+        """
+        context: UserGptContext | None = CompactContextCodec.decode(stored)
+        if context is not None:
+            for field in (
+                cls._string_fields
+                + cls._list_fields
+                + (CompactContextCodec.token_sums_field,)
+            ):
+                cls._remember(context, field, stored.get(field.encode(), b""))
+        return context
+
+    @classmethod
+    def _queue_read(
+        cls, pipe, user_id: int, chatroom_id: int, storage_format: str
+    ) -> None:
+        if storage_format == "compact":
+            pipe.hgetall(cls._get_compact_key(user_id, chatroom_id))
+            return
+        for key in cls._get_string_fields(user_id, chatroom_id).values():
+            pipe.get(key)
+        for key in cls._get_list_fields(user_id, chatroom_id).values():
+            pipe.lrange(key, 0, -1)
+        pipe.hgetall(cls._get_token_sums_key(user_id, chatroom_id))
+
+    @classmethod
+    def _parse_read(cls, stored: list, storage_format: str) -> UserGptContext | None:
+        if storage_format == "compact":
+            return cls._parse_compact_context(stored[0])
+        n_string_fields: int = len(cls._string_fields)
+        n_list_fields: int = len(cls._list_fields)
+        return cls._parse_context(
+            stored_string=dict(zip(cls._string_fields, stored[:n_string_fields])),
+            stored_list=dict(
+                zip(
+                    cls._list_fields,
+                    stored[n_string_fields : n_string_fields + n_list_fields],
+                )
+            ),
+            stored_tokens=stored[n_string_fields + n_list_fields],
+        )
+
+    @classmethod
+    async def read_context(cls, user_id: int, chatroom_id: int) -> UserGptContext:
+        return (await cls.read_contexts(user_id=user_id, chatroom_ids=[chatroom_id]))[0]
+
+    @classmethod
+    async def read_contexts(
+        cls, user_id: int, chatroom_ids: list[int]
+    ) -> list[UserGptContext]:
+        """
+        Read contexts of many chatrooms in a single round trip.
+        Contexts kept in memory by context cache are not read from redis.
+        :param user_id: user id
+        :param chatroom_ids: list of chatroom ids
+        :return: list of contexts, in the same order as chatroom_ids
+        """
+        cached: dict[int, UserGptContext | None] = {
+            chatroom_id: context_cache.get(user_id, chatroom_id)
+            for chatroom_id in chatroom_ids
+        }
+        missing_ids: list[int] = [
+            chatroom_id for chatroom_id, context in cached.items() if context is None
+        ]
+        if missing_ids:
+            storage_format: str = cls.storage_format
+            async with cache.redis.pipeline(transaction=False) as pipe:
+                for chatroom_id in missing_ids:
+                    cls._queue_read(pipe, user_id, chatroom_id, storage_format)
+                results: list = await pipe.execute()
+
+            n_commands: int = len(results) // len(missing_ids)
+            defaults: list[UserGptContext] = []
+            for idx, chatroom_id in enumerate(missing_ids):
+                context: UserGptContext | None = cls._parse_read(
+                    results[idx * n_commands : (idx + 1) * n_commands], storage_format
+                )
+                if context is None:
+                    # if any of stored strings are None, create new context
+                    context = UserGptContext.construct_default(
+                        user_id=user_id,
+                        chatroom_id=chatroom_id,
+                    )
+                    defaults.append(context)
+                else:
+                    context_cache.put(context)
+                cached[chatroom_id] = context
+            if defaults:
+                await cls.create_contexts(defaults)
+        return [cached[chatroom_id] for chatroom_id in chatroom_ids]  # type: ignore
+
+    @classmethod
+    def _queue_summary_read(cls, pipe, user_id: int, chatroom_id: int) -> None:
+        """Queue reading profile, model and token totals of chatroom, but not its histories"""
+        if cls._is_compact():
+            pipe.hmget(
+                cls._get_compact_key(user_id, chatroom_id),
+                [*cls._string_fields, CompactContextCodec.token_sums_field],
             )
-            await cls.create_context(default)
-            return default
+            return
+        for key in cls._get_string_fields(user_id, chatroom_id).values():
+            pipe.get(key)
+        pipe.hgetall(cls._get_token_sums_key(user_id, chatroom_id))
 
-        for field, value in stored_string.items():
-            if value is not None:
-                stored_string[field] = orjson_loads(value)
-        for field, value in stored_list.items():
-            if value is not None:
-                stored_list[field] = [orjson_loads(v) for v in value]
-
-        return UserGptContext(
-            user_gpt_profile=UserGptProfile(**stored_string["user_gpt_profile"]),  # type: ignore
-            gpt_model=LLMModels._member_map_[stored_string["gpt_model"]],  # type: ignore
-            user_message_histories=[
-                MessageHistory(**m) for m in stored_list["user_message_histories"]
-            ]
-            if stored_list["user_message_histories"] is not None
-            else [],
-            gpt_message_histories=[
-                MessageHistory(**m) for m in stored_list["gpt_message_histories"]
-            ]
-            if stored_list["gpt_message_histories"] is not None
-            else [],
-            system_message_histories=[
-                MessageHistory(**m) for m in stored_list["system_message_histories"]
-            ]
-            if stored_list["system_message_histories"] is not None
-            else [],
+    @classmethod
+    def _parse_summary(
+        cls, stored: list
+    ) -> tuple[UserGptProfile | None, LLMModels | None, dict[str, int] | None]:
+        """
+        Parse what _queue_summary_read has read
+        :return: profile, model and token totals, each of which is None if not stored
+        """
+        if cls._is_compact():
+            *stored_string, stored_tokens = stored[0]
+            message_tokens: dict[str, int] | None = (
+                orjson_loads(stored_tokens) if stored_tokens is not None else None
+            )
+        else:
+            *stored_string, stored_hash = stored
+            message_tokens = cls._parse_token_sums(stored_hash) if stored_hash else None
+        profile, gpt_model = [
+            orjson_loads(value) if value is not None else None
+            for value in stored_string
+        ]
+        return (
+            UserGptProfile(**profile) if profile is not None else None,
+            LLMModels._member_map_[gpt_model]  # type: ignore
+            if gpt_model is not None
+            else None,
+            message_tokens,
         )
 
     @classmethod
-    async def create_context(
+    async def read_context_stubs(
+        cls, user_id: int, chatroom_ids: list[int]
+    ) -> list[UserGptContextStub]:
+        """
+        Read only profiles and token totals of many chatrooms in a single round trip,
+        without message histories.
+        Contexts kept in memory by context cache are not read from redis.
+        :param user_id: user id
+        :param chatroom_ids: list of chatroom ids
+        :return: list of context stubs, in the same order as chatroom_ids
+        """
+        stubs: dict[int, UserGptContextStub] = {}
+        missing_ids: list[int] = []
+        for chatroom_id in chatroom_ids:
+            context: UserGptContext | None = context_cache.get(user_id, chatroom_id)
+            if context is None:
+                missing_ids.append(chatroom_id)
+            else:
+                stubs[chatroom_id] = UserGptContextStub.from_context(context)
+        if missing_ids:
+            async with cache.redis.pipeline(transaction=False) as pipe:
+                for chatroom_id in missing_ids:
+                    cls._queue_summary_read(pipe, user_id, chatroom_id)
+                results: list = await pipe.execute()
+            n_commands: int = len(results) // len(missing_ids)
+            for idx, chatroom_id in enumerate(missing_ids):
+                profile, _, message_tokens = cls._parse_summary(
+                    results[idx * n_commands : (idx + 1) * n_commands]
+                )
+                if profile is None:
+                    # context is created with a default profile when it's loaded
+                    profile = UserGptProfile(user_id=user_id, chatroom_id=chatroom_id)
+                stubs[chatroom_id] = UserGptContextStub(
+                    user_id=user_id,
+                    chatroom_id=chatroom_id,
+                    created_at=profile.created_at,
+                    **{
+                        f"{role}_message_tokens": tokens
+                        for role, tokens in (message_tokens or {}).items()
+                    },
+                )
+        return [stubs[chatroom_id] for chatroom_id in chatroom_ids]
+
+    @classmethod
+    async def read_usage(cls, user_id: int, chatroom_id: int) -> str:
+        """
+        Describe profile, model and token usage of chatroom.
+        Message histories are decoded only if token totals are not persisted.
+        """
+        context: UserGptContext | None = context_cache.get(user_id, chatroom_id)
+        if context is None:
+            async with cache.redis.pipeline(transaction=False) as pipe:
+                cls._queue_summary_read(pipe, user_id, chatroom_id)
+                profile, gpt_model, message_tokens = cls._parse_summary(
+                    await pipe.execute()
+                )
+            if (
+                profile is not None
+                and gpt_model is not None
+                and message_tokens is not None
+            ):
+                return describe_usage(
+                    user_gpt_profile=profile,
+                    gpt_model=gpt_model,
+                    message_tokens=message_tokens,
+                )
+            context = await cls.read_context(user_id=user_id, chatroom_id=chatroom_id)
+        return describe_usage(
+            user_gpt_profile=context.user_gpt_profile,
+            gpt_model=context.gpt_model,
+            message_tokens=context.message_tokens_of_roles,
+        )
+
+    @classmethod
+    def _queue_compact_context_creation(
         cls,
+        pipe,
         user_gpt_context: UserGptContext,
         only_if_exists: bool = False,
         only_if_not_exists: bool = True,
-    ) -> bool:
+    ) -> tuple[list[int], dict[str, bytes | list]]:
+        """
+        Queue commands for writing a whole context as a compact hash into pipeline.
+        With only_if_exists, nothing is written if the hash doesn't exist when it's run.
+        :return: indices of commands whose results must be truthy for success,
+            and values to remember once they are
+        """
+        key: str = cls._get_compact_key(
+            user_gpt_context.user_id, user_gpt_context.chatroom_id
+        )
+        encoded: dict[str, bytes] = CompactContextCodec.encode(user_gpt_context)
+        if only_if_exists:
+            return [
+                cls._queue_hset_if_exists(
+                    pipe,
+                    key,
+                    {CompactContextCodec.version_field: CompactContextCodec.version}
+                    | encoded,
+                )
+            ], encoded  # type: ignore
+        checked: list[int] = []
+        for field in cls._string_fields:
+            if only_if_not_exists:
+                pipe.hsetnx(key, field, encoded[field])
+                checked.append(len(pipe) - 1)
+            else:
+                pipe.hset(key, field, encoded[field])
+        pipe.hset(
+            key,
+            mapping={CompactContextCodec.version_field: CompactContextCodec.version}
+            | {
+                field: encoded[field]
+                for field in cls._list_fields + (CompactContextCodec.token_sums_field,)
+            },
+        )
+        return checked, encoded  # type: ignore
+
+    @classmethod
+    def _queue_context_creation(
+        cls,
+        pipe,
+        user_gpt_context: UserGptContext,
+        only_if_exists: bool = False,
+        only_if_not_exists: bool = True,
+    ) -> tuple[list[int], dict[str, bytes | list]]:
+        """
+        Queue commands for writing a whole context into pipeline
+        :return: indices of commands whose results must be truthy for success,
+            and values to remember once they are
+        """
+        if cls._is_compact():
+            return cls._queue_compact_context_creation(
+                pipe,
+                user_gpt_context,
+                only_if_exists=only_if_exists,
+                only_if_not_exists=only_if_not_exists,
+            )
         json_data = user_gpt_context.json()
-        success: bool = True
+        checked: list[int] = []
+        persisted: dict[str, bytes | list] = {}
         for field, key in cls._get_string_fields(
             user_gpt_context.user_id, user_gpt_context.chatroom_id
         ).items():
-            result = await cache.redis.set(
+            encoded: bytes = orjson_dumps(json_data[field])
+            pipe.set(
                 key,
-                orjson_dumps(json_data[field]),
+                encoded,
                 xx=only_if_exists,
                 nx=only_if_not_exists,
             )
-            success &= bool(result)
+            checked.append(len(pipe) - 1)
+            persisted[field] = encoded
         for field, key in cls._get_list_fields(
             user_gpt_context.user_id, user_gpt_context.chatroom_id
         ).items():
-            result = await cache.redis.delete(key)
-            for item in json_data[field]:
-                result = await cache.redis.rpush(key, orjson_dumps(item))
-                success &= bool(result)
+            encoded_list: list[bytes] = [
+                orjson_dumps(item) for item in json_data[field]
+            ]
+            pipe.delete(key)
+            if encoded_list:
+                pipe.rpush(key, *encoded_list)
+                checked.append(len(pipe) - 1)
+            persisted[field] = [
+                (item["uuid"], v) for item, v in zip(json_data[field], encoded_list)
+            ]
+        cls._queue_token_sums(pipe, user_gpt_context)
+        return checked, persisted
 
+    @classmethod
+    async def create_contexts(
+        cls,
+        user_gpt_contexts: list[UserGptContext],
+        only_if_exists: bool = False,
+        only_if_not_exists: bool = True,
+    ) -> bool:
+        """
+        Write many contexts atomically, in a single round trip.
+        What is persisted is remembered only for contexts whose writes succeeded.
+        """
+        queued: list[tuple[list[int], dict[str, bytes | list]]] = []
+        async with cache.redis.pipeline(transaction=True) as pipe:
+            for user_gpt_context in user_gpt_contexts:
+                queued.append(
+                    cls._queue_context_creation(
+                        pipe,
+                        user_gpt_context,
+                        only_if_exists=only_if_exists,
+                        only_if_not_exists=only_if_not_exists,
+                    )
+                )
+                cls._queue_invalidation(
+                    pipe, user_gpt_context.user_id, user_gpt_context.chatroom_id
+                )
+            results: list = await pipe.execute()
+        success: bool = True
+        for user_gpt_context, (checked, persisted) in zip(user_gpt_contexts, queued):
+            if all([bool(results[idx]) for idx in checked]):
+                for field, value in persisted.items():
+                    cls._remember(user_gpt_context, field, value)
+                context_cache.put(user_gpt_context)
+            else:
+                success = False
+                user_gpt_context._persisted.clear()
+                context_cache.invalidate(
+                    user_gpt_context.user_id, user_gpt_context.chatroom_id
+                )
         return success
 
+    @classmethod
+    async def create_context(
+        cls,
+        user_gpt_context: UserGptContext,
+        only_if_exists: bool = False,
+        only_if_not_exists: bool = True,
+    ) -> bool:
+        return await cls.create_contexts(
+            [user_gpt_context],
+            only_if_exists=only_if_exists,
+            only_if_not_exists=only_if_not_exists,
+        )
+
     @classmethod
     async def reset_context(
         cls,
@@ -161,41 +609,383 @@ class ChatGptCacheManager:
         user_gpt_context: UserGptContext,
         only_if_exists: bool = True,
     ) -> bool:
+        return (
+            await cls.sync_context(user_gpt_context, only_if_exists=only_if_exists)
+        ).success
+
+    @classmethod
+    def _queue_list_diff(
+        cls,
+        pipe,
+        key: str,
+        persisted: list[tuple[str, int]] | None,
+        message_histories: list[MessageHistory],
+        encoded_list: list[bytes],
+        result: ContextSyncResult,
+    ) -> list[int]:
+        """
+        Queue commands turning persisted list into message_histories, into pipeline.
+        Popped heads and tails are trimmed with LTRIM, edited messages are LSET,
+        and appended messages are sent with a single RPUSH.
+        :return: indices of commands whose results must be truthy for success
+        """
+        checked: list[int] = []
+        if persisted is None:
+            # nothing known about what is persisted, so rewrite the whole list
+            pipe.delete(key)
+            result.commands += 1
+            kept: int = 0
+        else:
+            persisted_uuids: list[str] = [uuid for uuid, _ in persisted]
+            try:
+                start: int = (
+                    persisted_uuids.index(message_histories[0].uuid)
+                    if message_histories
+                    else len(persisted)
+                )
+            except ValueError:
+                start = len(persisted)
+            kept = 0
+            while (
+                kept < len(message_histories)
+                and start + kept < len(persisted)
+                and persisted_uuids[start + kept] == message_histories[kept].uuid
+            ):
+                kept += 1
+            if kept == 0 and persisted:
+                pipe.delete(key)
+                result.commands += 1
+            elif kept < len(persisted):
+                pipe.ltrim(key, start, start + kept - 1)
+                result.commands += 1
+            for idx in range(kept):
+                if persisted[start + idx][1] != hash(encoded_list[idx]):
+                    pipe.lset(key, idx, encoded_list[idx])
+                    checked.append(len(pipe) - 1)
+                    result.commands += 1
+                    result.bytes += len(encoded_list[idx])
+        if encoded_list[kept:]:
+            pipe.rpush(key, *encoded_list[kept:])
+            checked.append(len(pipe) - 1)
+            result.commands += 1
+            result.bytes += sum([len(encoded) for encoded in encoded_list[kept:]])
+        # rewriting the whole list costs one DEL and one RPUSH per message
+        result.commands_saved += 1 + len(encoded_list)
+        result.bytes_saved += sum([len(encoded) for encoded in encoded_list])
+        return checked
+
+    @classmethod
+    async def sync_context(
+        cls,
+        user_gpt_context: UserGptContext,
+        only_if_exists: bool = True,
+    ) -> ContextSyncResult:
+        """
+        Write only what has changed since the context was last read or synced,
+        atomically in a single MULTI/EXEC round trip.
+        Syncs of a context wait for each other, so each diffs against what the previous one persisted.
+        """
+        async with user_gpt_context._sync_lock:
+            return await cls._sync_context(
+                user_gpt_context, only_if_exists=only_if_exists
+            )
+
+    @classmethod
+    async def _sync_context(
+        cls,
+        user_gpt_context: UserGptContext,
+        only_if_exists: bool = True,
+    ) -> ContextSyncResult:
+        if cls._is_compact():
+            return await cls._sync_compact_context(
+                user_gpt_context, only_if_exists=only_if_exists
+            )
         json_data = user_gpt_context.json()
-        success = True
-        for field, key in cls._get_string_fields(
-            user_gpt_context.user_id,
-            user_gpt_context.chatroom_id,
-        ).items():
-            result = await cache.redis.set(
-                key,
-                orjson_dumps(json_data[field]),
-                xx=only_if_exists,
+        encoded_strings: dict[str, bytes] = {
+            field: orjson_dumps(json_data[field]) for field in cls._string_fields
+        }
+        encoded_lists: dict[str, list[bytes]] = {
+            field: [orjson_dumps(item) for item in json_data[field]]
+            for field in cls._list_fields
+        }
+        result = ContextSyncResult()
+        checked: list[int] = []
+        async with cache.redis.pipeline(transaction=True) as pipe:
+            for field, key in cls._get_string_fields(
+                user_gpt_context.user_id,
+                user_gpt_context.chatroom_id,
+            ).items():
+                encoded: bytes = encoded_strings[field]
+                if user_gpt_context._persisted.get(field) != hash(encoded):
+                    pipe.set(key, encoded, xx=only_if_exists)
+                    checked.append(len(pipe) - 1)
+                    result.commands += 1
+                    result.bytes += len(encoded)
+                result.commands_saved += 1
+                result.bytes_saved += len(encoded)
+            n_string_commands: int = len(pipe)
+            for field, key in cls._get_list_fields(
+                user_gpt_context.user_id,
+                user_gpt_context.chatroom_id,
+            ).items():
+                checked += cls._queue_list_diff(
+                    pipe,
+                    key=key,
+                    persisted=user_gpt_context._persisted.get(field),
+                    message_histories=getattr(user_gpt_context, field),
+                    encoded_list=encoded_lists[field],
+                    result=result,
+                )
+            if len(pipe) > n_string_commands:
+                cls._queue_token_sums(pipe, user_gpt_context)
+            if len(pipe) > 0:
+                cls._queue_invalidation(
+                    pipe, user_gpt_context.user_id, user_gpt_context.chatroom_id
+                )
+            results: list = await pipe.execute() if len(pipe) > 0 else []
+        result.success = all([bool(results[idx]) for idx in checked])
+        result.commands_saved -= result.commands
+        result.bytes_saved -= result.bytes
+        if result.success:
+            for field in cls._string_fields:
+                cls._remember(user_gpt_context, field, encoded_strings[field])
+            for field in cls._list_fields:
+                cls._remember(
+                    user_gpt_context,
+                    field,
+                    [
+                        (item["uuid"], encoded)
+                        for item, encoded in zip(json_data[field], encoded_lists[field])
+                    ],
+                )
+            context_cache.put(user_gpt_context)
+        else:
+            # state of cache is unknown, so rewrite everything on next sync
+            user_gpt_context._persisted.clear()
+            context_cache.invalidate(
+                user_gpt_context.user_id, user_gpt_context.chatroom_id
             )
-            success &= bool(result)
-        for field, key in cls._get_list_fields(
-            user_gpt_context.user_id,
-            user_gpt_context.chatroom_id,
-        ).items():
-            result = await cache.redis.delete(key)
-            success &= bool(result)
-            for item in json_data[field]:
-                result = await cache.redis.rpush(key, orjson_dumps(item))
-                success &= bool(result)
-        return success
+        api_logger.debug(f"Synced context: {result}")
+        return result
 
     @classmethod
-    async def delete_chatroom(cls, user_id: int, chatroom_id: int) -> int:
+    async def _sync_compact_context(
+        cls,
+        user_gpt_context: UserGptContext,
+        only_if_exists: bool = True,
+    ) -> ContextSyncResult:
+        """Write only the hash fields that have changed, in a single HSET"""
+        key: str = cls._get_compact_key(
+            user_gpt_context.user_id, user_gpt_context.chatroom_id
+        )
+        encoded: dict[str, bytes] = CompactContextCodec.encode(user_gpt_context)
+        changed: dict[str, bytes] = {
+            field: value
+            for field, value in encoded.items()
+            if user_gpt_context._persisted.get(field) != hash(value)
+        }
+        result = ContextSyncResult(
+            commands_saved=1, bytes_saved=sum([len(v) for v in encoded.values()])
+        )
+        results: list = []
+        if changed:
+            async with cache.redis.pipeline(transaction=True) as pipe:
+                if only_if_exists:
+                    cls._queue_hset_if_exists(pipe, key, changed)
+                else:
+                    pipe.hset(key, mapping=changed)
+                cls._queue_invalidation(
+                    pipe, user_gpt_context.user_id, user_gpt_context.chatroom_id
+                )
+                results = await pipe.execute()
+            result.commands = 1
+            result.bytes = sum([len(v) for v in changed.values()])
+        result.success = bool(results[0]) if changed and only_if_exists else True
+        result.commands_saved -= result.commands
+        result.bytes_saved -= result.bytes
+        if result.success:
+            for field, value in changed.items():
+                cls._remember(user_gpt_context, field, value)
+            context_cache.put(user_gpt_context)
+        else:
+            user_gpt_context._persisted.clear()
+            context_cache.invalidate(
+                user_gpt_context.user_id, user_gpt_context.chatroom_id
+            )
+        api_logger.debug(f"Synced compact context: {result}")
+        return result
+
+    @classmethod
+    async def migrate_to_compact(cls, user_id: int, chatroom_id: int) -> bool:
         """
-        Delete all keys starting with "chatgpt:{user_id}:{chatroom_id}:
+        Convert context stored with one key per field into a compact hash,
+        and delete the old keys, atomically.
+        Old keys are watched while they're read, and conversion is retried
+        if any of them is changed before the compact hash is written, so a server may keep running.
+        :return: whether there was a context to convert
         """
-        keys = [
-            key
-            async for key in cache.redis.scan_iter(f"chatgpt:{user_id}:{chatroom_id}:*")
+        legacy_keys: list[str] = [
+            *cls._get_string_fields(user_id, chatroom_id).values(),
+            *cls._get_list_fields(user_id, chatroom_id).values(),
+            cls._get_token_sums_key(user_id, chatroom_id),
         ]
-        if not keys:
+        while True:
+            async with cache.redis.pipeline(transaction=True) as pipe:
+                await pipe.watch(*legacy_keys)
+                async with cache.redis.pipeline(transaction=False) as read_pipe:
+                    cls._queue_read(read_pipe, user_id, chatroom_id, "list")
+                    stored: list = await read_pipe.execute()
+                context: UserGptContext | None = cls._parse_read(stored, "list")
+                if context is None:
+                    return False
+                encoded: dict[str, bytes] = CompactContextCodec.encode(context)
+                pipe.multi()
+                pipe.delete(*legacy_keys)
+                pipe.hset(
+                    cls._get_compact_key(user_id, chatroom_id),
+                    mapping={
+                        CompactContextCodec.version_field: CompactContextCodec.version
+                    }
+                    | encoded,
+                )
+                cls._queue_invalidation(pipe, user_id, chatroom_id)
+                try:
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    api_logger.debug(
+                        f"Context of {user_id}:{chatroom_id} changed while migrating, retrying"
+                    )
+        context_cache.invalidate(user_id, chatroom_id)
+        return True
+
+    @classmethod
+    def _get_all_keys(cls, user_id: int, chatroom_id: int) -> list[str]:
+        """Every key a chatroom may be stored under, in either storage format"""
+        return [
+            *cls._get_string_fields(user_id, chatroom_id).values(),
+            *cls._get_list_fields(user_id, chatroom_id).values(),
+            cls._get_token_sums_key(user_id, chatroom_id),
+            cls._get_compact_key(user_id, chatroom_id),
+        ]
+
+    @classmethod
+    async def delete_chatroom(cls, user_id: int, chatroom_id: int) -> int:
+        """
+        Delete all keys of chatroom
+        :return: number of keys deleted
+        """
+        return await cls.delete_chatrooms(user_id=user_id, chatroom_ids=[chatroom_id])
+
+    @classmethod
+    async def delete_chatrooms(cls, user_id: int, chatroom_ids: list[int]) -> int:
+        """
+        Delete all keys of many chatrooms in a single round trip,
+        without scanning keyspace, since keys of a chatroom are deterministic.
+        :return: number of keys deleted
+        """
+        if not chatroom_ids:
             return 0
-        return await cache.redis.delete(*keys)
+        async with cache.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(
+                *[
+                    key
+                    for chatroom_id in chatroom_ids
+                    for key in cls._get_all_keys(user_id, chatroom_id)
+                ]
+            )
+            for chatroom_id in chatroom_ids:
+                cls._queue_invalidation(pipe, user_id, chatroom_id)
+            results: list = await pipe.execute()
+        for chatroom_id in chatroom_ids:
+            context_cache.invalidate(user_id, chatroom_id)
+        return results[0]
+
+    @classmethod
+    async def delete_all_chatrooms(cls, user_id: int) -> int:
+        """
+        Delete all keys of every chatroom of user, e.g. when the account is deleted
+        :return: number of keys deleted
+        """
+        try:
+            chatroom_ids: list[int] = await cls.get_all_chatrooms(user_id=user_id)
+        except ChatroomNotFound:
+            return 0
+        return await cls.delete_chatrooms(user_id=user_id, chatroom_ids=chatroom_ids)
+
+    @classmethod
+    async def append_and_trim_message_history(
+        cls, user_gpt_context: UserGptContext, role: GptRoles | str
+    ) -> int | None:
+        """
+        Push the last message history of role, which is already appended in memory,
+        and evict the oldest user and gpt message pairs until token window fits,
+        in a single atomic script call. The same pairs are evicted in memory.
+        :return: number of evicted pairs,
+            or None if the context must be synced instead, in compact format
+            or when the lists in memory differ from what is persisted besides the appended message.
+        """
+        async with user_gpt_context._sync_lock:
+            return await cls._append_and_trim_message_history(user_gpt_context, role)
+
+    @classmethod
+    async def _append_and_trim_message_history(
+        cls, user_gpt_context: UserGptContext, role: GptRoles | str
+    ) -> int | None:
+        role = GptRoles.get_name(role).lower()
+        role_field: str = f"{role}_message_histories"
+        message_histories: list[MessageHistory] = getattr(user_gpt_context, role_field)
+        if cls._is_compact() or not message_histories:
+            return None
+        for field in cls._list_fields:
+            persisted: list | None = user_gpt_context._persisted.get(field)
+            in_memory: list[MessageHistory] = getattr(user_gpt_context, field)
+            if field == role_field:
+                in_memory = in_memory[:-1]
+            if persisted is None or [uuid for uuid, _ in persisted] != [
+                m.uuid for m in in_memory
+            ]:
+                return None
+        if cls._append_and_trim_script is None:
+            cls._append_and_trim_script = cache.redis.register_script(APPEND_AND_TRIM)
+        user_id, chatroom_id = user_gpt_context.user_id, user_gpt_context.chatroom_id
+        message_history: MessageHistory = message_histories[-1]
+        encoded: bytes = orjson_dumps(message_history.__dict__)
+        gpt_model = user_gpt_context.gpt_model.value
+        evicted: int = await cls._append_and_trim_script(
+            keys=[
+                cls._generate_key(user_id, chatroom_id, role_field),
+                *[
+                    cls._generate_key(user_id, chatroom_id, f"{r}_message_histories")
+                    for r in ("user", "gpt", "system")
+                ],
+                cls._get_token_sums_key(user_id, chatroom_id),
+            ],
+            args=[
+                encoded,
+                role,
+                message_history.tokens,
+                gpt_model.max_total_tokens
+                - gpt_model.token_margin
+                - int(getattr(gpt_model, "description_tokens", 0)),
+                context_cache.config.invalidation_channel,
+                context_cache.invalidation_message(user_id, chatroom_id),
+            ],
+        )
+        user_gpt_context._persisted[role_field].append(
+            (message_history.uuid, hash(encoded))
+        )
+        for _ in range(evicted):
+            for r in ("user", "gpt"):
+                setattr(
+                    user_gpt_context,
+                    f"{r}_message_tokens",
+                    getattr(user_gpt_context, f"{r}_message_tokens")
+                    - getattr(user_gpt_context, f"{r}_message_histories").pop(0).tokens,
+                )
+                user_gpt_context._persisted[f"{r}_message_histories"].pop(0)
+        context_cache.put(user_gpt_context)
+        return evicted
 
     @classmethod
     async def update_profile_and_model(
@@ -203,20 +993,64 @@ class ChatGptCacheManager:
         user_gpt_context: UserGptContext,
         only_if_exists: bool = True,
     ) -> bool:
-        json_data = user_gpt_context.json()
-        success = True
+        async with user_gpt_context._sync_lock:
+            json_data = user_gpt_context.json()
+            encoded: dict[str, bytes] = {
+                field: orjson_dumps(json_data[field]) for field in cls._string_fields
+            }
+            checked: list[int] = []
+            async with cache.redis.pipeline(transaction=True) as pipe:
+                if cls._is_compact():
+                    key: str = cls._get_compact_key(
+                        user_gpt_context.user_id, user_gpt_context.chatroom_id
+                    )
+                    if only_if_exists:
+                        checked.append(cls._queue_hset_if_exists(pipe, key, encoded))
+                    else:
+                        pipe.hset(key, mapping=encoded)
+                else:
+                    for field, key in cls._get_string_fields(
+                        user_gpt_context.user_id,
+                        user_gpt_context.chatroom_id,
+                    ).items():
+                        pipe.set(key, encoded[field], xx=only_if_exists)
+                        checked.append(len(pipe) - 1)
+                cls._queue_invalidation(
+                    pipe, user_gpt_context.user_id, user_gpt_context.chatroom_id
+                )
+                results: list = await pipe.execute()
+            success: bool = all([bool(results[idx]) for idx in checked])
+            if success:
+                for field, value in encoded.items():
+                    cls._remember(user_gpt_context, field, value)
+            else:
+                user_gpt_context._persisted.clear()
+            return success
 
-        for field, key in cls._get_string_fields(
-            user_gpt_context.user_id,
-            user_gpt_context.chatroom_id,
-        ).items():
-            result = await cache.redis.set(
-                key,
-                orjson_dumps(json_data[field]),
-                xx=only_if_exists,
-            )
-            success &= bool(result)
-        return success
+    @classmethod
+    async def _modify_compact_histories(
+        cls,
+        user_id: int,
+        chatroom_id: int,
+        role: str,
+        modify: Callable[[list[MessageHistory]], Any],
+    ) -> Any:
+        """
+        Decode message histories of a single role from compact hash,
+        apply modify on them and write them back
+        :return: return value of modify
+        """
+        key: str = cls._get_compact_key(user_id, chatroom_id)
+        field: str = f"{role}_message_histories"
+        message_histories: list[MessageHistory] = CompactContextCodec.decode_histories(
+            await cache.redis.hget(key, field)
+        )
+        result: Any = modify(message_histories)
+        await cache.redis.hset(
+            key, field, CompactContextCodec.encode_histories(message_histories)
+        )
+        await cls._invalidate(user_id, chatroom_id)
+        return result
 
     @classmethod
     async def update_message_histories(
@@ -227,6 +1061,14 @@ class ChatGptCacheManager:
         message_histories: list[MessageHistory],
     ) -> bool:
         role = GptRoles.get_name(role).lower()
+        if cls._is_compact():
+            await cls._modify_compact_histories(
+                user_id,
+                chatroom_id,
+                role,
+                lambda stored: stored.__setitem__(slice(None), message_histories),
+            )
+            return True
         key = cls._generate_key(user_id, chatroom_id, f"{role}_message_histories")
         message_histories_json = [
             orjson_dumps(message_history.__dict__)
@@ -234,8 +1076,27 @@ class ChatGptCacheManager:
         ]
         result = await cache.redis.delete(key)
         result &= await cache.redis.rpush(key, *message_histories_json)
+        await cls._invalidate(user_id, chatroom_id)
         return bool(result)
 
+    @staticmethod
+    def _pop_from(
+        message_histories: list[MessageHistory], count: int | None, rpop: bool
+    ) -> MessageHistory | list[MessageHistory] | None:
+        """Pop like LPOP/RPOP do, from message histories in memory"""
+        if not message_histories:
+            return None
+        if count is None:
+            return message_histories.pop() if rpop else message_histories.pop(0)
+        popped: list[MessageHistory] = (
+            message_histories[-count:][::-1] if rpop else message_histories[:count]
+        )
+        if rpop:
+            del message_histories[-count:]
+        else:
+            del message_histories[:count]
+        return popped
+
     @classmethod
     async def lpop_message_history(
         cls,
@@ -246,10 +1107,18 @@ class ChatGptCacheManager:
     ) -> MessageHistory | list[MessageHistory] | None:
         role = GptRoles.get_name(role).lower()
         assert count is None or count > 0
+        if cls._is_compact():
+            return await cls._modify_compact_histories(
+                user_id,
+                chatroom_id,
+                role,
+                lambda stored: cls._pop_from(stored, count=count, rpop=False),
+            )
         message_history_json: str | list | None = await cache.redis.lpop(
             cls._generate_key(user_id, chatroom_id, f"{role}_message_histories"),
             count=count,
         )
+        await cls._invalidate(user_id, chatroom_id)
         if message_history_json is None:
             return None
         # if message_history_json is instance of list, then it is a list of message histories
@@ -268,10 +1137,18 @@ class ChatGptCacheManager:
     ) -> MessageHistory | list[MessageHistory] | None:
         role = GptRoles.get_name(role).lower()
         assert count is None or count > 0
+        if cls._is_compact():
+            return await cls._modify_compact_histories(
+                user_id,
+                chatroom_id,
+                role,
+                lambda stored: cls._pop_from(stored, count=count, rpop=True),
+            )
         message_history_json = await cache.redis.rpop(
             cls._generate_key(user_id, chatroom_id, f"{role}_message_histories"),
             count=count,
         )
+        await cls._invalidate(user_id, chatroom_id)
         if message_history_json is None:
             return None
         # if message_history_json is instance of list, then it is a list of message histories
@@ -290,6 +1167,19 @@ class ChatGptCacheManager:
         if_exists: bool = False,
     ) -> bool:
         role = GptRoles.get_name(role).lower()
+        if cls._is_compact():
+            if if_exists and not await cache.redis.hexists(
+                cls._get_compact_key(user_id, chatroom_id),
+                f"{role}_message_histories",
+            ):
+                return False
+            await cls._modify_compact_histories(
+                user_id,
+                chatroom_id,
+                role,
+                lambda stored: stored.append(message_history),
+            )
+            return True
         message_history_key = cls._generate_key(
             user_id, chatroom_id, f"{role}_message_histories"
         )
@@ -299,6 +1189,7 @@ class ChatGptCacheManager:
             if not if_exists
             else await cache.redis.rpushx(message_history_key, message_history_json)
         )
+        await cls._invalidate(user_id, chatroom_id)
         return bool(result)
 
     @classmethod
@@ -309,6 +1200,14 @@ class ChatGptCacheManager:
         role: GptRoles | str,
     ) -> list[MessageHistory]:
         role = GptRoles.get_name(role).lower()
+        if cls._is_compact():
+            # only the hash field of this role is read and decoded
+            return CompactContextCodec.decode_histories(
+                await cache.redis.hget(
+                    cls._get_compact_key(user_id, chatroom_id),
+                    f"{role}_message_histories",
+                )
+            )
         key = cls._generate_key(user_id, chatroom_id, f"{role}_message_histories")
         raw_message_histories = await cache.redis.lrange(key, 0, -1)
         if raw_message_histories is None:
@@ -326,8 +1225,16 @@ class ChatGptCacheManager:
         role: GptRoles | str,
     ) -> bool:
         role = GptRoles.get_name(role).lower()
-        key = cls._generate_key(user_id, chatroom_id, f"{role}_message_histories")
-        result = await cache.redis.delete(key)
+        if cls._is_compact():
+            result = await cache.redis.hdel(
+                cls._get_compact_key(user_id, chatroom_id),
+                f"{role}_message_histories",
+            )
+        else:
+            result = await cache.redis.delete(
+                cls._generate_key(user_id, chatroom_id, f"{role}_message_histories")
+            )
+        await cls._invalidate(user_id, chatroom_id)
         return bool(result)
 
     @classmethod
@@ -343,10 +1250,19 @@ class ChatGptCacheManager:
         Set the message history at the given index to the given message history
         """
         role = GptRoles.get_name(role).lower()
+        if cls._is_compact():
+            await cls._modify_compact_histories(
+                user_id,
+                chatroom_id,
+                role,
+                lambda stored: stored.__setitem__(index, message_history),
+            )
+            return True
         key = cls._generate_key(user_id, chatroom_id, f"{role}_message_histories")
         # value in redis is a list of message histories
         # set the last element of the list to the new message history
         result = await cache.redis.lset(
             key, index, orjson_dumps(message_history.__dict__)
         )
+        await cls._invalidate(user_id, chatroom_id)
         return bool(result)
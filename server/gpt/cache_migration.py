@@ -0,0 +1,45 @@
+"""
+Convert chat contexts stored with one key per field into one compact hash per chatroom.
+Set CONTEXT_STORAGE_FORMAT=compact in config/.env after running this.
+
+    python -m gpt.cache_migration [--dry-run]
+"""
+import argparse
+import asyncio
+
+from app.logger import api_logger
+from database import cache
+from gpt.cache_manager import ChatGptCacheManager
+
+
+async def migrate_contexts_to_compact(dry_run: bool = False) -> int:
+    """
+    Migrate every context found in redis
+    :param dry_run: only count contexts to migrate
+    :return: number of migrated contexts
+    """
+    migrated: int = 0
+    async for key in cache.redis.scan_iter(
+        ChatGptCacheManager._generate_key("*", "*", "user_gpt_profile")  # type: ignore
+    ):
+        _, user_id, chatroom_id, _ = key.decode("utf-8").split(":")
+        if dry_run or await ChatGptCacheManager.migrate_to_compact(
+            user_id=int(user_id), chatroom_id=int(chatroom_id)
+        ):
+            migrated += 1
+    return migrated
+
+
+async def main(dry_run: bool) -> None:
+    cache.start()
+    migrated: int = await migrate_contexts_to_compact(dry_run=dry_run)
+    api_logger.info(
+        f"{migrated} contexts {'to migrate' if dry_run else 'migrated'} to compact format"
+    )
+    await cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dry-run", action="store_true")
+    asyncio.run(main(dry_run=parser.parse_args().dry_run))
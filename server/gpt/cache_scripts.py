@@ -0,0 +1,57 @@
+"""
+Lua scripts run atomically inside redis, for context stored with one key per field.
+A brief explanation of the keys they share:
+    - "{role}_message_histories": list of json encoded message histories of a role
+    - "message_tokens": hash of running token sums, with a field per role.
+        It is recomputed from the lists by the script, if it doesn't exist.
+Context stored as a compact hash is written by HSET_IF_EXISTS,
+when a chatroom deleted meanwhile must not be recreated.
+"""
+
+# KEYS[1]: list to append to
+# KEYS[2], KEYS[3], KEYS[4]: user, gpt and system message histories
+# KEYS[5]: token sums
+# ARGV[1]: encoded message history, ARGV[2]: its role, ARGV[3]: its tokens
+# ARGV[4]: maximum total tokens kept, ARGV[5]: invalidation channel, ARGV[6]: invalidation message
+# returns number of evicted (user, gpt) message pairs
+APPEND_AND_TRIM: str = """
+local roles = {"user", "gpt", "system"}
+if redis.call("EXISTS", KEYS[5]) == 0 then
+    for idx, role in ipairs(roles) do
+        local tokens = 0
+        for _, encoded in ipairs(redis.call("LRANGE", KEYS[idx + 1], 0, -1)) do
+            tokens = tokens + cjson.decode(encoded)["tokens"]
+        end
+        redis.call("HSET", KEYS[5], role, tokens)
+    end
+end
+redis.call("RPUSH", KEYS[1], ARGV[1])
+redis.call("HINCRBY", KEYS[5], ARGV[2], ARGV[3])
+local sums = redis.call("HMGET", KEYS[5], unpack(roles))
+local total = tonumber(sums[1]) + tonumber(sums[2]) + tonumber(sums[3])
+local evicted = 0
+while total > tonumber(ARGV[4])
+    and redis.call("LLEN", KEYS[2]) > 0
+    and redis.call("LLEN", KEYS[3]) > 0 do
+    local user_tokens = cjson.decode(redis.call("LPOP", KEYS[2]))["tokens"]
+    local gpt_tokens = cjson.decode(redis.call("LPOP", KEYS[3]))["tokens"]
+    redis.call("HINCRBY", KEYS[5], "user", -user_tokens)
+    redis.call("HINCRBY", KEYS[5], "gpt", -gpt_tokens)
+    total = total - user_tokens - gpt_tokens
+    evicted = evicted + 1
+end
+redis.call("PUBLISH", ARGV[5], ARGV[6])
+return evicted
+"""
+
+
+# KEYS[1]: compact hash of a chatroom
+# ARGV: field and value pairs to write
+# returns 1 if the hash existed and fields are written, 0 if nothing is written
+HSET_IF_EXISTS: str = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("HSET", KEYS[1], unpack(ARGV))
+return 1
+"""
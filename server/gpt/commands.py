@@ -1,4 +1,3 @@
-from asyncio import gather
 from enum import Enum
 from functools import wraps
 from inspect import Parameter, iscoroutinefunction, signature
@@ -9,7 +8,7 @@ from fastapi import WebSocket
 from app.exceptions import ChatroomNotFound, InternalServerError
 from gpt.buffer import BufferedUserContext
 from gpt.cache_manager import ChatGptCacheManager
-from gpt.common import GptRoles, LLMModels, UserGptContext
+from gpt.common import GptRoles, LLMModels, UserGptContext, UserGptContextStub
 from gpt.message_handler import MessageHandler
 from gpt.message_manager import MessageManager
 from gpt.vectorstore_manager import Document, VectorStoreManager
@@ -37,26 +36,33 @@ async def delete_old_chatroom(
     )
 
 
-async def get_contexts_sorted_from_recent_to_past(
+async def delete_old_chatrooms(
+    chatroom_ids_to_delete: list[int],
+    user_id: int,
+) -> int:
+    return await ChatGptCacheManager.delete_chatrooms(
+        user_id=user_id, chatroom_ids=chatroom_ids_to_delete
+    )
+
+
+async def get_context_stubs_sorted_from_recent_to_past(
     user_id: int, chatroom_ids: list[int]
-) -> list[UserGptContext]:
+) -> list[UserGptContextStub]:
     """
-    Returns a list of contexts sorted from recent to past.
+    Returns a list of context stubs sorted from recent to past.
+    Message histories are not loaded, until the chatroom is selected.
     :param user_id: user id
     :param chatroom_ids: list of chatroom ids
     """
     if len(chatroom_ids) == 0:
         raise ChatroomNotFound()
     else:
-        # get latest chatroom
-        contexts: list[UserGptContext] = await gather(
-            *[
-                ChatGptCacheManager.read_context(user_id=user_id, chatroom_id=id)
-                for id in chatroom_ids
-            ]
+        # read profiles of all chatrooms in a single round trip
+        stubs: list[UserGptContextStub] = await ChatGptCacheManager.read_context_stubs(
+            user_id=user_id, chatroom_ids=chatroom_ids
         )
-        contexts.sort(key=lambda x: x.user_gpt_profile.created_at, reverse=True)
-        return contexts
+        stubs.sort(key=lambda x: x.created_at, reverse=True)
+        return stubs
 
 
 class ResponseType(str, Enum):
@@ -93,7 +99,9 @@ class CommandResponse:
                 result = await func(*args, **kwargs)
                 return (result, enum_type)
 
-            return async_wrapper if iscoroutinefunction(func) else sync_wrapper
+            wrapper = async_wrapper if iscoroutinefunction(func) else sync_wrapper
+            wrapper.response_type = enum_type  # type: ignore
+            return wrapper
 
         return decorator
 
@@ -243,6 +251,10 @@ class ChatGptCommands:
                     UserGptContext: buffer.current_user_gpt_context,
                     WebSocket: buffer.websocket,
                     BufferedUserContext: buffer,
+                    # snapshot of which chatroom command is sent from, without its lane
+                    UserGptContextStub: UserGptContextStub.from_context(
+                        buffer.current_user_gpt_context
+                    ),
                 },
                 available_kwargs=buffer.current_user_gpt_context.optional_info | kwargs,
             )
@@ -290,6 +302,27 @@ class ChatGptCommands:
                 )
                 return None, ResponseType.DO_NOTHING
 
+    @classmethod
+    def _is_context_free(cls, callback_name: str) -> bool:
+        """
+        Whether command neither uses a chatroom nor makes gpt respond,
+        so it can be handled without waiting for generations of chatrooms.
+        Commands only knowing which chatroom they're sent from take UserGptContextStub,
+        while those taking context or buffer, like /history, wait for lane of chatroom.
+        """
+        if callback_name.startswith("_"):
+            return False
+        callback: Callable = getattr(cls, callback_name, cls.not_existing_callback)
+        if getattr(callback, "response_type", None) not in (
+            ResponseType.SEND_MESSAGE_AND_STOP,
+            ResponseType.DO_NOTHING,
+        ):
+            return False
+        return all(
+            param.annotation not in (UserGptContext, BufferedUserContext, WebSocket)
+            for param in signature(callback).parameters.values()
+        )
+
     @staticmethod
     @CommandResponse.send_message_and_stop
     def not_existing_callback() -> str:  # callback for not existing command
@@ -318,11 +351,7 @@ class ChatGptCommands:
         for role in GptRoles:
             getattr(user_gpt_context, f"{role.name.lower()}_message_histories").clear()
             setattr(user_gpt_context, f"{role.name.lower()}_message_tokens", 0)
-            await ChatGptCacheManager.delete_message_history(
-                user_id=user_gpt_context.user_id,
-                chatroom_id=user_gpt_context.chatroom_id,
-                role=role,
-            )
+        await ChatGptCacheManager.sync_context(user_gpt_context)
         response: str = f"""## Total Token Removed: **{n_user_tokens + n_gpt_tokens + n_system_tokens}**
 - User: {n_user_tokens}
 - GPT: {n_gpt_tokens}
@@ -399,6 +428,18 @@ Start a conversation as "CODEX: Hi, what are we coding today?"
         )
         return "REDX mode ON"
 
+    @staticmethod
+    @CommandResponse.do_nothing
+    async def history(before: int, /, buffer: BufferedUserContext) -> None:
+        """Send older previous chats of this chatroom, before the given offset\n
+        /history <offset>"""
+        await SendToWebsocket.init(
+            buffer=buffer,
+            send_chatroom_ids=False,
+            init_callback=False,
+            previous_chats_before=before,
+        )
+
     @staticmethod
     @CommandResponse.send_message_and_stop
     def codeblock(language, codes: str, /) -> str:
@@ -410,13 +451,15 @@ Start a conversation as "CODEX: Hi, what are we coding today?"
     @CommandResponse.handle_gpt
     async def query(query: str, /, buffer: BufferedUserContext) -> None:
         """
-        Query from redis vectorstore
+        Query from redis vectorstore, searching only documents of this user
         /query <query>
         """
         num_documents: int = 3
         found_document: list[Document] = (
             await VectorStoreManager.asimilarity_search(
-                queries=[query], k=num_documents
+                queries=[query],
+                k=num_documents,
+                filters={"user_id": str(buffer.user_id)},
             )
         )[0]
         found_text: str = "\n\n".join(
@@ -432,11 +475,15 @@ Start a conversation as "CODEX: Hi, what are we coding today?"
 
     @staticmethod
     @CommandResponse.send_message_and_stop
-    async def embed(text_to_embed: str, /) -> str:
+    async def embed(text_to_embed: str, /, chatroom: UserGptContextStub) -> str:
         """Embed the text and save its vectors in the redis vectorstore.\n
         /embed <text_to_embed>"""
         await VectorStoreManager.create_documents(
             text=text_to_embed,
+            tags={
+                "user_id": str(chatroom.user_id),
+                "chatroom_id": str(chatroom.chatroom_id),
+            },
         )
         return "Embedding successful!"
 
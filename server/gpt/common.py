@@ -1,6 +1,8 @@
-from dataclasses import asdict, dataclass, field
+import asyncio
+from dataclasses import InitVar, asdict, dataclass, field
 from datetime import date, datetime, timedelta
 from enum import Enum
+from functools import cached_property
 from typing import Optional, Union
 from uuid import uuid4
 
@@ -8,7 +10,7 @@ from orjson import dumps as orjson_dumps
 from orjson import loads as orjson_loads
 
 from app.globals import DEFAULT_LLM_MODEL, OPENAI_API_KEY
-from gpt.tokenizers import BaseTokenizer, LlamaTokenizer, OpenAITokenizer
+from gpt.tokenizers import BaseTokenizer, LlamaTokenizer, OpenAITokenizer, get_tokenizer
 
 
 class UTC:
@@ -116,9 +118,12 @@ class LlamaCppModel(LLMModel):
         str
     ] = None  # A prefix to prepend to the generated text. If None, no prefix is prepended.
 
-    def __post_init__(self):
-        if self.description is not None:
-            self.description_tokens = self.tokenizer.tokens_of(self.description)
+    @cached_property
+    def description_tokens(self) -> int:
+        # counted on first use, so defining models doesn't load their tokenizer
+        if self.description is None:
+            return 0
+        return self.tokenizer.tokens_of(self.description)
 
 
 class LLMModels(Enum):  # gpt models for openai api
@@ -127,7 +132,7 @@ class LLMModels(Enum):  # gpt models for openai api
         max_total_tokens=4096,
         max_tokens_per_request=2048,
         token_margin=8,
-        tokenizer=OpenAITokenizer(),
+        tokenizer=get_tokenizer(OpenAITokenizer, "cl100k_base"),
         api_url="https://api.openai.com/v1/chat/completions",
         api_key=OPENAI_API_KEY,
     )
@@ -136,7 +141,7 @@ class LLMModels(Enum):  # gpt models for openai api
         max_total_tokens=8192,
         max_tokens_per_request=4096,
         token_margin=8,
-        tokenizer=OpenAITokenizer(),
+        tokenizer=get_tokenizer(OpenAITokenizer, "cl100k_base"),
         api_url="https://api.openai.com/v1/chat/completions",
         api_key=OPENAI_API_KEY,
     )
@@ -145,7 +150,7 @@ class LLMModels(Enum):  # gpt models for openai api
         max_total_tokens=2048,  # context tokens (n_ctx)
         max_tokens_per_request=1024,  # The maximum number of tokens to generate.
         token_margin=8,
-        tokenizer=LlamaTokenizer("junelee/wizard-vicuna-13b"),
+        tokenizer=get_tokenizer(LlamaTokenizer, "junelee/wizard-vicuna-13b"),
         model_path="./llama_models/ggml/wizard-vicuna-13B.ggml.q5_1.bin",
         description="""The following is a friendly conversation between a {user} and an {gpt}. The {gpt} is talkative and provides lots of specific details from its context. If the {gpt} does not know the answer to a question, it truthfully says it does not know:\n""",
     )
@@ -154,7 +159,7 @@ class LLMModels(Enum):  # gpt models for openai api
         max_total_tokens=2048,  # context tokens (n_ctx)
         max_tokens_per_request=1024,  # The maximum number of tokens to generate.
         token_margin=8,
-        tokenizer=LlamaTokenizer("junelee/wizard-vicuna-13b"),
+        tokenizer=get_tokenizer(LlamaTokenizer, "junelee/wizard-vicuna-13b"),
         model_path="./llama_models/ggml/WizardLM-7B-uncensored.ggml.q4_2.bin",
         description="""The following is a conversation between a {user} and an {gpt}. The {gpt} is talkative and provides lots of specific details from its context. If the {gpt} does not know the answer to a question, it truthfully says it does not know:\n""",
     )
@@ -163,11 +168,15 @@ class LLMModels(Enum):  # gpt models for openai api
         max_total_tokens=2048,  # context tokens (n_ctx)
         max_tokens_per_request=1024,  # The maximum number of tokens to generate.
         token_margin=8,
-        tokenizer=LlamaTokenizer("junelee/wizard-vicuna-13b"),
+        tokenizer=get_tokenizer(LlamaTokenizer, "junelee/wizard-vicuna-13b"),
         model_path="./llama_models/ggml/gpt4-x-vicuna-13B.ggml.q4_0.bin",
         description="""The following is a conversation between a {user} and an {gpt}. The {gpt} is talkative and provides lots of specific details from its context. If the {gpt} does not know the answer to a question, it truthfully says it does not know:\n""",
     )
 
+    def __reduce_ex__(self, protocol):
+        # pickled by name, since models hold tokenizers that aren't equal across processes
+        return getattr, (self.__class__, self.name)
+
 
 class GptRoles(str, Enum):
     GPT = "assistant"
@@ -228,6 +237,46 @@ class UserGptProfile:  # user gpt profile for user and gpt
     frequency_penalty: float = 1.1
 
 
+def describe_usage(
+    user_gpt_profile: UserGptProfile,
+    gpt_model: LLMModels,
+    message_tokens: dict[str, int],
+) -> str:
+    """Describe profile, model and token usage of a chatroom, without its message histories"""
+    time_string: str = datetime.strptime(
+        str(user_gpt_profile.created_at),
+        "%Y%m%d%H%M%S",
+    ).strftime("%Y-%m-%d %H:%M:%S")
+    total_tokens: int = sum(message_tokens.values())
+    left_tokens: int = (
+        gpt_model.value.max_total_tokens
+        - total_tokens
+        - gpt_model.value.token_margin
+        - int(getattr(gpt_model.value, "description_tokens", 0))
+    )
+    return f"""# User Info
+- Your ID: `{user_gpt_profile.user_id}`
+- This chatroom ID: `{user_gpt_profile.chatroom_id}`
+- Your profile created at: `{time_string}`
+
+# LLM Info
+- Model Name: `{gpt_model.name}`
+- Actual Model Name: `{gpt_model.value.name}`
+- Temperature: `{user_gpt_profile.temperature}`
+- Top P: `{user_gpt_profile.top_p}`
+- Presence Penalty: `{user_gpt_profile.presence_penalty}`
+- Frequency Penalty: `{user_gpt_profile.frequency_penalty}`
+
+# Token Info
+- Maximum Token Limit: `{gpt_model.value.max_total_tokens}`
+- User Token Consumed: `{message_tokens.get("user", 0)}`
+- GPT Token Consumed: `{message_tokens.get("gpt", 0)}`
+- System Token Consumed: `{message_tokens.get("system", 0)}`
+- Total Token Consumed: `{total_tokens}`
+- Remaining Tokens: `{left_tokens}`
+"""
+
+
 @dataclass
 class UserGptContext:
     """
@@ -246,19 +295,36 @@ class UserGptContext:
     system_message_tokens: int = field(init=False, default=0)
 
     optional_info: dict = field(default_factory=dict)
+    # digests of what is persisted in cache, so only changes are written on sync
+    _persisted: dict = field(init=False, default_factory=dict, repr=False)
+    # syncs of context are serialized, since each diffs against what the previous one persisted
+    _sync_lock: asyncio.Lock = field(
+        init=False, default_factory=asyncio.Lock, repr=False, compare=False
+    )
+    # token totals of roles persisted in cache, so histories don't have to be summed
+    message_tokens: InitVar[dict[str, int] | None] = None
 
-    def __post_init__(self):
-        for role in tuple(
-            key.split("_")[0]
-            for key in self.__annotations__.keys()
-            if "message_tokens" in key.lower()
-        ):
+    def __post_init__(self, message_tokens: dict[str, int] | None):
+        for role in GptRoles:
+            role_name: str = role.name.lower()
             setattr(
                 self,
-                f"{role}_message_tokens",
-                sum([m.tokens for m in getattr(self, f"{role}_message_histories")]),
+                f"{role_name}_message_tokens",
+                message_tokens[role_name]
+                if message_tokens is not None and role_name in message_tokens
+                else sum(
+                    [m.tokens for m in getattr(self, f"{role_name}_message_histories")]
+                ),
             )
 
+    def __getstate__(self) -> dict:
+        # lock is bound to the event loop, so it's not sent to worker processes
+        return {k: v for k, v in self.__dict__.items() if k != "_sync_lock"}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._sync_lock = asyncio.Lock()
+
     @classmethod
     def parse_stringified_json(cls, stred_json: str) -> "UserGptContext":
         stored: dict = orjson_loads(stred_json)
@@ -294,7 +360,7 @@ class UserGptContext:
         return self.gpt_model.value.tokenizer.encode(message)
 
     def get_tokens_of(self, message: str) -> int:
-        return len(self.tokenize(message))
+        return self.gpt_model.value.tokenizer.tokens_of(message)
 
     @property
     def left_tokens(self) -> int:
@@ -325,33 +391,19 @@ class UserGptContext:
     def chatroom_id(self) -> str:
         return self.user_gpt_profile.chatroom_id
 
-    def __repr__(self) -> str:
-        gpt_model: LLMModels = self.gpt_model
-        time_string: str = datetime.strptime(
-            str(self.user_gpt_profile.created_at),
-            "%Y%m%d%H%M%S",
-        ).strftime("%Y-%m-%d %H:%M:%S")
-        return f"""# User Info
-- Your ID: `{self.user_id}`
-- This chatroom ID: `{self.chatroom_id}`
-- Your profile created at: `{time_string}`
-
-# LLM Info
-- Model Name: `{gpt_model.name}`
-- Actual Model Name: `{gpt_model.value.name}`
-- Temperature: `{self.user_gpt_profile.temperature}`
-- Top P: `{self.user_gpt_profile.top_p}`
-- Presence Penalty: `{self.user_gpt_profile.presence_penalty}`
-- Frequency Penalty: `{self.user_gpt_profile.frequency_penalty}`
-
-# Token Info
-- Maximum Token Limit: `{gpt_model.value.max_total_tokens}`
-- User Token Consumed: `{self.user_message_tokens}`
-- GPT Token Consumed: `{self.gpt_message_tokens}`
-- System Token Consumed: `{self.system_message_tokens}`
-- Total Token Consumed: `{self.total_tokens}`
-- Remaining Tokens: `{self.left_tokens}`
+    @property
+    def message_tokens_of_roles(self) -> dict[str, int]:
+        return {
+            role.name.lower(): getattr(self, f"{role.name.lower()}_message_tokens")
+            for role in GptRoles
+        }
 
+    def __repr__(self) -> str:
+        return f"""{describe_usage(
+            user_gpt_profile=self.user_gpt_profile,
+            gpt_model=self.gpt_model,
+            message_tokens=self.message_tokens_of_roles,
+        )}
 # Message Histories
 - User Message_Histories={self.user_message_histories}
 
@@ -412,3 +464,30 @@ class UserGptContext:
             self.user_message_tokens -= self.user_message_histories.pop(0).tokens
             self.gpt_message_tokens -= self.gpt_message_histories.pop(0).tokens
         return deleted_histories
+
+
+@dataclass
+class UserGptContextStub:
+    """
+    lightweight placeholder of a chatroom whose message histories are not loaded yet,
+    holding just enough to sort and list chatrooms
+    """
+
+    user_id: int
+    chatroom_id: int
+    created_at: int
+    # running token totals, None if they are not known without loading histories
+    user_message_tokens: int | None = None
+    gpt_message_tokens: int | None = None
+    system_message_tokens: int | None = None
+
+    @classmethod
+    def from_context(cls, user_gpt_context: UserGptContext) -> "UserGptContextStub":
+        return cls(
+            user_id=user_gpt_context.user_gpt_profile.user_id,
+            chatroom_id=user_gpt_context.chatroom_id,
+            created_at=user_gpt_context.user_gpt_profile.created_at,
+            user_message_tokens=user_gpt_context.user_message_tokens,
+            gpt_message_tokens=user_gpt_context.gpt_message_tokens,
+            system_message_tokens=user_gpt_context.system_message_tokens,
+        )
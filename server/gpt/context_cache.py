@@ -0,0 +1,147 @@
+"""
+In-process cache of decoded contexts, shared by every websocket session of a worker.
+A brief explanation of how it stays fresh:
+    - Entries are evicted in LRU order when there are too many of them,
+        or when their approximate size exceeds the memory budget.
+    - Entries expire after a TTL, so they are read from redis again eventually.
+    - Every write to redis publishes the chatroom to an invalidation channel.
+        Other workers drop that chatroom from their cache when they receive it.
+"""
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic
+from uuid import uuid4
+
+from app.logger import api_logger
+from database import cache
+from database.dataclasses import ContextCacheConfig
+from gpt.common import UserGptContext
+
+
+@dataclass
+class _CacheEntry:
+    context: UserGptContext
+    expires_at: float
+    size: int
+
+
+class UserGptContextCache:
+    def __init__(self, config: ContextCacheConfig = ContextCacheConfig()):
+        self.config = config
+        self.worker_id: str = uuid4().hex
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+        self._entries: OrderedDict[tuple[int, int], _CacheEntry] = OrderedDict()
+        self._total_size: int = 0
+
+    @staticmethod
+    def _key(user_id: int | str, chatroom_id: int | str) -> tuple[int, int]:
+        return int(user_id), int(chatroom_id)
+
+    @staticmethod
+    def _size_of(user_gpt_context: UserGptContext) -> int:
+        """Approximate size of context in bytes, dominated by message contents"""
+        return 512 + sum(
+            [
+                256 + len(message_history.content)
+                for message_histories in (
+                    user_gpt_context.user_message_histories,
+                    user_gpt_context.gpt_message_histories,
+                    user_gpt_context.system_message_histories,
+                )
+                for message_history in message_histories
+            ]
+        )
+
+    def get(self, user_id: int | str, chatroom_id: int | str) -> UserGptContext | None:
+        key: tuple[int, int] = self._key(user_id, chatroom_id)
+        entry: _CacheEntry | None = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at < monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.context
+
+    def put(self, user_gpt_context: UserGptContext) -> None:
+        key: tuple[int, int] = self._key(
+            user_gpt_context.user_id, user_gpt_context.chatroom_id
+        )
+        self._remove(key)
+        entry = _CacheEntry(
+            context=user_gpt_context,
+            expires_at=monotonic() + self.config.ttl,
+            size=self._size_of(user_gpt_context),
+        )
+        self._entries[key] = entry
+        self._total_size += entry.size
+        while self._entries and (
+            len(self._entries) > self.config.max_entries
+            or self._total_size > self.config.max_bytes
+        ):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, user_id: int | str, chatroom_id: int | str) -> None:
+        if self._remove(self._key(user_id, chatroom_id)):
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._total_size = 0
+
+    def _remove(self, key: tuple[int, int]) -> bool:
+        entry: _CacheEntry | None = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._total_size -= entry.size
+        return True
+
+    def invalidation_message(self, user_id: int | str, chatroom_id: int | str) -> str:
+        """Message to publish to invalidation channel, after writing chatroom to redis"""
+        return f"{self.worker_id}:{int(user_id)}:{int(chatroom_id)}"
+
+    async def listen(self) -> None:
+        """Drop chatrooms written by other workers, until cancelled"""
+        while True:
+            try:
+                async with cache.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.config.invalidation_channel)
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        worker_id, user_id, chatroom_id = (
+                            message["data"].decode("utf-8").split(":")
+                        )
+                        if worker_id != self.worker_id:
+                            self.invalidate(user_id, chatroom_id)
+            except asyncio.CancelledError:
+                break
+            except Exception as exception:
+                # invalidations may have been missed while disconnected
+                api_logger.error(f"Context cache invalidation error: {exception}")
+                self.clear()
+                await asyncio.sleep(1)
+
+    @property
+    def stats(self) -> dict[str, int | float]:
+        requests: int = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._total_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+context_cache: UserGptContextCache = UserGptContextCache()
@@ -0,0 +1,114 @@
+"""
+Compact encoding of chat contexts, stored as a single redis hash per chatroom.
+A brief explanation of the layout:
+    - "v": format version of the hash
+    - "user_gpt_profile", "gpt_model": same values as the per-key format
+    - "{role}_message_histories": message histories of a role, stored column by column
+        (contents, tokens, timestamps, uuids) after a version byte, so field names
+        are not repeated per message and each role can be decoded on its own.
+    - "message_tokens": token totals of roles, so histories don't have to be summed.
+        It is removed when histories are written without it, and summed again on decode.
+"""
+from orjson import dumps as orjson_dumps
+from orjson import loads as orjson_loads
+
+from gpt.common import (
+    GptRoles,
+    LLMModels,
+    MessageHistory,
+    UserGptContext,
+    UserGptProfile,
+)
+
+
+class CompactContextCodec:
+    version: int = 1
+    version_field: str = "v"
+    string_fields: tuple[str, ...] = ("user_gpt_profile", "gpt_model")
+    list_fields: tuple[str, ...] = tuple(
+        f"{role.name.lower()}_message_histories" for role in GptRoles
+    )
+    token_sums_field: str = "message_tokens"
+    # columns whose value is usually the same for every message of a role
+    _uniform_columns: tuple[str, ...] = ("role", "is_user", "model_name")
+    _columns: tuple[str, ...] = ("content", "tokens", "timestamp", "uuid")
+
+    @classmethod
+    def encode_histories(cls, message_histories: list[MessageHistory]) -> bytes:
+        columns: dict = {
+            column: [getattr(m, column) for m in message_histories]
+            for column in cls._columns + cls._uniform_columns
+        }
+        for column in cls._uniform_columns:
+            # store a single value instead of a list, if every message shares it
+            if len(set(columns[column])) <= 1:
+                columns[column] = columns[column][0] if columns[column] else None
+        return bytes((cls.version,)) + orjson_dumps(columns)
+
+    @classmethod
+    def decode_histories(cls, blob: bytes | None) -> list[MessageHistory]:
+        if not blob:
+            return []
+        if blob[0] != cls.version:
+            raise ValueError(f"Unsupported compact context version: {blob[0]}")
+        columns: dict = orjson_loads(blob[1:])
+        n_messages: int = len(columns["content"])
+        for column in cls._uniform_columns:
+            if not isinstance(columns[column], list):
+                columns[column] = [columns[column]] * n_messages
+        return [
+            MessageHistory(
+                role=role,
+                content=content,
+                tokens=tokens,
+                is_user=is_user,
+                timestamp=timestamp,
+                uuid=uuid,
+                model_name=model_name,
+            )
+            for content, tokens, timestamp, uuid, role, is_user, model_name in zip(
+                *[columns[column] for column in cls._columns + cls._uniform_columns]
+            )
+        ]
+
+    @classmethod
+    def encode(cls, user_gpt_context: UserGptContext) -> dict[str, bytes]:
+        """Encode context into mapping of hash fields, except for version field"""
+        json_data: dict = user_gpt_context.json()
+        return (
+            {field: orjson_dumps(json_data[field]) for field in cls.string_fields}
+            | {
+                field: cls.encode_histories(getattr(user_gpt_context, field))
+                for field in cls.list_fields
+            }
+            | {
+                cls.token_sums_field: orjson_dumps(
+                    user_gpt_context.message_tokens_of_roles
+                )
+            }
+        )
+
+    @classmethod
+    def decode(cls, stored: dict[bytes, bytes]) -> UserGptContext | None:
+        """
+        Decode context from stored hash
+        :return: None if the hash doesn't hold a whole context
+        """
+        stored_string: list[bytes | None] = [
+            stored.get(field.encode()) for field in cls.string_fields
+        ]
+        if any([value is None for value in stored_string]):
+            return None
+        profile, gpt_model = [orjson_loads(value) for value in stored_string]  # type: ignore
+        message_tokens: bytes | None = stored.get(cls.token_sums_field.encode())
+        return UserGptContext(
+            user_gpt_profile=UserGptProfile(**profile),
+            gpt_model=LLMModels._member_map_[gpt_model],  # type: ignore
+            **{
+                field: cls.decode_histories(stored.get(field.encode()))
+                for field in cls.list_fields
+            },
+            message_tokens=orjson_loads(message_tokens)
+            if message_tokens is not None
+            else None,
+        )
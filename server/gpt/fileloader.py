@@ -1,10 +1,22 @@
+import codecs
 import io
-from typing import IO, Any
+from hashlib import sha256
+from itertools import islice
+from os.path import splitext
+from tempfile import SpooledTemporaryFile
+from typing import IO, Any, Iterable, Iterator
 
 from langchain.docstore.document import Document
 from langchain.document_loaders.unstructured import UnstructuredBaseLoader
+from langchain.text_splitter import TokenTextSplitter
 from unstructured.partition.auto import partition
 
+from database.dataclasses import FileUploadConfig
+
+# read as they are, in blocks, instead of being partitioned by unstructured
+_TEXT_EXTENSIONS: tuple[str, ...] = (".txt", ".md", ".csv", ".tsv", ".json", ".log")
+_TEXT_BLOCK_SIZE: int = 1 << 16
+
 
 class UnstructuredFileIOLoader(UnstructuredBaseLoader):
     """Loader that uses unstructured to load file IO objects."""
@@ -39,6 +51,120 @@ def read_bytes_to_text(file: bytes, filename: str) -> str:
     )
 
 
+class SpooledUpload:
+    """
+    File uploaded in chunks, kept in memory up to `spool_size` bytes and in a temporary file beyond,
+    with its size and checksum tracked as chunks are written.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        size: int | None = None,
+        config: FileUploadConfig = FileUploadConfig(),
+    ):
+        if size is not None and size > config.max_size:
+            raise ValueError(
+                f"File of {size} bytes exceeds limit of {config.max_size} bytes"
+            )
+        self.filename = filename
+        self.size = size
+        self.config = config
+        self.received: int = 0
+        self.file: IO[bytes] = SpooledTemporaryFile(max_size=config.spool_size)  # type: ignore
+        self._sha256 = sha256()
+
+    def write(self, chunk: bytes) -> None:
+        limit: int = self.size if self.size is not None else self.config.max_size
+        if self.received + len(chunk) > limit:
+            raise ValueError(f"Upload exceeds {limit} bytes")
+        self.file.write(chunk)
+        self._sha256.update(chunk)
+        self.received += len(chunk)
+
+    def finish(self, sha256_hex: str | None = None) -> None:
+        """Check the upload is complete and intact, then rewind it to be read"""
+        if self.size is not None and self.received != self.size:
+            raise ValueError(f"Received {self.received} of {self.size} bytes")
+        if sha256_hex is not None and sha256_hex.lower() != self._sha256.hexdigest():
+            raise ValueError("Checksum of upload doesn't match")
+        self.file.seek(0)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def iter_file_texts(file: IO[bytes], filename: str) -> Iterator[str]:
+    """
+    Texts of file from start to end, parsed a part at a time where possible,
+    so a large file isn't held in memory as a whole
+    """
+    extension: str = splitext(filename)[1].lower()
+    if extension == ".pdf":
+        from pdfminer.high_level import extract_pages
+        from pdfminer.layout import LTTextContainer
+
+        # a page at a time, without caching objects of pages already parsed
+        for page in extract_pages(file, caching=False):
+            text: str = "".join(
+                [
+                    element.get_text()
+                    for element in page
+                    if isinstance(element, LTTextContainer)
+                ]
+            )
+            if text.strip():
+                yield text
+    elif extension in _TEXT_EXTENSIONS:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while block := file.read(_TEXT_BLOCK_SIZE):
+            yield decoder.decode(block)
+        yield decoder.decode(b"", final=True)
+    else:
+        for element in partition(file=file, file_filename=filename):
+            if str(element).strip():
+                yield str(element)
+
+
+def iter_text_chunks(
+    texts: Iterable[str],
+    config: FileUploadConfig = FileUploadConfig(),
+) -> Iterator[str]:
+    """
+    Split texts into chunks of tokens, as they come.
+    Texts are buffered up to `text_buffer_size` characters and split,
+    keeping the last, possibly partial chunk to be split again with following texts.
+    """
+    splitter = TokenTextSplitter(
+        chunk_size=config.chunk_size,
+        chunk_overlap=config.chunk_overlap,
+        encoding_name="cl100k_base",
+    )
+    pending: str = ""
+    for text in texts:
+        pending += text
+        if len(pending) < config.text_buffer_size:
+            continue
+        chunks: list[str] = splitter.split_text(pending)
+        yield from chunks[:-1]
+        pending = chunks[-1] if chunks else ""
+    if pending.strip():
+        yield from splitter.split_text(pending)
+
+
+def iter_document_batches(
+    file: IO[bytes],
+    filename: str,
+    config: FileUploadConfig = FileUploadConfig(),
+) -> Iterator[list[str]]:
+    """Documents of file in batches of `embed_batch_size`, produced while parsing it"""
+    chunks: Iterator[str] = iter_text_chunks(
+        iter_file_texts(file=file, filename=filename), config=config
+    )
+    while batch := list(islice(chunks, config.embed_batch_size)):
+        yield batch
+
+
 if __name__ == "__main__":
     with open(r"test.pdf", "rb") as f:
         file = f.read()
@@ -1,8 +1,6 @@
-import asyncio
 from asyncio import sleep
-from concurrent.futures import ThreadPoolExecutor
 from itertools import zip_longest
-from typing import Any, AsyncGenerator, Union
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Union
 
 import httpx
 import orjson
@@ -18,19 +16,26 @@ from app.logger import api_logger
 from database.dataclasses import ChatGPTConfig
 from database.schemas import SendInitToWebsocket, SendToStream
 from gpt.common import GptRoles, UserGptContext
+from gpt.http_client import http_client_pool
 from gpt.message_manager import MessageManager
+from gpt.sse import aiter_sse_data
+
+if TYPE_CHECKING:
+    from gpt.llama_worker import LlamaJob
 
 
 def message_history_organizer(
     user_gpt_context: UserGptContext,
     send_to_stream: bool = True,
     return_as_string: bool = False,
+    turns: slice = slice(None),
 ) -> Union[list[dict], str]:
     """
     Organize message history for openai api
     :param user_gpt_context: user gpt context
     :param send_to_stream: whether to send to stream or websocket
     :param return_as_string: whether to return as string or list
+    :param turns: slice of (user message, gpt message) pairs to organize
     :return: message history
     """
     message_histories: list[dict[str, str]] = []
@@ -38,8 +43,8 @@ def message_history_organizer(
         for system_history in user_gpt_context.system_message_histories:
             message_histories.append(SendToStream.from_orm(system_history).dict())
     for user_message_history, gpt_message_history in zip_longest(
-        user_gpt_context.user_message_histories,
-        user_gpt_context.gpt_message_histories,
+        user_gpt_context.user_message_histories[turns],
+        user_gpt_context.gpt_message_histories[turns],
     ):
         message_histories.append(
             SendToStream.from_orm(user_message_history).dict()
@@ -51,7 +56,9 @@ def message_history_organizer(
             if send_to_stream
             else SendInitToWebsocket.from_orm(gpt_message_history).dict()
         ) if gpt_message_history is not None else ...
-    if user_gpt_context.optional_info.get("is_discontinued", False):
+    if turns.stop is None and user_gpt_context.optional_info.get(
+        "is_discontinued", False
+    ):
         # add continuation to last message, if discontinued, this is to prevent the user from being able to send messages after the chat is discontinued
         for message_history in reversed(message_histories):
             if message_history["role"] == user_gpt_context.user_gpt_profile.gpt_role:
@@ -97,118 +104,79 @@ async def generate_from_openai(
     api_key_to_use: Any = (
         user_defined_api_key if user_defined_api_key is not None else default_api_key
     )
-    async with httpx.AsyncClient(timeout=ChatGPTConfig.wait_for_timeout) as client:
-        is_appending_discontinued_message: bool = False
-        content_buffer: str = ""
-        while True:
-            if not user_gpt_context.optional_info.get("is_discontinued", False):
-                content_buffer = ""
-            try:
-                async with client.stream(
-                    method="POST",
-                    url=user_gpt_context.gpt_model.value.api_url,
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {api_key_to_use}",
-                    },
-                    json={
-                        "model": user_gpt_context.gpt_model.value.name,
-                        "messages": message_history_organizer(
-                            user_gpt_context=user_gpt_context
-                        ),
-                        "temperature": user_gpt_context.user_gpt_profile.temperature,
-                        "top_p": user_gpt_context.user_gpt_profile.top_p,
-                        "n": 1,
-                        "stream": True,
-                        "presence_penalty": user_gpt_context.user_gpt_profile.presence_penalty,
-                        "frequency_penalty": user_gpt_context.user_gpt_profile.frequency_penalty,
-                        "max_tokens": min(
-                            user_gpt_context.left_tokens,
-                            user_gpt_context.gpt_model.value.max_tokens_per_request,
-                        ),
-                        "stop": None,
-                        "logit_bias": {},
-                        "user": user_gpt_context.user_id,
-                    },
-                ) as streaming_response:
-                    if streaming_response.status_code != 200:
-                        # if status code is not 200
-                        err_msg = orjson.loads(await streaming_response.aread()).get(
-                            "error"
+    # connections are pooled and kept alive across generations of every user
+    client: httpx.AsyncClient = http_client_pool.client
+    is_appending_discontinued_message: bool = False
+    content_buffer: str = ""
+    while True:
+        if not user_gpt_context.optional_info.get("is_discontinued", False):
+            content_buffer = ""
+        try:
+            async with client.stream(
+                method="POST",
+                url=user_gpt_context.gpt_model.value.api_url,
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {api_key_to_use}",
+                },
+                json={
+                    "model": user_gpt_context.gpt_model.value.name,
+                    "messages": message_history_organizer(
+                        user_gpt_context=user_gpt_context
+                    ),
+                    "temperature": user_gpt_context.user_gpt_profile.temperature,
+                    "top_p": user_gpt_context.user_gpt_profile.top_p,
+                    "n": 1,
+                    "stream": True,
+                    "presence_penalty": user_gpt_context.user_gpt_profile.presence_penalty,
+                    "frequency_penalty": user_gpt_context.user_gpt_profile.frequency_penalty,
+                    "max_tokens": min(
+                        user_gpt_context.left_tokens,
+                        user_gpt_context.gpt_model.value.max_tokens_per_request,
+                    ),
+                    "stop": None,
+                    "logit_bias": {},
+                    "user": user_gpt_context.user_id,
+                },
+            ) as streaming_response:
+                if streaming_response.status_code != 200:
+                    # if status code is not 200
+                    err_msg = orjson.loads(await streaming_response.aread()).get(
+                        "error"
+                    )
+                    if isinstance(err_msg, dict):
+                        err_msg = err_msg.get("message")
+                    raise GptConnectionException(msg=f"OpenAI Server Error: {err_msg}")
+                # stream from api, decoding events as bytes arrive
+                async for data in aiter_sse_data(streaming_response.aiter_bytes()):
+                    try:
+                        json_data: dict = orjson.loads(data)["choices"][0]
+                    except orjson.JSONDecodeError:
+                        continue
+                    finish_reason: str | None = json_data.get("finish_reason")
+                    delta: dict | None = json_data.get("delta")
+                    if finish_reason == "length":
+                        raise GptLengthException(
+                            msg="Incomplete model output due to max_tokens parameter or token limit"
                         )
-                        if isinstance(err_msg, dict):
-                            err_msg = err_msg.get("message")
-                        raise GptConnectionException(
-                            msg=f"OpenAI Server Error: {err_msg}"
+                    elif finish_reason == "content_filter":
+                        raise GptContentFilterException(
+                            msg="Omitted content due to a flag from our content filters"
                         )
-                    stream_buffer: str = ""
-                    # stream from api
-                    async for stream in streaming_response.aiter_text():
-                        stream_buffer += stream
-                        # parse json from stream
-                        for match in ChatGPTConfig.api_regex_pattern.finditer(
-                            stream_buffer
-                        ):
-                            try:
-                                json_data: dict = orjson.loads(match.group(1))[
-                                    "choices"
-                                ][0]
-                            except orjson.JSONDecodeError:
-                                continue
-                            finally:
-                                stream_buffer = stream_buffer[match.end() :]
-                            finish_reason: str | None = json_data.get("finish_reason")
-                            delta: dict | None = json_data.get("delta")
-                            if finish_reason == "length":
-                                raise GptLengthException(
-                                    msg="Incomplete model output due to max_tokens parameter or token limit"
-                                )
-                            elif finish_reason == "content_filter":
-                                raise GptContentFilterException(
-                                    msg="Omitted content due to a flag from our content filters"
-                                )
-                            elif delta is not None:
-                                delta_content: str | None = delta.get("content")
-                                if delta_content is not None:
-                                    content_buffer += delta_content
-                                    yield delta_content
-            except GptLengthException:
-                api_logger.error("token limit exceeded")
-                if is_appending_discontinued_message:
-                    await MessageManager.set_message_history_safely(
-                        user_gpt_context=user_gpt_context,
-                        new_content=content_buffer,
-                        role=GptRoles.GPT,
-                        index=-1,
-                    )
-                else:
-                    await MessageManager.add_message_history_safely(
-                        user_gpt_context=user_gpt_context,
-                        content=content_buffer,
-                        role=GptRoles.GPT,
-                        model_name="chatgpt",
-                    )
-                    is_appending_discontinued_message = True
-                user_gpt_context.optional_info["is_discontinued"] = True
-                continue
-            except GptException as gpt_exception:
-                api_logger.error(f"gpt exception: {gpt_exception.msg}")
-                await MessageManager.pop_message_history_safely(
-                    user_gpt_context=user_gpt_context, role=GptRoles.USER
-                )
-                yield gpt_exception.msg
-                break
-            except httpx.TimeoutException:
-                api_logger.error("gpt timeout exception")
-                await sleep(ChatGPTConfig.wait_for_reconnect)
-                continue
-            except Exception as exception:
-                api_logger.error(f"unexpected gpt exception: {exception}")
-                await MessageManager.pop_message_history_safely(
-                    user_gpt_context=user_gpt_context, role=GptRoles.USER
+                    elif delta is not None:
+                        delta_content: str | None = delta.get("content")
+                        if delta_content is not None:
+                            content_buffer += delta_content
+                            yield delta_content
+        except GptLengthException:
+            api_logger.error("token limit exceeded")
+            if is_appending_discontinued_message:
+                await MessageManager.set_message_history_safely(
+                    user_gpt_context=user_gpt_context,
+                    new_content=content_buffer,
+                    role=GptRoles.GPT,
+                    index=-1,
                 )
-                yield "Internal Server Error"
-                break
             else:
                 await MessageManager.add_message_history_safely(
                     user_gpt_context=user_gpt_context,
@@ -216,19 +184,43 @@ async def generate_from_openai(
                     role=GptRoles.GPT,
                     model_name="chatgpt",
                 )
-                user_gpt_context.optional_info["is_discontinued"] = False
-                break
+                is_appending_discontinued_message = True
+            user_gpt_context.optional_info["is_discontinued"] = True
+            continue
+        except GptException as gpt_exception:
+            api_logger.error(f"gpt exception: {gpt_exception.msg}")
+            await MessageManager.pop_message_history_safely(
+                user_gpt_context=user_gpt_context, role=GptRoles.USER
+            )
+            yield gpt_exception.msg
+            break
+        except httpx.TimeoutException:
+            api_logger.error("gpt timeout exception")
+            await sleep(ChatGPTConfig.wait_for_reconnect)
+            continue
+        except Exception as exception:
+            api_logger.error(f"unexpected gpt exception: {exception}")
+            await MessageManager.pop_message_history_safely(
+                user_gpt_context=user_gpt_context, role=GptRoles.USER
+            )
+            yield "Internal Server Error"
+            break
+        else:
+            await MessageManager.add_message_history_safely(
+                user_gpt_context=user_gpt_context,
+                content=content_buffer,
+                role=GptRoles.GPT,
+                model_name="chatgpt",
+            )
+            user_gpt_context.optional_info["is_discontinued"] = False
+            break
 
 
 async def generate_from_llama_cpp(
     user_gpt_context: UserGptContext,
-    m_queue,
-    m_done,
+    job: "LlamaJob",
 ) -> AsyncGenerator:
-    loop = asyncio.get_event_loop()
-    executor = ThreadPoolExecutor(max_workers=1)
-    while not m_queue.empty() or not m_done.is_set():
-        generation: Any = await loop.run_in_executor(executor, m_queue.get)
+    async for generation in job:
         if type(generation) == str:
             yield generation
         elif type(generation) == dict:
@@ -236,19 +228,18 @@ async def generate_from_llama_cpp(
             n_gen_tokens: int = generation["result"]["n_gen_tokens"]
             deleted_histories: int = generation["result"]["deleted_histories"]
             if deleted_histories > 0:
-                asyncio.gather(
-                    MessageManager.pop_message_history_safely(
-                        user_gpt_context=user_gpt_context,
-                        role=GptRoles.USER,
-                        rpop=False,
-                        count=deleted_histories,
-                    ),
-                    MessageManager.pop_message_history_safely(
-                        user_gpt_context=user_gpt_context,
-                        role=GptRoles.GPT,
-                        rpop=False,
-                        count=deleted_histories,
-                    ),
+                # in order, before the generated message is added
+                await MessageManager.pop_message_history_safely(
+                    user_gpt_context=user_gpt_context,
+                    role=GptRoles.USER,
+                    rpop=False,
+                    count=deleted_histories,
+                )
+                await MessageManager.pop_message_history_safely(
+                    user_gpt_context=user_gpt_context,
+                    role=GptRoles.GPT,
+                    rpop=False,
+                    count=deleted_histories,
                 )
             await MessageManager.add_message_history_safely(
                 user_gpt_context=user_gpt_context,
@@ -0,0 +1,118 @@
+"""
+Application-lifetime pool of HTTP connections, shared by every generation of a worker.
+A brief explanation of why it is shared:
+    - Connections are kept alive between requests, so TCP and TLS handshakes
+        are paid once per connection instead of once per message.
+    - With HTTP/2, concurrent streams to the same host are multiplexed over one connection.
+    - Statistics are kept per host, including how many connections were actually opened.
+"""
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from time import perf_counter
+from typing import Awaitable, Callable
+from weakref import WeakKeyDictionary
+
+import httpx
+
+from app.logger import api_logger
+from database.dataclasses import HttpClientConfig
+
+
+@dataclass
+class _HostStats:
+    requests: int = 0
+    errors: int = 0
+    connections: int = 0
+    tls_handshakes: int = 0
+    total_time_to_headers: float = 0.0
+    http2_responses: int = 0
+
+
+class HttpClientPool:
+    def __init__(self, config: HttpClientConfig = HttpClientConfig()):
+        self.config = config
+        self._client: httpx.AsyncClient | None = None
+        self._host_stats: defaultdict[str, _HostStats] = defaultdict(_HostStats)
+        # requests that fail before a response is received are dropped with them
+        self._started_at: WeakKeyDictionary[httpx.Request, float] = WeakKeyDictionary()
+
+    def start(self) -> None:
+        if self._client is not None:
+            return
+        http2: bool = self.config.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                api_logger.warning("HTTP/2 requires `pip install httpx[http2]`")
+                http2 = False
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            timeout=self.config.timeout,
+            limits=httpx.Limits(
+                max_connections=self.config.max_connections,
+                max_keepalive_connections=self.config.max_keepalive_connections,
+                keepalive_expiry=self.config.keepalive_expiry,
+            ),
+            event_hooks={
+                "request": [self._on_request],
+                "response": [self._on_response],
+            },
+        )
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Pooled client, started on first use if the app hasn't started it"""
+        if self._client is None:
+            self.start()
+        return self._client  # type: ignore
+
+    def _trace(self, host: str) -> Callable[[str, dict], Awaitable[None]]:
+        stats: _HostStats = self._host_stats[host]
+
+        async def trace(event_name: str, info: dict) -> None:
+            # only called when a new connection is opened, not when one is reused
+            if event_name == "connection.connect_tcp.complete":
+                stats.connections += 1
+            elif event_name == "connection.start_tls.complete":
+                stats.tls_handshakes += 1
+
+        return trace
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        self._host_stats[request.url.host].requests += 1
+        request.extensions["trace"] = self._trace(request.url.host)
+        self._started_at[request] = perf_counter()
+
+    async def _on_response(self, response: httpx.Response) -> None:
+        stats: _HostStats = self._host_stats[response.request.url.host]
+        started_at: float | None = self._started_at.pop(response.request, None)
+        if started_at is not None:
+            stats.total_time_to_headers += perf_counter() - started_at
+        if response.status_code >= 400:
+            stats.errors += 1
+        if response.http_version == "HTTP/2":
+            stats.http2_responses += 1
+
+    @property
+    def stats(self) -> dict[str, dict[str, int | float]]:
+        return {
+            host: asdict(stats)
+            | {
+                "avg_time_to_headers": stats.total_time_to_headers / stats.requests
+                if stats.requests
+                else 0.0,
+                "requests_per_connection": stats.requests / stats.connections
+                if stats.connections
+                else 0.0,
+            }
+            for host, stats in self._host_stats.items()
+        }
+
+
+http_client_pool: HttpClientPool = HttpClientPool()
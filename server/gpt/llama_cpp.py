@@ -1,4 +1,4 @@
-"""This module will be spawned in process pool, so parent process can't its global variables."""
+"""This module is run by llama worker processes, so parent process can't access its global variables."""
 from typing import TYPE_CHECKING, Generator
 
 from langchain import LlamaCpp
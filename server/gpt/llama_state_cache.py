@@ -0,0 +1,193 @@
+"""
+Cache of llama.cpp states per chatroom, used by llama worker processes.
+A brief explanation of how a follow-up turn skips evaluating its history:
+    - After a generation, the state of model, including evaluated tokens and KV cache, is saved
+        under the chatroom.
+    - Before the next generation, the state is loaded if it shares a longer prefix with the prompt
+        than what the model has evaluated last. llama.cpp then only evaluates the rest of prompt.
+    - States are kept in RAM up to a budget, least recently used first out.
+        Evicted states are spilled to disk if a directory is given, up to another budget.
+"""
+import os
+import pickle
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from hashlib import sha256
+from time import perf_counter
+from typing import TYPE_CHECKING, Sequence
+
+if TYPE_CHECKING:
+    from llama_cpp import Llama, LlamaState
+
+
+@dataclass
+class _StateCacheStats:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    spills: int = 0
+    reused_tokens: int = 0
+    evaluated_tokens: int = 0
+    prompt_eval_time: float = 0.0
+    save_time: float = 0.0
+    load_time: float = 0.0
+
+
+@dataclass
+class _CachedState:
+    tokens: tuple[int, ...]
+    size: int
+    state: "LlamaState | None" = None  # None if spilled to disk
+
+
+def longest_token_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+    length: int = 0
+    for token_a, token_b in zip(a, b):
+        if token_a != token_b:
+            break
+        length += 1
+    return length
+
+
+class LlamaStateCache:
+    def __init__(
+        self,
+        capacity_bytes: int,
+        spill_dir: str | None = None,
+        spill_capacity_bytes: int = 0,
+    ):
+        self.capacity_bytes = capacity_bytes
+        self.spill_dir = spill_dir
+        self.spill_capacity_bytes = spill_capacity_bytes
+        self._in_memory: OrderedDict[str, _CachedState] = OrderedDict()
+        self._on_disk: OrderedDict[str, _CachedState] = OrderedDict()
+        self._stats = _StateCacheStats()
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            for file_name in os.listdir(spill_dir):  # left by a previous process
+                if file_name.endswith(".state"):
+                    os.remove(os.path.join(spill_dir, file_name))
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.capacity_bytes > 0
+
+    def restore(self, llm: "Llama", key: str, prompt_tokens: Sequence[int]) -> int:
+        """
+        Load state of key into llm, if it shares a longer prefix with prompt than llm does.
+        Returns number of prompt tokens that don't have to be evaluated again.
+        """
+        evaluated_prefix: int = longest_token_prefix(llm.eval_tokens, prompt_tokens)
+        cached: _CachedState | None = self._get(key)
+        if cached is None:
+            self._stats.misses += 1
+            return evaluated_prefix
+        cached_prefix: int = longest_token_prefix(cached.tokens, prompt_tokens)
+        if cached_prefix > evaluated_prefix:
+            start: float = perf_counter()
+            llm.load_state(cached.state)  # type: ignore
+            self._stats.load_time += perf_counter() - start
+            return cached_prefix
+        return evaluated_prefix
+
+    def save(self, llm: "Llama", key: str) -> None:
+        start: float = perf_counter()
+        state: "LlamaState" = llm.save_state()
+        self._stats.save_time += perf_counter() - start
+        self._discard(key)
+        self._in_memory[key] = _CachedState(
+            tokens=tuple(state.eval_tokens),
+            size=state.llama_state_size,
+            state=state,
+        )
+        while self._in_memory and self._memory_bytes > self.capacity_bytes:
+            self._evict()
+
+    def record_prompt_eval(
+        self, reused_tokens: int, evaluated_tokens: int, seconds: float
+    ) -> None:
+        """Record time taken until first token, spent evaluating the part of prompt not reused"""
+        self._stats.reused_tokens += reused_tokens
+        self._stats.evaluated_tokens += evaluated_tokens
+        self._stats.prompt_eval_time += seconds
+
+    @property
+    def stats(self) -> dict[str, int | float]:
+        stats: _StateCacheStats = self._stats
+        seconds_per_token: float = (
+            stats.prompt_eval_time / stats.evaluated_tokens
+            if stats.evaluated_tokens
+            else 0.0
+        )
+        return asdict(stats) | {
+            "entries_in_memory": len(self._in_memory),
+            "entries_on_disk": len(self._on_disk),
+            "memory_bytes": self._memory_bytes,
+            "disk_bytes": self._disk_bytes,
+            # estimated from average time to evaluate a prompt token
+            "prompt_eval_time_saved": stats.reused_tokens * seconds_per_token
+            - stats.load_time,
+        }
+
+    @property
+    def _memory_bytes(self) -> int:
+        return sum([cached.size for cached in self._in_memory.values()])
+
+    @property
+    def _disk_bytes(self) -> int:
+        return sum([cached.size for cached in self._on_disk.values()])
+
+    def _get(self, key: str) -> _CachedState | None:
+        if key in self._in_memory:
+            self._in_memory.move_to_end(key)
+            self._stats.hits += 1
+            return self._in_memory[key]
+        if key in self._on_disk:
+            cached: _CachedState = self._on_disk.pop(key)
+            path: str = self._spill_path(key)
+            try:
+                with open(path, "rb") as f:
+                    cached.state = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                return None
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+            self._stats.disk_hits += 1
+            self._in_memory[key] = cached
+            while len(self._in_memory) > 1 and self._memory_bytes > self.capacity_bytes:
+                self._evict()
+            return cached
+        return None
+
+    def _evict(self) -> None:
+        key, cached = self._in_memory.popitem(last=False)
+        self._stats.evictions += 1
+        if self.spill_dir is None or cached.size > self.spill_capacity_bytes:
+            return
+        while (
+            self._on_disk and self._disk_bytes + cached.size > self.spill_capacity_bytes
+        ):
+            self._remove_spilled(next(iter(self._on_disk)))
+        with open(self._spill_path(key), "wb") as f:
+            pickle.dump(cached.state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        cached.state = None
+        self._on_disk[key] = cached
+        self._stats.spills += 1
+
+    def _discard(self, key: str) -> None:
+        self._in_memory.pop(key, None)
+        if key in self._on_disk:
+            self._remove_spilled(key)
+
+    def _remove_spilled(self, key: str) -> None:
+        self._on_disk.pop(key, None)
+        path: str = self._spill_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(
+            self.spill_dir, sha256(key.encode()).hexdigest() + ".state"  # type: ignore
+        )
@@ -0,0 +1,582 @@
+"""
+Long-lived worker processes, each keeping one llama.cpp model loaded for its whole lifetime.
+A brief explanation of how jobs flow:
+    - A model is pinned to a fixed number of processes, which load its weights once.
+    - Jobs are sent to the least busy process of the model over a multiprocessing queue,
+        with only the prompt and context, never the model itself.
+    - Generated tokens come back through a ring buffer in shared memory,
+        read by the event loop as soon as the worker wakes it up.
+A spawned worker imports this module first, so it doesn't import `app`, `database`
+or other modules importing them at module level: they import this module back while it's partly initialized.
+"""
+import asyncio
+import multiprocessing
+import os
+import queue
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import asdict
+from itertools import count, zip_longest
+from time import perf_counter
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Any, Callable
+
+import psutil
+
+from gpt.llama_state_cache import LlamaStateCache
+from gpt.token_ring import TokenRingClosed, TokenRingReader, TokenRingWriter
+
+if TYPE_CHECKING:
+    from logging import Logger
+
+    from database.dataclasses import LlamaWorkerConfig
+    from gpt.common import UserGptContext
+
+# kinds of messages sent from worker processes
+_READY = "ready"
+_ITEM = "item"
+_ERROR = "error"
+_DONE = "done"
+_STATS = "stats"
+
+
+def _logger() -> "Logger":
+    """api_logger of app, imported on use since app imports this module"""
+    from app.logger import api_logger
+
+    return api_logger
+
+
+def _state_key(user_gpt_context: "UserGptContext") -> str:
+    return f"{user_gpt_context.user_id}:{user_gpt_context.chatroom_id}"
+
+
+class LlamaWorkerError(Exception):
+    """Error raised in a worker process, sent back as text since it may not be picklable"""
+
+
+class _JobChannel:
+    """
+    Stands in for both the queue and the done event of `llama_cpp_generation`,
+    tagging everything it puts with the job id.
+    """
+
+    def __init__(
+        self,
+        job_id: int,
+        results: TokenRingWriter,
+        cancellations: multiprocessing.Queue,
+        cancelled: set[int],
+    ):
+        self.job_id = job_id
+        self._results = results
+        self._cancellations = cancellations
+        self._cancelled = cancelled
+        self._done: bool = False
+        self.first_item_at: float | None = None
+
+    def put(self, item: Any) -> None:
+        if self.first_item_at is None:
+            self.first_item_at = perf_counter()
+        if isinstance(item, BaseException):
+            self._results.send((self.job_id, _ERROR, f"{type(item).__name__}: {item}"))
+        else:
+            self._results.send((self.job_id, _ITEM, item))
+
+    put_nowait = put
+
+    def is_set(self) -> bool:
+        while True:
+            try:
+                self._cancelled.add(self._cancellations.get_nowait())
+            except queue.Empty:
+                break
+        return self._done or self.job_id in self._cancelled
+
+    def set(self) -> None:
+        self._done = True
+
+    def clear(self) -> None:
+        self._done = False
+
+
+def _worker_main(
+    model_name: str,
+    jobs: multiprocessing.Queue,
+    results_args: tuple,
+    cancellations: multiprocessing.Queue,
+    config: "LlamaWorkerConfig",
+) -> None:
+    """Entrypoint of a worker process: load the model once, then run jobs until None is received"""
+    import app  # noqa: F401, imported before gpt modules, in the order of the server
+    from gpt.common import LLMModels
+    from gpt.llama_cpp import llama_cpp_generation, load_llama
+
+    results = TokenRingWriter(*results_args)
+    llama_cpp_model = LLMModels[model_name].value
+    llm = load_llama(llama_cpp_model)
+    if llama_cpp_model.n_threads is None:
+        # workers of a model share the core budget, instead of each taking half of the cores
+        llm.client.n_threads = max(config.core_budget // config.processes_per_model, 1)
+    if config.warmup:
+        llm.client.create_completion(prompt=" ", max_tokens=1)
+    state_cache = LlamaStateCache(
+        capacity_bytes=config.state_cache_bytes,
+        spill_dir=os.path.join(
+            config.state_spill_dir, multiprocessing.current_process().name
+        )
+        if config.state_spill_dir is not None
+        else None,
+        spill_capacity_bytes=config.state_spill_bytes,
+    )
+    try:
+        results.send((None, _READY, None))
+        cancelled: set[int] = set()
+        while True:
+            job: tuple[int, str, "UserGptContext"] | None = jobs.get()
+            if job is None:
+                break
+            job_id, prompt, user_gpt_context = job
+            # jobs arrive in order of their ids, so cancellations of older ones are stale
+            cancelled.difference_update([old for old in cancelled if old < job_id])
+            channel = _JobChannel(job_id, results, cancellations, cancelled)
+            state_key: str = _state_key(user_gpt_context)
+            is_generated: bool = False
+            try:
+                if not channel.is_set():  # skip jobs cancelled while queued
+                    if state_cache.is_enabled:
+                        # tokenized the same way as `create_completion` does
+                        prompt_tokens: list[int] = llm.client.tokenize(
+                            b" " + prompt.encode("utf-8")
+                        )
+                        reused_tokens: int = state_cache.restore(
+                            llm.client, state_key, prompt_tokens
+                        )
+                    started_at: float = perf_counter()
+                    llama_cpp_generation(
+                        llama_cpp_model,
+                        prompt,
+                        channel,
+                        channel,
+                        user_gpt_context,
+                    )
+                    is_generated = True
+            except Exception as e:
+                channel.put(e)
+            finally:
+                cancelled.discard(job_id)
+                results.send((job_id, _DONE, None))
+            if is_generated and state_cache.is_enabled:
+                # after the job is done, so saving doesn't delay its result
+                if channel.first_item_at is not None:
+                    state_cache.record_prompt_eval(
+                        reused_tokens=reused_tokens,
+                        evaluated_tokens=max(len(prompt_tokens) - reused_tokens, 1),
+                        seconds=channel.first_item_at - started_at,
+                    )
+                state_cache.save(llm.client, state_key)
+                results.send((None, _STATS, state_cache.stats))
+    except TokenRingClosed as e:
+        # results can't be delivered anymore, so exit to be replaced by a new worker
+        _logger().error(f"{multiprocessing.current_process().name}: {e}")
+    finally:
+        results.close()
+
+
+class LlamaJob:
+    """
+    Async iterator over tokens and the final result of a generation in a worker process.
+    Until a worker is free, it waits in the queue of its model, with its position updated.
+    """
+
+    def __init__(self, job_id: int, prompt: str, user_gpt_context: "UserGptContext"):
+        self.job_id = job_id
+        self.prompt = prompt
+        self.user_gpt_context = user_gpt_context
+        self.model_name: str = user_gpt_context.gpt_model.name
+        self.worker: LlamaWorker | None = None
+        self.is_done: bool = False
+        self.queue_position: int | None = None  # 0 if next to be dispatched
+        self.estimated_wait: float | None = None  # seconds, None if not known yet
+        self.updated = asyncio.Event()
+        self._on_cancel: Callable[[LlamaJob], None] | None = None
+        self._items: asyncio.Queue[tuple[str, Any]] = asyncio.Queue()
+
+    def __aiter__(self) -> "LlamaJob":
+        return self
+
+    async def __anext__(self) -> Any:
+        if self.is_done:
+            raise StopAsyncIteration
+        kind, payload = await self._items.get()
+        if kind == _DONE:
+            self.is_done = True
+            raise StopAsyncIteration
+        if kind == _ERROR:
+            return LlamaWorkerError(payload)
+        return payload
+
+    @property
+    def is_dispatched(self) -> bool:
+        return self.worker is not None
+
+    def cancel(self) -> None:
+        """Stop generating, or remove the job from queue if it is not dispatched yet"""
+        if self.is_done:
+            return
+        if self.worker is None:
+            if self._on_cancel is not None:
+                self._on_cancel(self)
+            self._deliver(_DONE, None)
+        elif self.job_id in self.worker.pending:
+            self.worker.cancellations.put(self.job_id)
+
+    def _deliver(self, kind: str, payload: Any) -> None:
+        self._items.put_nowait((kind, payload))
+
+    def _update(self, queue_position: int, estimated_wait: float | None) -> None:
+        self.queue_position = queue_position
+        self.estimated_wait = estimated_wait
+        self.updated.set()
+
+
+class _FairQueue:
+    """Queue of jobs of a model, taking turns between users so no one can hold up the others"""
+
+    def __init__(self):
+        self._by_user: OrderedDict[str, deque[LlamaJob]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return sum([len(jobs) for jobs in self._by_user.values()])
+
+    def push(self, job: LlamaJob) -> None:
+        self._by_user.setdefault(job.user_gpt_context.user_id, deque()).append(job)
+
+    def pop(self) -> LlamaJob:
+        user_id, jobs = next(iter(self._by_user.items()))
+        job: LlamaJob = jobs.popleft()
+        del self._by_user[user_id]
+        if jobs:  # the user takes the next turn after everyone else
+            self._by_user[user_id] = jobs
+        return job
+
+    def remove(self, job: LlamaJob) -> None:
+        jobs: deque[LlamaJob] | None = self._by_user.get(job.user_gpt_context.user_id)
+        if jobs is not None and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self._by_user[job.user_gpt_context.user_id]
+
+    def in_order(self) -> list[LlamaJob]:
+        """Jobs in the order they will be dispatched"""
+        return [
+            job
+            for turn in zip_longest(*self._by_user.values())
+            for job in turn
+            if job is not None
+        ]
+
+
+class LlamaWorker:
+    """Handle of a worker process in the parent process"""
+
+    def __init__(
+        self,
+        model_name: str,
+        index: int,
+        config: "LlamaWorkerConfig",
+        context: multiprocessing.context.BaseContext,
+        on_idle: Callable[["LlamaWorker"], None],
+    ):
+        self.model_name = model_name
+        self.config = config
+        self.jobs: multiprocessing.Queue = context.Queue()
+        self.results = TokenRingReader(
+            capacity=config.token_buffer_size,
+            context=context,
+            send_timeout=config.token_buffer_timeout,
+        )
+        self.cancellations: multiprocessing.Queue = context.Queue()
+        self.process = context.Process(  # type: ignore
+            target=_worker_main,
+            args=(
+                model_name,
+                self.jobs,
+                self.results.writer_args,
+                self.cancellations,
+                # as a namespace, since unpickling the dataclass would import `database` first
+                SimpleNamespace(**asdict(config)),
+            ),
+            name=f"llama-{model_name}-{index}",
+            daemon=True,
+        )
+        self.pending: dict[int, LlamaJob] = {}
+        self.jobs_done: int = 0
+        self.ready: bool = False
+        self.state_cache_stats: dict[str, int | float] = {}
+        # chatrooms whose states this worker may have cached, most recent last
+        self.recent_chatrooms: OrderedDict[str, None] = OrderedDict()
+        # moving average of seconds from dispatch to done
+        self.average_job_time: float | None = None
+        self._dispatched_at: dict[int, float] = {}
+        self._on_idle = on_idle
+        self._closing: bool = False
+
+    def start(self) -> None:
+        """Start the process, and read its results from the running event loop"""
+        self.process.start()
+        self.results.close_writer()
+        self.results.attach(
+            loop=asyncio.get_running_loop(),
+            on_messages=self._on_results,
+            on_closed=self._on_exit,
+        )
+
+    async def close(self) -> None:
+        self._closing = True
+        if self.process.is_alive():
+            self.jobs.put(None)
+            await asyncio.to_thread(
+                self.process.join, timeout=self.config.shutdown_timeout
+            )
+        if self.process.is_alive():
+            self.process.terminate()
+            await asyncio.to_thread(self.process.join)
+        self.results.close()
+        self._fail_pending("llama worker is closed")
+
+    @property
+    def is_alive(self) -> bool:
+        return not self._closing and self.process.is_alive()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of jobs sent to the worker, including the one being generated"""
+        return len(self.pending)
+
+    def submit(self, job: LlamaJob) -> None:
+        state_key: str = _state_key(job.user_gpt_context)
+        self.recent_chatrooms[state_key] = None
+        self.recent_chatrooms.move_to_end(state_key)
+        if len(self.recent_chatrooms) > self.config.recent_chatrooms_per_worker:
+            self.recent_chatrooms.popitem(last=False)
+        job.worker = self
+        self.pending[job.job_id] = job
+        self._dispatched_at[job.job_id] = perf_counter()
+        self.jobs.put((job.job_id, job.prompt, job.user_gpt_context))
+
+    def _on_results(self, results: list[tuple[int | None, str, Any]]) -> None:
+        for job_id, kind, payload in results:
+            if kind == _READY:
+                _logger().info(f"{self.process.name} loaded {self.model_name}")
+                self.ready = True
+                continue
+            if kind == _STATS:
+                self.state_cache_stats = payload
+                continue
+            job: LlamaJob | None = (
+                self.pending.pop(job_id, None)  # type: ignore
+                if kind == _DONE
+                else self.pending.get(job_id)  # type: ignore
+            )
+            if kind == _DONE:
+                self.jobs_done += 1
+                self._record_job_time(job_id)  # type: ignore
+            if job is not None:
+                job._deliver(kind, payload)
+        if not self.pending:
+            self._on_idle(self)
+
+    def _record_job_time(self, job_id: int) -> None:
+        dispatched_at: float | None = self._dispatched_at.pop(job_id, None)
+        if dispatched_at is None:
+            return
+        job_time: float = perf_counter() - dispatched_at
+        self.average_job_time = (
+            job_time
+            if self.average_job_time is None
+            else 0.8 * self.average_job_time + 0.2 * job_time
+        )
+
+    def _on_exit(self) -> None:
+        if self._closing:
+            return
+        _logger().error(f"{self.process.name} exited unexpectedly")
+        self._closing = True
+        self.results.close()
+        self._fail_pending("llama worker exited unexpectedly")
+        self._on_idle(self)  # to be replaced, if jobs are queued
+
+    def _fail_pending(self, reason: str) -> None:
+        self._dispatched_at.clear()
+        for job_id in list(self.pending):
+            job: LlamaJob | None = self.pending.pop(job_id, None)
+            if job is not None:
+                job._deliver(_ERROR, reason)
+                job._deliver(_DONE, None)
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        rss: int | None = None
+        if self.process.pid is not None and self.process.is_alive():
+            try:
+                rss = psutil.Process(self.process.pid).memory_info().rss
+            except psutil.Error:
+                pass
+        return {
+            "model": self.model_name,
+            "pid": self.process.pid,
+            "alive": self.is_alive,
+            "ready": self.ready,
+            "queue_depth": self.queue_depth,
+            "jobs_done": self.jobs_done,
+            "average_job_time": self.average_job_time,
+            "rss_bytes": rss,
+            "state_cache": self.state_cache_stats,
+        }
+
+
+class LlamaWorkerPool:
+    """
+    Scheduler of generations of llama.cpp models.
+    A brief explanation of how it shares CPU cores:
+        - Each worker process decodes one sequence at a time, with its share of the core budget
+            as threads, so a model never decodes more sequences at once than it has workers.
+        - Other generations wait in a queue per model, taking turns between users,
+            and are dispatched as soon as a worker becomes idle.
+        - Positions and estimated waits of queued generations are updated on every change.
+    """
+
+    def __init__(self, config: "LlamaWorkerConfig | None" = None):
+        self._config = config
+        self._workers: dict[str, list[LlamaWorker]] = {}
+        self._queues: defaultdict[str, _FairQueue] = defaultdict(_FairQueue)
+        self._job_ids = count()
+        # fork would copy threads and connections of the app into workers
+        self._context = multiprocessing.get_context("spawn")
+
+    @property
+    def config(self) -> "LlamaWorkerConfig":
+        if self._config is None:
+            from database.dataclasses import LlamaWorkerConfig
+
+            self._config = LlamaWorkerConfig()
+        return self._config
+
+    def start(self) -> None:
+        """Start workers of the configured models, which load their weights in background"""
+        for model_name in self.config.models:
+            self._get_workers(model_name)
+
+    async def close(self) -> None:
+        for fair_queue in self._queues.values():
+            for job in fair_queue.in_order():
+                job._deliver(_ERROR, "llama worker is closed")
+                job._deliver(_DONE, None)
+        self._queues.clear()
+        workers: list[LlamaWorker] = [
+            worker for workers in self._workers.values() for worker in workers
+        ]
+        self._workers.clear()
+        await asyncio.gather(*[worker.close() for worker in workers])
+
+    def submit(self, prompt: str, user_gpt_context: "UserGptContext") -> LlamaJob:
+        """Queue a generation for the model of context, and dispatch it if a worker is idle"""
+        job = LlamaJob(
+            job_id=next(self._job_ids),
+            prompt=prompt,
+            user_gpt_context=user_gpt_context,
+        )
+        job._on_cancel = self._remove
+        self._queues[job.model_name].push(job)
+        self._schedule(job.model_name)
+        return job
+
+    def _remove(self, job: LlamaJob) -> None:
+        self._queues[job.model_name].remove(job)
+        self._update_positions(job.model_name)
+
+    def _schedule(self, model_name: str) -> None:
+        """
+        Dispatch queued jobs to idle workers.
+        Among them, the one which served the chatroom last is preferred, as it may have its state.
+        """
+        fair_queue: _FairQueue = self._queues[model_name]
+        if not fair_queue:
+            return
+        idle_workers: list[LlamaWorker] = [
+            worker
+            for worker in self._get_workers(model_name)
+            if worker.is_alive and worker.queue_depth == 0
+        ]
+        while idle_workers and fair_queue:
+            job: LlamaJob = fair_queue.pop()
+            state_key: str = _state_key(job.user_gpt_context)
+            worker: LlamaWorker = min(
+                idle_workers,
+                key=lambda worker: state_key not in worker.recent_chatrooms,
+            )
+            idle_workers.remove(worker)
+            worker.submit(job)
+            job.updated.set()
+        self._update_positions(model_name)
+
+    def _update_positions(self, model_name: str) -> None:
+        workers: list[LlamaWorker] = self._workers.get(model_name, [])
+        job_times: list[float] = [
+            worker.average_job_time
+            for worker in workers
+            if worker.average_job_time is not None
+        ]
+        average_job_time: float | None = (
+            sum(job_times) / len(job_times) if job_times else None
+        )
+        for position, job in enumerate(self._queues[model_name].in_order()):
+            job._update(
+                queue_position=position,
+                # every worker has to finish a job for the next round of queue to start
+                estimated_wait=(position // max(len(workers), 1) + 1) * average_job_time
+                if average_job_time is not None
+                else None,
+            )
+
+    def _on_idle(self, worker: LlamaWorker) -> None:
+        self._schedule(worker.model_name)
+
+    def _get_workers(self, model_name: str) -> list[LlamaWorker]:
+        """Workers of model, starting them if not started yet, and replacing dead ones"""
+        workers: list[LlamaWorker] = self._workers.setdefault(model_name, [])
+        if not workers and model_name not in self.config.models:
+            _logger().warning(
+                f"{model_name} is loaded on first use, add it to LLAMA_WORKER_MODELS to load it at startup"
+            )
+        for index in range(self.config.processes_per_model):
+            if index < len(workers) and workers[index].is_alive:
+                continue
+            worker = LlamaWorker(
+                model_name=model_name,
+                index=index,
+                config=self.config,
+                context=self._context,
+                on_idle=self._on_idle,
+            )
+            worker.start()
+            if index < len(workers):
+                workers[index] = worker
+            else:
+                workers.append(worker)
+        return workers
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            "workers": [
+                worker.stats for workers in self._workers.values() for worker in workers
+            ],
+            "queued": {
+                model_name: len(fair_queue)
+                for model_name, fair_queue in self._queues.items()
+            },
+        }
+
+
+llama_worker_pool: LlamaWorkerPool = LlamaWorkerPool()
@@ -1,6 +1,3 @@
-import asyncio
-
-from app.dependencies import process_manager, process_pool_executor
 from app.exceptions import (
     GptInterruptedException,
     GptModelNotImplementedException,
@@ -14,7 +11,7 @@ from gpt.generation import (
     generate_from_openai,
     message_history_organizer,
 )
-from gpt.llama_cpp import llama_cpp_generation
+from gpt.llama_worker import llama_worker_pool
 from gpt.message_manager import MessageManager
 from gpt.websocket_manager import SendToWebsocket
 
@@ -50,6 +47,7 @@ class MessageHandler:
             user_gpt_context=buffer.current_user_gpt_context,
             content=msg,
             role=GptRoles.USER,
+            calculated_tokens_to_use=user_token,
         )
 
     @staticmethod
@@ -71,39 +69,27 @@ class MessageHandler:
             elif isinstance(
                 buffer.current_user_gpt_context.gpt_model.value, LlamaCppModel
             ):
-                m_queue, m_done = process_manager.Queue(), process_manager.Event()
-                loop = asyncio.get_event_loop()
                 prompt: str = message_history_organizer(
                     user_gpt_context=buffer.current_user_gpt_context,
                     return_as_string=True,
                 )
+                job = llama_worker_pool.submit(
+                    prompt=prompt,
+                    user_gpt_context=buffer.current_user_gpt_context,
+                )
                 try:
-                    await asyncio.gather(
-                        SendToWebsocket.stream(
-                            buffer=buffer,
-                            finish=True,
-                            chunk_size=1,
-                            model_name=current_model.name,
-                            stream=generate_from_llama_cpp(
-                                user_gpt_context=buffer.current_user_gpt_context,
-                                m_queue=m_queue,
-                                m_done=m_done,
-                            ),
-                        ),
-                        loop.run_in_executor(
-                            process_pool_executor,
-                            llama_cpp_generation,
-                            buffer.current_user_gpt_context.gpt_model.value,
-                            prompt,
-                            m_queue,
-                            m_done,
-                            buffer.current_user_gpt_context,
+                    await SendToWebsocket.queue_status(buffer=buffer, job=job)
+                    await SendToWebsocket.stream(
+                        buffer=buffer,
+                        finish=True,
+                        model_name=current_model.name,
+                        stream=generate_from_llama_cpp(
+                            user_gpt_context=buffer.current_user_gpt_context,
+                            job=job,
                         ),
                     )
-                except Exception as e:
-                    raise e
                 finally:
-                    m_done.set()
+                    job.cancel()
             else:
                 raise GptModelNotImplementedException(
                     msg="Model not implemented. Please contact administrator."
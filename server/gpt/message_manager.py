@@ -1,5 +1,3 @@
-import asyncio
-
 from gpt.cache_manager import ChatGptCacheManager
 from gpt.common import GptRoles, MessageHistory, UserGptContext
 
@@ -36,28 +34,15 @@ class MessageManager:
             f"{role}_message_tokens",
             getattr(user_gpt_context, f"{role}_message_tokens") + tokens,
         )
-        num_of_deleted_histories: int = user_gpt_context.ensure_token_not_exceed()
-        await ChatGptCacheManager.append_message_history(
-            user_id=user_gpt_context.user_id,
-            chatroom_id=user_gpt_context.chatroom_id,
-            role=role,
-            message_history=message_history,
-        )
-        if num_of_deleted_histories > 0:
-            asyncio.gather(
-                ChatGptCacheManager.lpop_message_history(
-                    user_id=user_gpt_context.user_id,
-                    chatroom_id=user_gpt_context.chatroom_id,
-                    role=GptRoles.GPT,
-                    count=num_of_deleted_histories,
-                ),
-                ChatGptCacheManager.lpop_message_history(
-                    user_id=user_gpt_context.user_id,
-                    chatroom_id=user_gpt_context.chatroom_id,
-                    role=GptRoles.USER,
-                    count=num_of_deleted_histories,
-                ),
+        # appended message is pushed and histories are trimmed in one atomic call
+        if (
+            await ChatGptCacheManager.append_and_trim_message_history(
+                user_gpt_context=user_gpt_context, role=role
             )
+            is None
+        ):
+            user_gpt_context.ensure_token_not_exceed()
+            await ChatGptCacheManager.sync_context(user_gpt_context)
 
     @staticmethod
     async def pop_message_history_safely(
@@ -72,32 +57,26 @@ class MessageManager:
         If rpop is False, remove the first message history from the list and return it.
         """
         role = GptRoles.get_name(role).lower()
-        try:
-            message_history: MessageHistory = getattr(
-                user_gpt_context, f"{role}_message_histories"
-            ).pop()
-        except IndexError:
-            return None
-        setattr(
-            user_gpt_context,
-            f"{role}_message_tokens",
-            getattr(user_gpt_context, f"{role}_message_tokens")
-            - message_history.tokens,
+        message_histories: list[MessageHistory] = getattr(
+            user_gpt_context, f"{role}_message_histories"
         )
-        if rpop:
-            await ChatGptCacheManager.rpop_message_history(
-                user_id=user_gpt_context.user_id,
-                chatroom_id=user_gpt_context.chatroom_id,
-                role=role,
-                count=count,
-            )
-        else:
-            await ChatGptCacheManager.lpop_message_history(
-                user_id=user_gpt_context.user_id,
-                chatroom_id=user_gpt_context.chatroom_id,
-                role=role,
-                count=count,
+        message_history: MessageHistory | None = None
+        for _ in range(count if count is not None else 1):
+            try:
+                message_history = (
+                    message_histories.pop() if rpop else message_histories.pop(0)
+                )
+            except IndexError:
+                break
+            setattr(
+                user_gpt_context,
+                f"{role}_message_tokens",
+                getattr(user_gpt_context, f"{role}_message_tokens")
+                - message_history.tokens,
             )
+        if message_history is None:
+            return None
+        await ChatGptCacheManager.sync_context(user_gpt_context)
         return message_history
 
     @staticmethod
@@ -122,22 +101,8 @@ class MessageManager:
             + new_tokens
             - old_tokens,
         )
-        num_of_deleted_histories: int = user_gpt_context.ensure_token_not_exceed()
-        await ChatGptCacheManager.set_message_history(
-            user_id=user_gpt_context.user_id,
-            chatroom_id=user_gpt_context.chatroom_id,
-            role=role,
-            message_history=message_history_to_change,
-            index=index,
-        )
-        if num_of_deleted_histories > 0:
-            for role in (GptRoles.GPT, GptRoles.USER):
-                await ChatGptCacheManager.lpop_message_history(
-                    user_id=user_gpt_context.user_id,
-                    chatroom_id=user_gpt_context.chatroom_id,
-                    role=role,
-                    count=num_of_deleted_histories,
-                )
+        user_gpt_context.ensure_token_not_exceed()
+        await ChatGptCacheManager.sync_context(user_gpt_context)
 
     @staticmethod
     async def clear_message_history_safely(
@@ -147,8 +112,4 @@ class MessageManager:
         role = GptRoles.get_name(role).lower()
         setattr(user_gpt_context, f"{role}_message_histories", [])
         setattr(user_gpt_context, f"{role}_message_tokens", 0)
-        await ChatGptCacheManager.delete_message_history(
-            user_id=user_gpt_context.user_id,
-            chatroom_id=user_gpt_context.chatroom_id,
-            role=role,
-        )
+        await ChatGptCacheManager.sync_context(user_gpt_context)
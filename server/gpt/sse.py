@@ -0,0 +1,90 @@
+"""
+Incremental decoder of server-sent events, fed with bytes as they arrive from a stream.
+A brief explanation of how it stays O(total bytes):
+    - Bytes are split on line endings once they arrive; only the unterminated tail is kept.
+    - Lines are split on ASCII line endings, so multi-byte characters are never cut in half.
+    - An event is dispatched on an empty line, with its `data:` lines joined by newlines.
+"""
+from typing import AsyncIterator
+
+
+class SSEDecoder:
+    done_data: str = "[DONE]"
+
+    def __init__(self):
+        self._buffer: bytearray = bytearray()
+        self._data_lines: list[str] = []
+
+    def feed(self, chunk: bytes) -> list[str]:
+        """Feed a chunk of bytes, and return data of every event completed by it"""
+        self._buffer += chunk
+        if b"\r" in self._buffer:
+            # "\n" of "\r\n" may arrive with the next chunk, so a trailing "\r" waits
+            pending_cr: bool = self._buffer.endswith(b"\r")
+            if pending_cr:
+                del self._buffer[-1]
+            self._buffer = self._buffer.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+            if pending_cr:
+                self._buffer += b"\r"
+        *lines, rest = self._buffer.split(b"\n")
+        if not lines:
+            return []
+        self._buffer = rest
+        completed: list[str] = []
+        for line in lines:
+            data: str | None = self._process_line(line)
+            if data is not None:
+                completed.append(data)
+        return completed
+
+    def flush(self) -> list[str]:
+        """Dispatch what is left when the stream ends without a trailing empty line"""
+        completed: list[str] = []
+        if self._buffer:
+            self._process_line(bytes(self._buffer))
+            self._buffer.clear()
+        data: str | None = self._process_line(b"")
+        if data is not None:
+            completed.append(data)
+        return completed
+
+    def _process_line(self, line: bytes | bytearray) -> str | None:
+        """Process a line without its line ending, returning data if an event is dispatched"""
+        if not line:
+            if not self._data_lines:
+                return None
+            data: str = "\n".join(self._data_lines)
+            self._data_lines.clear()
+            return data
+        if line.startswith(b":"):
+            # comment
+            return None
+        field, _, value = line.partition(b":")
+        if field == b"data":
+            self._data_lines.append(
+                (value[1:] if value.startswith(b" ") else value).decode("utf-8")
+            )
+        # "event", "id" and "retry" fields are not used by completion streams
+        return None
+
+
+async def aiter_sse_data(byte_stream: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    Yield data of every event in byte stream, until the stream is done.
+    Bytes after the done event are still drained, so the connection can be reused.
+    """
+    decoder = SSEDecoder()
+    done: bool = False
+    async for chunk in byte_stream:
+        if done:
+            continue
+        for data in decoder.feed(chunk):
+            if data == decoder.done_data:
+                done = True
+                break
+            yield data
+    if not done:
+        for data in decoder.flush():
+            if data == decoder.done_data:
+                break
+            yield data
@@ -15,11 +15,16 @@ from app.exceptions import (
     MySQLConnectionError,
 )
 from app.logger import api_logger
-from database.schemas import MessageFromWebsocket
-from gpt.buffer import BufferedUserContext
+from database.schemas import FileUploadEnd, FileUploadStart, MessageFromWebsocket
+from gpt.buffer import BufferedUserContext, ChatroomLane
 from gpt.cache_manager import ChatGptCacheManager
-from gpt.commands import command_handler, get_contexts_sorted_from_recent_to_past
-from gpt.common import GptRoles
+from gpt.commands import (
+    ChatGptCommands,
+    command_handler,
+    get_context_stubs_sorted_from_recent_to_past,
+)
+from gpt.common import GptRoles, UserGptContext, UserGptContextStub
+from gpt.fileloader import SpooledUpload
 from gpt.message_handler import MessageHandler
 from gpt.message_manager import MessageManager
 from gpt.vectorstore_manager import VectorStoreManager
@@ -32,23 +37,42 @@ class ChatGptStreamManager:
         cls, websocket: WebSocket, user_id: int, chatroom_id: int
     ) -> None:
         try:
+            sorted_contexts: list[
+                UserGptContext | UserGptContextStub
+            ] = await get_context_stubs_sorted_from_recent_to_past(
+                user_id=user_id,
+                chatroom_ids=await ChatGptCacheManager.get_all_chatrooms(
+                    user_id=user_id
+                ),
+            )
+            # only the initial chatroom is loaded with its histories
+            initial_index: int = next(
+                (
+                    index
+                    for index, stub in enumerate(sorted_contexts)
+                    if stub.chatroom_id == chatroom_id
+                ),
+                0,
+            )
+            sorted_contexts[initial_index] = await ChatGptCacheManager.read_context(
+                user_id=user_id,
+                chatroom_id=sorted_contexts[initial_index].chatroom_id,
+            )
             buffer: BufferedUserContext = BufferedUserContext(
                 user_id=user_id,
                 websocket=websocket,
                 initial_chatroom_id=chatroom_id,
-                sorted_contexts=await get_contexts_sorted_from_recent_to_past(
-                    user_id=user_id,
-                    chatroom_ids=await ChatGptCacheManager.get_all_chatrooms(
-                        user_id=user_id
-                    ),
-                ),
+                sorted_contexts=sorted_contexts,
             )
             loop = asyncio.get_event_loop()
             loop.create_task(SendToWebsocket.init(buffer=buffer))
-            await asyncio.gather(
-                cls._websocket_receiver(buffer=buffer),
-                cls._websocket_sender(buffer=buffer),
-            )
+            try:
+                await asyncio.gather(
+                    cls._websocket_receiver(buffer=buffer),
+                    cls._websocket_sender(buffer=buffer),
+                )
+            finally:
+                buffer.cancel_tasks()
         except ChatroomNotFound:
             api_logger.error("Chatroom not found", exc_info=True)
             return
@@ -85,34 +109,136 @@ class ChatGptStreamManager:
                 chatroom_id=buffer.current_chatroom_id,
             )
 
-    @staticmethod
-    async def _websocket_receiver(buffer: BufferedUserContext) -> None:
+    @classmethod
+    async def _websocket_receiver(cls, buffer: BufferedUserContext) -> None:
         filename: str = ""
+        upload: SpooledUpload | None = None  # chunked upload in progress
         # loop until connection is closed
-        while True:
-            rcvd = await buffer.websocket.receive()
-            received_text: str | None = rcvd.get("text")
-            received_bytes: bytes | None = rcvd.get("bytes")
-            if received_text is not None:
-                try:
-                    received_json: dict = orjson_loads(received_text)
-                    assert isinstance(received_json, dict)
-                except (JSONDecodeError, AssertionError):
-                    if received_text == "stop":
-                        buffer.done.set()
-                else:
+        try:
+            while True:
+                rcvd = await buffer.websocket.receive()
+                received_text: str | None = rcvd.get("text")
+                received_bytes: bytes | None = rcvd.get("bytes")
+                if received_text is not None:
                     try:
-                        message_from_websocket = MessageFromWebsocket(**received_json)
-                        await buffer.queue.put(message_from_websocket)
-                    except ValidationError:
-                        if "filename" in received_json:
-                            filename = received_json["filename"]
-            elif received_bytes is not None:
-                await buffer.queue.put(
-                    await VectorStoreManager.embed_file_to_vectorstore(
-                        file=received_bytes, filename=filename
-                    )
+                        received_json: dict = orjson_loads(received_text)
+                        assert isinstance(received_json, dict)
+                    except (JSONDecodeError, AssertionError):
+                        if received_text == "stop":
+                            buffer.stop(chatroom_id=buffer.current_chatroom_id)
+                    else:
+                        try:
+                            message_from_websocket = MessageFromWebsocket(
+                                **received_json
+                            )
+                            await buffer.queue.put(message_from_websocket)
+                        except ValidationError:
+                            if "upload" in received_json:
+                                upload = await cls._handle_upload_frame(
+                                    buffer=buffer,
+                                    received_json=received_json,
+                                    upload=upload,
+                                )
+                            elif "filename" in received_json:
+                                filename = received_json["filename"]
+                elif received_bytes is not None:
+                    if upload is not None:
+                        upload = await cls._handle_upload_bytes(
+                            buffer=buffer, received_bytes=received_bytes, upload=upload
+                        )
+                    else:
+                        # whole file in one frame, after a frame of its filename
+                        whole_file: SpooledUpload | None = (
+                            await cls._handle_upload_bytes(
+                                buffer=buffer,
+                                received_bytes=received_bytes,
+                                upload=SpooledUpload(filename=filename),
+                            )
+                        )
+                        if whole_file is not None:
+                            await cls._finish_upload(buffer=buffer, upload=whole_file)
+        finally:
+            if upload is not None:
+                upload.close()
+
+    @staticmethod
+    async def _handle_upload_bytes(
+        buffer: BufferedUserContext, received_bytes: bytes, upload: SpooledUpload
+    ) -> SpooledUpload | None:
+        """Write a chunk of upload, returning None if the upload failed"""
+        try:
+            upload.write(received_bytes)
+            return upload
+        except ValueError as e:
+            upload.close()
+            await buffer.queue.put(f"Upload failed: {e}")
+            return None
+
+    @classmethod
+    async def _handle_upload_frame(
+        cls,
+        buffer: BufferedUserContext,
+        received_json: dict,
+        upload: SpooledUpload | None,
+    ) -> SpooledUpload | None:
+        """Start or end a chunked upload, returning the upload in progress"""
+        try:
+            if received_json["upload"] == "start":
+                upload_start = FileUploadStart(**received_json)
+                if upload is not None:  # abandoned by client
+                    upload.close()
+                    upload = None
+                return SpooledUpload(
+                    filename=upload_start.filename, size=upload_start.size
+                )
+            upload_end = FileUploadEnd(**received_json)
+            if upload is None:
+                raise ValueError("No upload in progress")
+        except (ValidationError, ValueError) as e:
+            if upload is not None:
+                upload.close()
+            await buffer.queue.put(f"Upload failed: {e}")
+            return None
+        await cls._finish_upload(
+            buffer=buffer, upload=upload, sha256_hex=upload_end.sha256
+        )
+        return None
+
+    @classmethod
+    async def _finish_upload(
+        cls,
+        buffer: BufferedUserContext,
+        upload: SpooledUpload,
+        sha256_hex: str | None = None,
+    ) -> None:
+        """Check upload, then embed it in background, so "stop" is received meanwhile"""
+        try:
+            upload.finish(sha256_hex=sha256_hex)
+        except ValueError as e:
+            upload.close()
+            await buffer.queue.put(f"Upload failed: {e}")
+            return
+        # tagged with the chatroom of upload, even if chatroom is changed while embedding
+        tags: dict[str, str] = {
+            "user_id": str(buffer.user_id),
+            "chatroom_id": str(buffer.current_chatroom_id),
+        }
+        buffer.run_in_background(
+            cls._embed_file(buffer=buffer, upload=upload, tags=tags)
+        )
+
+    @staticmethod
+    async def _embed_file(
+        buffer: BufferedUserContext, upload: SpooledUpload, tags: dict[str, str]
+    ) -> None:
+        try:
+            await buffer.queue.put(
+                await VectorStoreManager.embed_file_to_vectorstore(
+                    file=upload.file, filename=upload.filename, tags=tags
                 )
+            )
+        finally:
+            upload.close()
 
     @classmethod
     async def _websocket_sender(cls, buffer: BufferedUserContext) -> None:
@@ -133,22 +259,26 @@ class ChatGptStreamManager:
                             buffer=buffer,
                             changed_chatroom_id=item.chatroom_id,
                         )
-                    elif item.msg.startswith("/"):
-                        # if user message is command, handle command
-                        splitted: list[str] = item.msg[1:].split(" ")
-                        await command_handler(
-                            callback_name=splitted[0],
-                            callback_args=splitted[1:],
-                            buffer=buffer,
+                    elif item.msg.startswith("/") and ChatGptCommands._is_context_free(
+                        item.msg[1:].split(" ")[0]
+                    ):
+                        # commands like /ping are answered without waiting for generations
+                        buffer.run_in_background(
+                            cls._handle_message(buffer=buffer, item=item)
                         )
                     else:
-                        await MessageHandler.user(
-                            msg=item.msg,
-                            buffer=buffer,
-                        )
-                        await MessageHandler.gpt(
-                            buffer=buffer,
-                        )
+                        lane: ChatroomLane = buffer.lane_of(item.chatroom_id)
+                        if lane.is_idle:
+                            # another session may have changed this chatroom meanwhile
+                            await cls._refresh_context(
+                                buffer=buffer,
+                                index=buffer.find_index_of_chatroom(item.chatroom_id),
+                            )
+                        if lane.task is None:
+                            lane.task = asyncio.create_task(
+                                cls._chatroom_lane(buffer=buffer, lane=lane)
+                            )
+                        lane.queue.put_nowait(item)
             except asyncio.CancelledError:
                 break
             except GptException as gpt_exception:
@@ -156,6 +286,49 @@ class ChatGptStreamManager:
                     buffer=buffer, gpt_exception=gpt_exception
                 )
 
+    @classmethod
+    async def _chatroom_lane(
+        cls, buffer: BufferedUserContext, lane: ChatroomLane
+    ) -> None:
+        """Handle messages of a chatroom in order, generating for up to `max_concurrent_lanes` chatrooms at once"""
+        while True:
+            item: MessageFromWebsocket = await lane.queue.get()
+            lane.is_handling = True
+            try:
+                async with buffer.lane_semaphore:
+                    buffer.pin_lane(lane)
+                    await cls._handle_message(buffer=lane.buffer, item=item)
+            except Exception as e:
+                api_logger.error(
+                    f"Exception in chatroom {lane.chatroom_id}: {e}", exc_info=True
+                )
+            finally:
+                lane.is_handling = False
+
+    @classmethod
+    async def _handle_message(
+        cls, buffer: BufferedUserContext, item: MessageFromWebsocket
+    ) -> None:
+        try:
+            if item.msg.startswith("/"):
+                # if user message is command, handle command
+                splitted: list[str] = item.msg[1:].split(" ")
+                await command_handler(
+                    callback_name=splitted[0],
+                    callback_args=splitted[1:],
+                    buffer=buffer,
+                )
+            else:
+                await MessageHandler.user(
+                    msg=item.msg,
+                    buffer=buffer,
+                )
+                await MessageHandler.gpt(
+                    buffer=buffer,
+                )
+        except GptException as gpt_exception:
+            await cls._gpt_exception_handler(buffer=buffer, gpt_exception=gpt_exception)
+
     @staticmethod
     async def _gpt_exception_handler(
         buffer: BufferedUserContext, gpt_exception: GptException
@@ -213,9 +386,44 @@ class ChatGptStreamManager:
                 f"Received chatroom_id {buffer.current_chatroom_id} is not in chatroom_ids {buffer.sorted_chatroom_ids}"
             )
         else:
-            # if received chatroom_id is in chatroom_ids, get context from memory
+            # if received chatroom_id is in chatroom_ids, get context from context cache
+            previous_index: int | None = buffer.find_index_of_chatroom(
+                buffer.current_chatroom_id
+            )
+            lane: ChatroomLane | None = buffer.lanes.get(changed_chatroom_id)  # type: ignore
+            if lane is not None and not lane.is_idle:
+                # a generating chatroom keeps the context it is generating in
+                buffer.replace_context(
+                    index=index, user_gpt_context=lane.buffer.current_user_gpt_context
+                )
+            else:
+                await ChatGptStreamManager._refresh_context(buffer=buffer, index=index)
             buffer.change_context_to(index=index)
+            if previous_index is not None and previous_index != index:
+                # unselected chatroom keeps only its stub, its histories stay in context cache
+                buffer.replace_context(
+                    index=previous_index,
+                    user_gpt_context=UserGptContextStub.from_context(
+                        buffer.sorted_contexts[previous_index]  # type: ignore
+                    ),
+                )
             await SendToWebsocket.init(
                 buffer=buffer,
                 send_chatroom_ids=False,
             )
+
+    @staticmethod
+    async def _refresh_context(buffer: BufferedUserContext, index: int | None) -> None:
+        """
+        Replace context at index with the one in context cache of this worker,
+        which is read again from redis if another worker or session has changed it.
+        """
+        if index is None:
+            return
+        buffer.replace_context(
+            index=index,
+            user_gpt_context=await ChatGptCacheManager.read_context(
+                user_id=buffer.user_id,
+                chatroom_id=buffer.sorted_chatroom_ids[index],
+            ),
+        )
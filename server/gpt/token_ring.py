@@ -0,0 +1,214 @@
+"""
+Ring buffer in shared memory, carrying messages from one worker process to the event loop.
+A brief explanation of how a message is passed:
+    - The writer copies a length-prefixed, json encoded message into shared memory.
+    - Then it writes the new end position into a pipe. The write wakes up the reader,
+        and being a system call, it publishes the copied bytes before the position.
+    - The reader is a callback of the event loop on the pipe, so no thread is involved.
+        It reads every message up to the last position, then frees their space.
+    - Freeing space writes a byte into another pipe, which wakes up a writer waiting on a full ring.
+        The writer gives up after a timeout, or at once if the reader has closed its end.
+"""
+import os
+from asyncio import AbstractEventLoop
+from multiprocessing.connection import Connection
+from multiprocessing.context import BaseContext
+from multiprocessing.shared_memory import SharedMemory
+from select import select
+from time import monotonic
+from typing import Any, Callable
+
+import orjson
+
+# read position, owned by the reader, is kept in the first cache line
+_HEADER_SIZE: int = 64
+_POSITION_SIZE: int = 8
+_LENGTH_SIZE: int = 4
+
+
+class TokenRingClosed(Exception):
+    """The reader is gone, or hasn't freed space of a full ring in time"""
+
+
+class _Ring:
+    def __init__(self, shm: SharedMemory, capacity: int):
+        self.shm = shm
+        self.capacity = capacity
+        self.data: memoryview = shm.buf[_HEADER_SIZE : _HEADER_SIZE + capacity]  # type: ignore
+
+    @property
+    def read_position(self) -> int:
+        return int.from_bytes(self.shm.buf[:_POSITION_SIZE], "little")  # type: ignore
+
+    @read_position.setter
+    def read_position(self, position: int) -> None:
+        self.shm.buf[:_POSITION_SIZE] = position.to_bytes(_POSITION_SIZE, "little")  # type: ignore
+
+    def write_at(self, position: int, data: bytes) -> None:
+        start: int = position % self.capacity
+        head: int = min(len(data), self.capacity - start)
+        self.data[start : start + head] = data[:head]
+        if head < len(data):
+            self.data[: len(data) - head] = data[head:]
+
+    def read_at(self, position: int, size: int) -> bytes:
+        start: int = position % self.capacity
+        head: int = min(size, self.capacity - start)
+        if head == size:
+            return bytes(self.data[start : start + size])
+        return bytes(self.data[start:]) + bytes(self.data[: size - head])
+
+    def release(self) -> None:
+        self.data.release()
+        self.shm.close()
+
+
+class TokenRingWriter:
+    """Writing end, used in the worker process"""
+
+    def __init__(
+        self,
+        name: str,
+        capacity: int,
+        wakeup: Connection,
+        freed: Connection,
+        timeout: float,
+    ):
+        self._ring = _Ring(SharedMemory(name=name), capacity)
+        self._wakeup_fd: int = wakeup.fileno()
+        self._wakeup = wakeup  # keeps the file descriptor open
+        self._freed = freed
+        self._timeout = timeout
+        self._write_position: int = 0
+        self._is_closed: bool = False
+
+    def send(self, message: Any) -> None:
+        encoded: bytes = orjson.dumps(message)
+        frame: bytes = len(encoded).to_bytes(_LENGTH_SIZE, "little") + encoded
+        if len(frame) > self._ring.capacity:
+            raise ValueError(
+                f"message of {len(frame)} bytes exceeds ring buffer of {self._ring.capacity} bytes"
+            )
+        self._wait_for_space(len(frame))
+        self._ring.write_at(self._write_position, frame)
+        self._write_position += len(frame)
+        os.write(
+            self._wakeup_fd, self._write_position.to_bytes(_POSITION_SIZE, "little")
+        )
+
+    def _wait_for_space(self, size: int) -> None:
+        """Block until the reader frees space of size, without spinning"""
+        if self._is_closed:
+            raise TokenRingClosed("reader of ring buffer is gone")
+        deadline: float = monotonic() + self._timeout
+        while (
+            self._write_position + size - self._ring.read_position > self._ring.capacity
+        ):
+            remaining: float = deadline - monotonic()
+            if remaining <= 0:
+                self._is_closed = True
+                raise TokenRingClosed(
+                    f"reader hasn't freed space of ring buffer in {self._timeout} seconds"
+                )
+            if select([self._freed], [], [], remaining)[0] and not os.read(
+                self._freed.fileno(), 1 << 16
+            ):
+                self._is_closed = True
+                raise TokenRingClosed("reader of ring buffer is gone")
+
+    def close(self) -> None:
+        self._ring.release()
+        self._wakeup.close()
+        self._freed.close()
+
+
+class TokenRingReader:
+    """Reading end, owning the shared memory, used in the process of the event loop"""
+
+    def __init__(self, capacity: int, context: BaseContext, send_timeout: float):
+        self._ring = _Ring(
+            SharedMemory(create=True, size=_HEADER_SIZE + capacity), capacity
+        )
+        self._ring.read_position = 0
+        self._wakeup, self._wakeup_writer = context.Pipe(duplex=False)
+        os.set_blocking(self._wakeup.fileno(), False)
+        self._freed_reader, self._freed = context.Pipe(duplex=False)
+        os.set_blocking(self._freed.fileno(), False)
+        self._send_timeout = send_timeout
+        self._loop: AbstractEventLoop | None = None
+
+    @property
+    def writer_args(self) -> tuple[str, int, Connection, Connection, float]:
+        """Arguments of `TokenRingWriter`, to be passed to the worker process"""
+        return (
+            self._ring.shm.name,
+            self._ring.capacity,
+            self._wakeup_writer,
+            self._freed_reader,
+            self._send_timeout,
+        )
+
+    def close_writer(self) -> None:
+        """Close the worker's ends of pipes in this process, once the worker has inherited them"""
+        self._wakeup_writer.close()
+        self._freed_reader.close()
+
+    def attach(
+        self,
+        loop: AbstractEventLoop,
+        on_messages: Callable[[list[Any]], None],
+        on_closed: Callable[[], None],
+    ) -> None:
+        """Call `on_messages` from the event loop when messages arrive, and `on_closed` when the writer exits"""
+
+        def on_readable() -> None:
+            try:
+                positions: bytes = os.read(self._wakeup.fileno(), 1 << 16)
+            except BlockingIOError:
+                return
+            if not positions:
+                self.detach()
+                on_closed()
+                return
+            # positions are written whole and in order, so the last one covers the others
+            on_messages(
+                self._read_until(int.from_bytes(positions[-_POSITION_SIZE:], "little"))
+            )
+
+        self._loop = loop
+        loop.add_reader(self._wakeup.fileno(), on_readable)
+
+    def detach(self) -> None:
+        if self._loop is not None:
+            self._loop.remove_reader(self._wakeup.fileno())
+            self._loop = None
+
+    def close(self) -> None:
+        self.detach()
+        self._wakeup.close()
+        self._freed.close()
+        for connection in (self._wakeup_writer, self._freed_reader):
+            if not connection.closed:
+                connection.close()
+        self._ring.release()
+        self._ring.shm.unlink()
+
+    def _read_until(self, end: int) -> list[Any]:
+        messages: list[Any] = []
+        position: int = self._ring.read_position
+        while position < end:
+            size: int = int.from_bytes(
+                self._ring.read_at(position, _LENGTH_SIZE), "little"
+            )
+            messages.append(
+                orjson.loads(self._ring.read_at(position + _LENGTH_SIZE, size))
+            )
+            position += _LENGTH_SIZE + size
+        self._ring.read_position = position
+        try:
+            os.write(self._freed.fileno(), b"\0")
+        except BlockingIOError:
+            pass  # pipe is full of wakeups the writer hasn't read yet
+        except BrokenPipeError:
+            pass  # writer has exited
+        return messages
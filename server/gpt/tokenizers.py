@@ -2,46 +2,166 @@
 This module contains the tokenizer classes for the GPT-2 and GPT-Neo models.
 A brief explanation of the tokenizer classes:
     - BaseTokenizer: The base class for all tokenizers. It is an abstract class
-        that defines the interface for all tokenizers.
+        that defines the interface for all tokenizers. Token counts are cached by
+        hash of content, so the same message is never encoded twice for counting.
     - OpenAITokenizer: The tokenizer for the GPT-2 model. It uses the
-        `transformers` library to tokenize the input.
+        `tiktoken` library to tokenize the input.
     - LlamaTokenizer: The tokenizer for the GPT-Neo model. It uses the
-        `transformers` library to tokenize the input.
+        `transformers` library to tokenize the input, with the fast tokenizer if available.
 Tokenization is the process of converting a string into a list of integers.
+Backends are imported and loaded on first use, and `get_tokenizer` shares one tokenizer
+per name, so importing models doesn't load any tokenizer.
 """
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
+from typing import Any, TypeVar
 
-import transformers
-from tiktoken.model import get_encoding
+from app.logger import api_logger
+from database.dataclasses import TokenizerConfig
 
 
 class BaseTokenizer(ABC):
+    def __init__(self, name: str, config: TokenizerConfig = TokenizerConfig()):
+        self.name = name
+        self.config = config
+        self._tokenizer: Any = None
+        self._load_lock = Lock()
+        self._counts: OrderedDict[bytes, int] = OrderedDict()
+        self._counts_lock = Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @abstractmethod
+    def _load(self) -> Any:
+        """Import the backend and load the tokenizer of name"""
+
+    @property
+    def tokenizer(self) -> Any:
+        if self._tokenizer is None:
+            with self._load_lock:
+                if self._tokenizer is None:
+                    self._tokenizer = self._load()
+        return self._tokenizer
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._tokenizer is not None
+
     @abstractmethod
     def encode(self, message: str) -> list[int]:
         ...
 
-    @abstractmethod
+    def encode_batch(self, messages: list[str]) -> list[list[int]]:
+        """Encode messages at once, which backends can do faster than one by one"""
+        return [self.encode(message) for message in messages]
+
     def tokens_of(self, message: str) -> int:
-        ...
+        return self.tokens_of_batch([message])[0]
+
+    def tokens_of_batch(self, messages: list[str]) -> list[int]:
+        """Count tokens of messages, encoding only the ones not counted recently"""
+        keys: list[bytes] = [self._content_key(message) for message in messages]
+        counts: list[int | None] = [self._get_count(key) for key in keys]
+        missing: list[int] = [idx for idx, count in enumerate(counts) if count is None]
+        if not missing:
+            return counts  # type: ignore
+        encoded_messages: list[list[int]] = (
+            [self.encode(messages[missing[0]])]
+            if len(missing) == 1
+            else self.encode_batch([messages[idx] for idx in missing])
+        )
+        for idx, encoded in zip(missing, encoded_messages):
+            counts[idx] = len(encoded)
+            self._put_count(keys[idx], len(encoded))
+        return counts  # type: ignore
+
+    @property
+    def stats(self) -> dict[str, int | bool]:
+        return {
+            "loaded": self.is_loaded,
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._counts),
+        }
+
+    @staticmethod
+    def _content_key(message: str) -> bytes:
+        # a digest instead of the message, so cached long messages don't stay in memory
+        return blake2b(message.encode("utf-8"), digest_size=16).digest()
+
+    def _get_count(self, key: bytes) -> int | None:
+        with self._counts_lock:
+            count: int | None = self._counts.get(key)
+            if count is None:
+                self.misses += 1
+                return None
+            self._counts.move_to_end(key)
+            self.hits += 1
+            return count
+
+    def _put_count(self, key: bytes, count: int) -> None:
+        with self._counts_lock:
+            self._counts[key] = count
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.config.count_cache_size:
+                self._counts.popitem(last=False)
 
 
 class OpenAITokenizer(BaseTokenizer):
-    def __init__(self):
-        self._tokenizer = get_encoding("cl100k_base")
+    def __init__(
+        self, name: str = "cl100k_base", config: TokenizerConfig = TokenizerConfig()
+    ):
+        super().__init__(name, config)
+
+    def _load(self) -> Any:
+        from tiktoken.model import get_encoding
+
+        return get_encoding(self.name)
 
     def encode(self, message: str, /) -> list[int]:
-        return self._tokenizer.encode(message)
+        return self.tokenizer.encode(message)
 
-    def tokens_of(self, message: str) -> int:
-        return len(self.encode(message))
+    def encode_batch(self, messages: list[str]) -> list[list[int]]:
+        # tiktoken encodes a batch with a thread pool, releasing the GIL
+        return self.tokenizer.encode_batch(messages)
 
 
 class LlamaTokenizer(BaseTokenizer):
-    def __init__(self, model_name: str):
-        self._tokenizer = transformers.LlamaTokenizer.from_pretrained(model_name)
+    def _load(self) -> Any:
+        import transformers
+
+        try:
+            # rust backed, converted from the sentencepiece model if not published
+            return transformers.AutoTokenizer.from_pretrained(self.name, use_fast=True)
+        except Exception as e:
+            api_logger.warning(
+                f"fast tokenizer of {self.name} is not available, using slow one: {e}"
+            )
+            return transformers.LlamaTokenizer.from_pretrained(self.name)
+
+    @property
+    def is_fast(self) -> bool:
+        return bool(getattr(self.tokenizer, "is_fast", False))
 
     def encode(self, message: str, /) -> list[int]:
-        return self._tokenizer.encode(message)
+        return self.tokenizer.encode(message)
 
-    def tokens_of(self, message: str) -> int:
-        return len(self.encode(message))
+    def encode_batch(self, messages: list[str]) -> list[list[int]]:
+        if not self.is_fast:
+            return super().encode_batch(messages)
+        return self.tokenizer(messages)["input_ids"]
+
+
+_T = TypeVar("_T", bound=BaseTokenizer)
+_shared_tokenizers: dict[tuple[type[BaseTokenizer], str], BaseTokenizer] = {}
+_shared_tokenizers_lock = Lock()
+
+
+def get_tokenizer(tokenizer_type: type[_T], name: str) -> _T:
+    """Tokenizer of name, created once and shared by every model using it"""
+    with _shared_tokenizers_lock:
+        if (tokenizer_type, name) not in _shared_tokenizers:
+            _shared_tokenizers[(tokenizer_type, name)] = tokenizer_type(name)
+        return _shared_tokenizers[(tokenizer_type, name)]  # type: ignore
@@ -1,13 +1,17 @@
 import base64
-from asyncio import gather
+import io
 from datetime import datetime
+from typing import IO
 
-from fastapi.concurrency import run_in_threadpool
+from fastapi.concurrency import iterate_in_threadpool
 from langchain.docstore.document import Document
 from langchain.text_splitter import TokenTextSplitter
 
+from app.logger import api_logger
 from database import cache
-from gpt.fileloader import read_bytes_to_text
+from database.dataclasses import FileUploadConfig
+from database.embeddings import EmbeddingStats
+from gpt.fileloader import iter_document_batches
 
 
 class VectorStoreManager:
@@ -30,8 +34,12 @@ class VectorStoreManager:
         chunk_overlap: int = 0,
         tokenizer_model: str = "gpt-3.5-turbo",
         search_term: str = None,
+        tags: dict[str, str] | None = None,
     ) -> list[str]:
-        """Create documents from text and add them to the vectorstore."""
+        """
+        Create documents from text and add them to the vectorstore.
+        Documents are tagged with tags, such as user_id and chatroom_id, to be filtered by search.
+        """
         texts = TokenTextSplitter(
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
@@ -49,24 +57,52 @@ class VectorStoreManager:
                 return texts
             else:
                 return texts
-        await cache.vectorstore.aadd_texts(texts=texts)
+        stats = EmbeddingStats()
+        await cache.vectorstore.aadd_texts(texts=texts, stats=stats, tags=tags)
+        api_logger.info(f"Embedded text: {stats}")
         return texts
 
     @staticmethod
     async def asimilarity_search(
-        queries: list[str], k: int = 1
+        queries: list[str], k: int = 1, filters: dict[str, str] | None = None
     ) -> list[list[Document]]:
-        """Perform approximate similarity search on the vectorstore."""
-        return await gather(
-            *[cache.vectorstore.asimilarity_search(query, k=k) for query in queries]
+        """
+        Perform approximate similarity search on the vectorstore.
+        Queries are embedded at once unless cached, and searched by one pipeline.
+        Only documents having the tags of filters are searched.
+        """
+        return await cache.vectorstore.abatch_similarity_search(
+            queries, k=k, filters=filters
         )
 
     @classmethod
-    async def embed_file_to_vectorstore(cls, file: bytes, filename: str) -> str:
-        """If user uploads file, embed it to vectorstore."""
+    async def embed_file_to_vectorstore(
+        cls,
+        file: bytes | IO[bytes],
+        filename: str,
+        config: FileUploadConfig = FileUploadConfig(),
+        tags: dict[str, str] | None = None,
+    ) -> str:
+        """
+        If user uploads file, embed it to vectorstore.
+        File is parsed in a thread, and batches of documents are embedded as they are produced,
+        so neither the whole text nor all documents are held in memory at once.
+        """
         try:
-            text: str = await run_in_threadpool(read_bytes_to_text, file, filename)
-            docs: list[str] = await VectorStoreManager.create_documents(text)
-            return f"Successfully embedded documents. You uploaded file begins with...\n\n```{docs[0][:50]}```..."
+            if isinstance(file, bytes):
+                file = io.BytesIO(file)
+            first_doc: str | None = None
+            stats = EmbeddingStats()
+            tags = (tags or {}) | {"source": filename}
+            async for docs in iterate_in_threadpool(
+                iter_document_batches(file=file, filename=filename, config=config)
+            ):
+                await cache.vectorstore.aadd_texts(texts=docs, stats=stats, tags=tags)
+                if first_doc is None:
+                    first_doc = docs[0]
+            if first_doc is None:
+                raise ValueError("No text found in file")
+            api_logger.info(f"Embedded {filename}: {stats}")
+            return f"Successfully embedded documents. You uploaded file begins with...\n\n```{first_doc[:50]}```..."
         except Exception:
             return "Can't embed this type of file. Try another file."
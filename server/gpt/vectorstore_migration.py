@@ -0,0 +1,49 @@
+"""
+Rebuild the index of the vectorstore with another algorithm or parameters, while it serves searches.
+The new index is built over the same documents, then the vectorstore is switched to it by an alias.
+Set the same VECTOR_INDEX_* variables in config/.env after running this.
+
+    python -m gpt.vectorstore_migration --algorithm HNSW --m 16 --ef-construction 200
+"""
+import argparse
+import asyncio
+
+from app.logger import api_logger
+from database import cache
+from database.dataclasses import VectorIndexConfig
+from database.redis import amigrate_index
+
+
+async def main(args: argparse.Namespace) -> None:
+    cache.start()
+    index_config = VectorIndexConfig(
+        algorithm=args.algorithm,
+        m=args.m,
+        ef_construction=args.ef_construction,
+        ef_runtime=args.ef_runtime,
+        initial_cap=args.initial_cap,
+    )
+    new_index_name: str = await amigrate_index(
+        client=cache.redis,
+        index_name=cache.vectorstore.index_name,
+        dim=args.dim,
+        index_config=index_config,
+        drop_old_index=not args.keep_old_index,
+    )
+    api_logger.info(f"Vectorstore is searched by {new_index_name}: {index_config}")
+    await cache.close()
+
+
+if __name__ == "__main__":
+    defaults = VectorIndexConfig()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--algorithm", choices=["FLAT", "HNSW"], default=defaults.algorithm
+    )
+    parser.add_argument("--m", type=int, default=defaults.m)
+    parser.add_argument("--ef-construction", type=int, default=defaults.ef_construction)
+    parser.add_argument("--ef-runtime", type=int, default=defaults.ef_runtime)
+    parser.add_argument("--initial-cap", type=int, default=defaults.initial_cap)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--keep-old-index", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -1,33 +1,157 @@
-from typing import AsyncGenerator, AsyncIterator, Generator, Iterator
+import asyncio
+from typing import TYPE_CHECKING, AsyncGenerator, AsyncIterator, Generator, Iterator
 
 from fastapi import WebSocket
 
-from database.schemas import InitMessage, MessageToWebsocket
+from database.dataclasses import WebsocketStreamConfig
+from database.schemas import InitMessage, MessageToWebsocketFrame
 from gpt.buffer import BufferedUserContext
 from gpt.common import OpenAIModel
 from gpt.generation import message_history_organizer
 
+if TYPE_CHECKING:
+    from gpt.llama_worker import LlamaJob
+
+
+class CoalescingSender:
+    """
+    Sends deltas of a stream to websocket, coalescing the ones arriving while a frame is sent
+    or within `flush_interval` since the last frame, unless they reach `flush_bytes`.
+    A delta arriving after a quiet period is sent right away.
+    If the client doesn't drain as fast as deltas arrive, `push` waits once `max_pending_bytes`
+    are pending, so the stream is read only as fast as the client receives.
+    Frames are encoded from a template of the stream, rather than built as pydantic models.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        frame: MessageToWebsocketFrame,
+        config: WebsocketStreamConfig = WebsocketStreamConfig(),
+    ):
+        self.websocket = websocket
+        self.config = config
+        self.frames: int = 0
+        self._frame = frame
+        self._pending: list[str] = []
+        self._pending_bytes: int = 0
+        self._last_sent_at: float = float("-inf")
+        self._closing: bool = False
+        self._has_pending = asyncio.Event()
+        self._budget_reached = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._task: asyncio.Task = asyncio.create_task(self._run())
+
+    async def push(self, delta: str) -> None:
+        if self._task.done():
+            self._task.result()  # raises error of sending, if any
+            raise RuntimeError("Sender is closed.")
+        self._pending.append(delta)
+        self._pending_bytes += len(delta.encode("utf-8"))
+        self._has_pending.set()
+        if self._pending_bytes >= self.config.flush_bytes:
+            self._budget_reached.set()
+        if self._pending_bytes >= self.config.max_pending_bytes:
+            self._drained.clear()
+            drained = asyncio.ensure_future(self._drained.wait())
+            try:
+                await asyncio.wait(
+                    (drained, self._task), return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                drained.cancel()
+
+    async def close(self) -> str:
+        """Stop sending after the frame being sent, returning deltas not sent yet"""
+        self._closing = True
+        self._has_pending.set()
+        self._budget_reached.set()
+        try:
+            await self._task
+        finally:
+            rest: str = "".join(self._pending)
+            self._pending.clear()
+            self._pending_bytes = 0
+        return rest
+
+    def cancel(self) -> None:
+        self._task.cancel()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._has_pending.wait()
+            if self._closing:
+                return
+            delay: float = self._last_sent_at + self.config.flush_interval - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._budget_reached.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                if self._closing:
+                    return
+            msg: str = "".join(self._pending)
+            self._pending.clear()
+            self._pending_bytes = 0
+            self._has_pending.clear()
+            self._budget_reached.clear()
+            self._drained.set()
+            self._last_sent_at = loop.time()
+            await self.websocket.send_text(self._frame.text(msg))
+            self.frames += 1
+
 
 class SendToWebsocket:
-    @staticmethod
+    # number of (user message, gpt message) pairs sent at once as previous chats
+    previous_chats_window: int = 20
+
+    @classmethod
     async def init(
+        cls,
         buffer: BufferedUserContext,
         send_chatroom_ids: bool = True,
         send_previous_chats: bool = True,
         init_callback: bool = True,
+        previous_chats_before: int | None = None,
     ) -> None:
-        """Send initial message to websocket, providing current state of user"""
-        previous_chats = message_history_organizer(
-            user_gpt_context=buffer.current_user_gpt_context,
-            send_to_stream=False,
-        )
-        assert isinstance(previous_chats, list)
-        current_model = buffer.current_user_gpt_context.gpt_model.value
+        """
+        Send initial message to websocket, providing current state of user.
+        Only the latest window of previous chats is sent,
+        and older windows are sent when requested with `previous_chats_before`.
+        """
+        user_gpt_context = buffer.current_user_gpt_context
+        previous_chats: list[dict] | None = None
+        previous_chats_offset: int | None = None
+        if send_previous_chats:
+            n_turns: int = max(
+                len(user_gpt_context.user_message_histories),
+                len(user_gpt_context.gpt_message_histories),
+            )
+            end: int = (
+                n_turns
+                if previous_chats_before is None
+                else max(min(previous_chats_before, n_turns), 0)
+            )
+            previous_chats_offset = max(end - cls.previous_chats_window, 0)
+            previous_chats = message_history_organizer(  # type: ignore
+                user_gpt_context=user_gpt_context,
+                send_to_stream=False,
+                turns=slice(
+                    previous_chats_offset,
+                    None if previous_chats_before is None else end,
+                ),
+            )
+            assert isinstance(previous_chats, list)
+        current_model = user_gpt_context.gpt_model.value
         await SendToWebsocket.message(
             websocket=buffer.websocket,
             msg=InitMessage(
                 chatroom_ids=buffer.sorted_chatroom_ids if send_chatroom_ids else None,
-                previous_chats=previous_chats if send_previous_chats else None,
+                previous_chats=previous_chats,
+                previous_chats_offset=previous_chats_offset,
+                older_chats=previous_chats_before is not None,
                 init_callback=init_callback,
             ).json(),
             chatroom_id=buffer.current_chatroom_id,
@@ -50,37 +174,70 @@ class SendToWebsocket:
         """Send whole message to websocket"""
         if websocket.client_state.value != 1:
             return
-        await websocket.send_json(
-            MessageToWebsocket(
-                msg=msg,
-                finish=finish,
+        await websocket.send_text(
+            MessageToWebsocketFrame(
                 chatroom_id=chatroom_id,
                 is_user=is_user,
                 init=init,
                 model_name=model_name,
-            ).dict()
+            ).text(msg, finish)
         )
 
+    @staticmethod
+    async def queue_status(
+        buffer: BufferedUserContext,
+        job: "LlamaJob",
+        poll_interval: float = 1.0,
+    ) -> None:
+        """Send queue position of job to websocket whenever it changes, until job is dispatched"""
+        sent: tuple[int | None, int | None] | None = None
+        while not job.is_dispatched and not job.is_done:
+            status: tuple[int | None, int | None] = (
+                job.queue_position,
+                round(job.estimated_wait) if job.estimated_wait is not None else None,
+            )
+            if status != sent and buffer.websocket.client_state.value == 1:
+                await buffer.websocket.send_text(
+                    MessageToWebsocketFrame(
+                        chatroom_id=buffer.current_chatroom_id,
+                        is_user=False,
+                        queue_position=status[0],
+                        estimated_wait=status[1],
+                    ).text("")
+                )
+                sent = status
+            try:
+                await asyncio.wait_for(job.updated.wait(), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            job.updated.clear()
+            if buffer.done.is_set():
+                buffer.done.clear()
+                raise InterruptedError("Stream was interrupted by user.")
+
     @staticmethod
     async def stream(
         buffer: BufferedUserContext,
         stream: AsyncGenerator | Generator | AsyncIterator | Iterator,
         finish: bool = True,
         is_user: bool = False,
-        chunk_size: int = 2,
         model_name: str | None = None,
+        config: WebsocketStreamConfig = WebsocketStreamConfig(),
     ) -> str:
-        """Send SSE stream to websocket"""
-        final_response, stream_buffer = "", ""
-        iteration: int = 0
-        await buffer.websocket.send_json(
-            MessageToWebsocket(
-                msg=None,
-                finish=False,
+        """Send SSE stream to websocket, coalescing deltas into frames as the client drains them"""
+        final_response: str = ""
+        await buffer.websocket.send_text(
+            MessageToWebsocketFrame(
                 chatroom_id=buffer.current_chatroom_id,
                 is_user=is_user,
                 model_name=model_name,
-            ).dict()
+            ).text(None)
+        )
+        frame = MessageToWebsocketFrame(
+            chatroom_id=buffer.current_chatroom_id, is_user=is_user
+        )
+        sender = CoalescingSender(
+            websocket=buffer.websocket, frame=frame, config=config
         )
         try:
             if isinstance(stream, (Generator, Iterator)):
@@ -89,56 +246,27 @@ class SendToWebsocket:
                     if buffer.done.is_set():
                         buffer.done.clear()
                         raise InterruptedError("Stream was interrupted by user.")
-                    stream_buffer += delta
-                    iteration += 1
-                    if iteration % chunk_size == 0:
-                        final_response += stream_buffer
-                        await buffer.websocket.send_json(
-                            MessageToWebsocket(
-                                msg=stream_buffer,
-                                finish=False,
-                                chatroom_id=buffer.current_chatroom_id,
-                                is_user=is_user,
-                            ).dict()
-                        )
-                        stream_buffer = ""
+                    final_response += delta
+                    await sender.push(delta)
             elif isinstance(stream, (AsyncGenerator, AsyncIterator)):
                 async for delta in stream:
                     # stream from api
                     if buffer.done.is_set():
                         buffer.done.clear()
                         raise InterruptedError("Stream was interrupted by user.")
-                    stream_buffer += delta
-                    iteration += 1
-                    if iteration % chunk_size == 0:
-                        final_response += stream_buffer
-                        await buffer.websocket.send_json(
-                            MessageToWebsocket(
-                                msg=stream_buffer,
-                                finish=False,
-                                chatroom_id=buffer.current_chatroom_id,
-                                is_user=is_user,
-                            ).dict()
-                        )
-                        stream_buffer = ""
+                    final_response += delta
+                    await sender.push(delta)
             else:
                 raise TypeError("Stream type is not AsyncGenerator or Generator.")
         except InterruptedError as e:
-            await buffer.websocket.send_json(
-                MessageToWebsocket(
-                    msg=stream_buffer,
-                    finish=True,
-                    chatroom_id=buffer.current_chatroom_id,
-                    is_user=is_user,
-                ).dict()
+            await buffer.websocket.send_text(
+                frame.text(await sender.close(), finish=True)
             )
             raise e
-        await buffer.websocket.send_json(
-            MessageToWebsocket(
-                msg=stream_buffer,
-                finish=True if finish else False,
-                chatroom_id=buffer.current_chatroom_id,
-                is_user=is_user,
-            ).dict()
+        except BaseException:
+            sender.cancel()
+            raise
+        await buffer.websocket.send_text(
+            frame.text(await sender.close(), finish=True if finish else False)
         )
         return final_response